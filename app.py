@@ -1,16 +1,768 @@
-from flask import Flask, request, jsonify, render_template, session
+from flask import (Flask, request, jsonify, render_template, session, g, Response, send_from_directory, url_for,
+                   has_request_context)
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 import random
 import json
+import atexit
+import bisect
+import contextlib
+import copy
+import gzip
+import hashlib
+import math
+import mimetypes
 import sys
+import os
+import multiprocessing
+import heapq
+import mmap
+import pickle
+import secrets
+import shutil
+import sqlite3
+import statistics
+import struct
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
+
+try:
+    import numpy as np  # バッチ学習 (simulate_q_vs_q_batch) でのみ使用
+except ImportError:
+    np = None
+
+try:
+    import fcntl  # 学習ジョブの起動をプロセス間で排他する (Windows にはないのでプロセス内の排他だけになる)
+except ImportError:
+    fcntl = None
 
 # --- Flask アプリケーションのインスタンス作成 ---
 app = Flask(__name__)
 app.secret_key = 'your_super_secret_and_random_string_here'  # セッション用の秘密鍵
 
+
+# --- メトリクス (/metrics, Prometheus テキスト形式) ---
+# 値はワーカープロセスごとに集計し、全ての行に worker="<pid>" ラベルを付けて出力する。
+# リクエストごとの処理は perf_counter 2回とヒストグラムへの加算だけにしている。
+# Qテーブルの大きさやメモリ使用量などは /metrics が呼ばれたときに計算する。
+METRICS_PREFIX = "blackjack"
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRICS_SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+class Histogram:
+    """バケットごとの度数 (出力時に累積する)、合計、件数"""
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """ワーカープロセス内のカウンターとヒストグラム"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_latency = {}  # ルート -> Histogram
+        self.requests = {}         # (ルート, ステータス) -> 件数
+        # AIの判断の内訳。hit: 学習済みの状態, fallback: 未学習の状態 (Qテーブルにない = ミス),
+        # rule: 固定ルール (合計 LOW_TOTAL_THRESHOLD 以下 / 21以上、プレイヤーの牽制ルール)
+        self.policy_decisions = {"hit": 0, "fallback": 0, "rule": 0}
+        self.game_state_bytes = Histogram(METRICS_SIZE_BUCKETS)
+
+    def observe_request(self, route, status, seconds):
+        with self._lock:
+            histogram = self.request_latency.get(route)
+            if histogram is None:
+                histogram = self.request_latency[route] = Histogram(METRICS_LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def count_policy_decision(self, result):
+        with self._lock:
+            self.policy_decisions[result] += 1
+
+    def count_policy_code(self, code, ai_total):
+        """FrozenPolicy.code() の結果を内訳に加える"""
+        if ai_total <= LOW_TOTAL_THRESHOLD or ai_total >= BURST_LIMIT:
+            self.count_policy_decision("rule")
+        elif code & POLICY_FALLBACK_FLAG:
+            self.count_policy_decision("fallback")
+        else:
+            self.count_policy_decision("hit")
+
+    def observe_game_state_bytes(self, size):
+        with self._lock:
+            self.game_state_bytes.observe(size)
+
+    def render(self, gauges):
+        """Prometheus テキスト形式で出力する。gauges は [(名前, 説明, [(ラベル, 値), ...]), ...]"""
+        worker = f'worker="{os.getpid()}"'
+        lines = []
+
+        def header(name, help_text, kind):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join([worker] + [f'{k}="{v}"' for k, v in labels.items()])
+            lines.append(f"{METRICS_PREFIX}_{name}{{{label_text}}} {value}")
+
+        def histogram(name, labels, h):
+            cumulative = 0
+            for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                cumulative += count
+                sample(f"{name}_bucket", dict(labels, le=bound), cumulative)
+            sample(f"{name}_sum", labels, h.total)
+            sample(f"{name}_count", labels, h.count)
+
+        with self._lock:
+            header("request_duration_seconds", "Request latency by route.", "histogram")
+            for route, h in sorted(self.request_latency.items()):
+                histogram("request_duration_seconds", {"route": route}, h)
+            header("requests_total", "Requests by route and status code.", "counter")
+            for (route, status), count in sorted(self.requests.items()):
+                sample("requests_total", {"route": route, "status": status}, count)
+            header("policy_decisions_total",
+                   "AI decisions: hit (learned state), fallback (state missing from the Q-table), rule.", "counter")
+            for result, count in self.policy_decisions.items():
+                sample("policy_decisions_total", {"result": result}, count)
+            header("game_state_bytes", "Size of the stored game state per write.", "histogram")
+            histogram("game_state_bytes", {}, self.game_state_bytes)
+        for name, help_text, samples in gauges:
+            header(name, help_text, "gauge")
+            for labels, value in samples:
+                sample(name, labels, value)
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe_request(route, response.status_code, time.perf_counter() - started)
+    return response
+
+
+# --- サーバー側のゲーム状態ストア ---
+# ゲームの状態 (山札、手札、SPカード、ポイントなど) はサーバー側に保存し、
+# Cookie にはランダムなセッションIDだけを載せる。ルートからは今まで通り flask.session で扱える。
+#  - GAME_STATE_BACKEND=memory (既定): プロセス内の辞書 (TTL + LRU で古いものから削除)
+#  - GAME_STATE_BACKEND=sqlite: 同じホストの全ワーカーで共有する SQLite ファイル (gunicorn -w 2 など)
+GAME_STATE_BACKEND = os.environ.get("GAME_STATE_BACKEND", "memory")
+GAME_STATE_TTL = int(os.environ.get("GAME_STATE_TTL", 24 * 60 * 60))  # 最後の更新からの保持秒数
+GAME_STATE_MAX_SESSIONS = int(os.environ.get("GAME_STATE_MAX_SESSIONS", 10000))  # memory の上限
+GAME_STATE_SQLITE_PATH = os.environ.get("GAME_STATE_SQLITE_PATH", "game_state.sqlite3")
+
+
+class InMemoryStateStore:
+    """プロセス内のゲーム状態ストア (セッションID -> pickle 済みの状態)"""
+
+    def __init__(self, ttl=GAME_STATE_TTL, max_sessions=GAME_STATE_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._data = OrderedDict()  # sid -> (期限, データ)。末尾ほど最近使ったもの
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return entry[1]
+
+    def set(self, sid, data):
+        with self._lock:
+            self._data[sid] = (time.time() + self.ttl, data)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class SQLiteStateStore:
+    """SQLite ファイルのゲーム状態ストア。同じホストの複数ワーカーで共有できる"""
+    PURGE_EVERY = 1000  # 書き込みこの回数ごとに期限切れの状態を削除する
+
+    def __init__(self, path=GAME_STATE_SQLITE_PATH, ttl=GAME_STATE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()  # sqlite3 の接続はスレッドごとに持つ
+        self._writes = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS game_state (sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = self._connection().execute(
+            "SELECT data FROM game_state WHERE sid = ? AND expires >= ?", (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, data):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO game_state (sid, data, expires) VALUES (?, ?, ?)",
+                     (sid, data, now + self.ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM game_state WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM game_state WHERE sid = ?", (sid,))
+
+
+GAME_STATE_STORES = {"memory": InMemoryStateStore, "sqlite": SQLiteStateStore}
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """サーバー側に保存するセッション。loaded は読み込んだ時点の pickle (変更検出用)"""
+
+    def __init__(self, initial=None, sid=None, loaded=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.loaded = loaded
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Cookie にはセッションIDだけを入れ、状態は store に保存する SessionInterface"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.store.get(sid) if sid else None
+        if data is None:
+            # 見つからないIDは引き継がず、新しいIDを発行する (古い署名付き Cookie もここに来る)
+            return ServerSideSession(sid=None)
+        return ServerSideSession(pickle.loads(data), sid=sid, loaded=data)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid is not None and (session.modified or session.loaded is not None):
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        # ルートはリストや辞書をその場で書き換えることがあるので、modified ではなく
+        # pickle の中身を比べて変わったときだけ保存する
+        data = pickle.dumps(dict(session), pickle.HIGHEST_PROTOCOL)
+        if data == session.loaded:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        self.store.set(session.sid, data)
+        session.loaded = data
+        metrics.observe_game_state_bytes(len(data))
+
+
+app.session_interface = ServerSideSessionInterface(GAME_STATE_STORES[GAME_STATE_BACKEND]())
+
+# --- 状態の版と差分レスポンス ---
+# ゲームのルートは、レスポンスに状態の版 (state_version) を付ける。リクエストの X-State-Version が
+# サーバーの版と一致すれば、クライアントは前回のレスポンスまでの状態を持っているので、
+# STATE_FIELDS のうち変わった項目だけを返す ("delta": true)。一致しない・ヘッダーがないときは
+# 従来どおり全項目を返す ("delta": false)。状態はルートのペイロードではなく、常にセッションの現在の
+# 状態 (current_game_state) から作る。最後に送った状態はコピーをセッションの "client_state" に残す
+# (手札などのリストは以降のリクエストでその場で書き換えられるので、同じオブジェクトを共有しない)。
+# JSON のレスポンスは、クライアントが gzip を受け付けて RESPONSE_GZIP_MIN_BYTES 以上なら圧縮する。
+STATE_FIELDS = ("player_hand", "ai_hand", "player_points", "ai_points", "player_sp_cards", "ai_sp_cards",
+                "declared_sp_card", "ai_declared_sp_card", "game_over")
+STATE_VERSION_HEADER = "X-State-Version"
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get("RESPONSE_GZIP_MIN_BYTES", "512"))  # 0 で圧縮しない
+_MISSING = object()
+
+
+def versioned_payload(payload):
+    """
+    ゲームのルートのレスポンス (dict) に state_version を付け、クライアントの版が最新なら差分にして返す。
+    payload の STATE_FIELDS の項目は使わず、セッションの現在の状態で置き換える。
+    /turn のように1つのレスポンスに複数の結果を入れるときは、前から順に呼べば順に当てられる差分になる
+    (リクエストに X-State-Version がなければ、どの結果も全項目で返す)。
+    """
+    client_version = g.get("client_state_version", request.headers.get(STATE_VERSION_HEADER))
+    version = session.get("state_version", 0)
+    known = session.get("client_state")
+    state = copy.deepcopy(current_game_state())
+    body = {key: value for key, value in payload.items() if key not in STATE_FIELDS}
+    if known is not None and client_version == str(version):
+        changed = {key: value for key, value in state.items() if known.get(key, _MISSING) != value}
+        body.update(changed, delta=True)
+    else:
+        body.update(state, delta=False)
+    if state != known:
+        version += 1
+        session["state_version"] = version
+        session["client_state"] = state
+    body["state_version"] = version
+    if client_version is not None:
+        g.client_state_version = str(version)  # ヘッダーなしのリクエストは、後の結果も全項目で返す
+    return body
+
+
+def current_game_state():
+    """セッションのゲーム状態を、ルートのレスポンスと同じ形 (AIの1枚目はゲーム終了まで伏せる) で返す"""
+    game_over = session.get("turn") == "end"
+    ai_hand = session.get("ai_hand", [])
+    return {
+        "player_hand": session.get("player_hand", []),
+        "ai_hand": ai_hand if game_over or not ai_hand else [0] + ai_hand[1:],
+        "player_points": session.get("player_points", INITIAL_POINTS),
+        "ai_points": session.get("ai_points", INITIAL_POINTS),
+        "player_sp_cards": session.get("player_sp_cards", {}),
+        "ai_sp_cards": session.get("ai_sp_cards", {}),
+        "declared_sp_card": session.get("declared_sp_card"),
+        "ai_declared_sp_card": session.get("ai_declared_sp_card"),
+        "game_over": game_over,
+    }
+
+
+@app.after_request
+def _compress_response(response):
+    if (not RESPONSE_GZIP_MIN_BYTES or response.mimetype != "application/json" or response.direct_passthrough
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        data = response.get_data()
+        if len(data) >= RESPONSE_GZIP_MIN_BYTES:
+            response.set_data(gzip.compress(data, compresslevel=6))
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+# --- 静的アセット ---
+# build_assets.py が static/dist/ にスプライトシートと内容のハッシュ付きファイル、manifest.json を出力する。
+# manifest があればテンプレートの asset_url() はハッシュ付きの URL を返し、/static/dist/ は1年の immutable で
+# 配信する (.gz があれば gzip を受け付けるクライアントにそれを返す)。
+# manifest がない (ビルドしていない) とき、または STATIC_ASSETS=source のときは元のファイルをそのまま使う。
+ASSET_DIST_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST_PATH = os.path.join(ASSET_DIST_DIR, "manifest.json")
+ASSET_CACHE_SECONDS = 365 * 24 * 3600
+
+
+def load_asset_manifest(path=ASSET_MANIFEST_PATH):
+    """build_assets.py の manifest を読む。使わないとき・読めないときは空の manifest"""
+    if os.environ.get("STATIC_ASSETS", "auto") == "source":
+        return {"assets": {}, "preload": []}
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"assets": {}, "preload": []}
+    print(f"静的アセット: {path} のビルド済みファイルを使います。")
+    return manifest
+
+
+asset_manifest = load_asset_manifest()
+
+
+@app.template_global()
+def asset_url(filename):
+    """static/ からの相対パスを、ビルド済みならハッシュ付きのファイルの URL にして返す"""
+    return url_for("static", filename=asset_manifest["assets"].get(filename, filename))
+
+
+@app.template_global()
+def preload_asset_urls():
+    """テンプレートで先読みさせるスプライトシートの URL (ビルドしていなければ空)"""
+    return [asset_url(filename) for filename in asset_manifest.get("preload", [])]
+
+
+@app.route("/static/dist/<path:filename>")
+def dist_asset(filename):
+    """ハッシュ付きのファイルは内容が変わらないので、ブラウザにずっとキャッシュさせる"""
+    if filename == "manifest.json":  # manifest だけはハッシュが付かないので配信しない
+        return jsonify({"error": "Not found."}), 404
+    mimetype = mimetypes.guess_type(filename)[0]
+    accepts_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+    if accepts_gzip and os.path.isfile(os.path.join(ASSET_DIST_DIR, filename + ".gz")):
+        response = send_from_directory(ASSET_DIST_DIR, filename + ".gz", mimetype=mimetype,
+                                       max_age=ASSET_CACHE_SECONDS)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_from_directory(ASSET_DIST_DIR, filename, mimetype=mimetype, max_age=ASSET_CACHE_SECONDS)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+
+# --- ゲームのイベントストリーム (Server-Sent Events) ---
+# /turn に "push": true を付けると、AIのターンはレスポンスに入れず、セッションの "game_events" に積む。
+# GET /events はそれを text/event-stream で順に送る。各イベントには配信してよい時刻 "at" があり、
+# AIの行動は GAME_EVENT_DELAY 秒ずつ間を空けて届く (クライアントのタイマーではなくサーバーが間を決める)。
+# イベントIDはセッション内の通し番号で、再接続時の Last-Event-ID から続きを送る。
+# ストリームはセッションストアを GAME_EVENTS_POLL_SECONDS ごとに読み直すので、複数ワーカーでは
+# GAME_STATE_BACKEND=sqlite にする。1本のストリームは GAME_EVENTS_STREAM_SECONDS で閉じ、ブラウザが再接続する。
+# 開いているストリームは待っている間もワーカーのスレッドを1つ占有するので、既定では無効 (GAME_EVENTS=1 で有効)。
+# 有効にするときは gevent などの非同期ワーカーで動かす (gunicorn.conf.py は GAME_EVENTS=1 なら gevent を使う)。
+GAME_EVENTS_ENABLED = os.environ.get("GAME_EVENTS", "0") == "1"
+GAME_EVENT_DELAY = float(os.environ.get("GAME_EVENT_DELAY", "0.6"))
+GAME_EVENTS_BACKLOG = 16  # セッションに残すイベント数 (再接続で送り直せる範囲)
+GAME_EVENTS_POLL_SECONDS = 0.2
+GAME_EVENTS_KEEPALIVE_SECONDS = 15
+GAME_EVENTS_STREAM_SECONDS = int(os.environ.get("GAME_EVENTS_STREAM_SECONDS", "300"))
+
+
+def push_game_event(event, data, delay=0.0):
+    """セッションにイベントを積む。配信時刻は直前のイベントから delay 秒後 (過去なら今から delay 秒後)"""
+    events = session.get("game_events", [])
+    event_id = session.get("game_event_seq", 0) + 1
+    at = max(events[-1]["at"] if events else 0.0, time.time()) + delay
+    events.append({"id": event_id, "event": event, "data": data, "at": at})
+    session["game_events"] = events[-GAME_EVENTS_BACKLOG:]
+    session["game_event_seq"] = event_id
+    return event_id
+
+
+def push_ai_turn_events(payload, declared_before):
+    """
+    _ai_turn() の結果をイベントにして積む:
+      ai_sp_declared : AIが宣言系SPカードを宣言した
+      ai_action      : AIのヒット/スタンド (/ai_turn と同じ内容)
+      round_end      : 決着した (ai_action の代わりに送る。AIの手札は全部見える)
+    ペイロードは状態の全項目を持つ (差分にしない) ので、どの版のクライアントでもそのまま当てられる。
+    """
+    declared = session.get("ai_declared_sp_card")
+    if declared and declared != declared_before:
+        push_game_event("ai_sp_declared", {
+            "ai_declared_sp_card": declared,
+            "name": SP_CARDS_MASTER.get(declared, {}).get("name", declared),
+        }, delay=GAME_EVENT_DELAY)
+    g.client_state_version = None
+    body = versioned_payload(payload)
+    return push_game_event("round_end" if body.get("game_over") else "ai_action", body, delay=GAME_EVENT_DELAY)
+
+
+def _format_sse(event):
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+
+def stream_game_events(store, sid, last_id):
+    """store のセッション sid から、last_id より後のイベントを配信時刻になったものから送るジェネレーター"""
+    yield "retry: 1000\n\n"  # 切れたら1秒後に再接続させる
+    deadline = time.monotonic() + GAME_EVENTS_STREAM_SECONDS
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        data = store.get(sid)
+        if data is None:  # リセットされたか期限切れ
+            return
+        events = [event for event in pickle.loads(data).get("game_events", []) if event["id"] > last_id]
+        if events and events[0]["id"] > last_id + 1:
+            # 送り直せる範囲より前から再接続してきたので、状態を取り直してもらう
+            yield "event: resync\ndata: {}\n\n"
+            last_id = events[0]["id"] - 1  # 最初のイベントが配信時刻前でも、resync は1回だけ送る
+        now = time.time()
+        wait = GAME_EVENTS_POLL_SECONDS
+        for event in events:
+            if event["at"] > now:
+                wait = min(wait, event["at"] - now)
+                break
+            yield _format_sse(event)
+            last_id = event["id"]
+            last_sent = time.monotonic()
+        if time.monotonic() - last_sent >= GAME_EVENTS_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"  # プロキシに接続を切られないようにコメント行を送る
+            last_sent = time.monotonic()
+        time.sleep(max(wait, 0.01))
+
+
+# --- ゲームのイベントログ ---
+# EVENT_LOG_DIR を設定すると、ゲームの出来事 (配札、プレイヤーとAIの行動、SPカード、決着) を1件1行の
+# JSONL で追記する。リクエスト側は dict をキューに積むだけで、JSON への変換とファイルへの書き込みは
+# プロセスごとのバックグラウンドスレッドが EVENT_LOG_FLUSH_SECONDS ごとにまとめて行う。
+# ファイルはワーカーのプロセスごとに分け (events-<開始時刻>-<pid>-<番号>.jsonl)、
+# EVENT_LOG_MAX_BYTES を超えたら次のファイルに切り替える。書き込みが追いつかずキューが
+# EVENT_LOG_QUEUE_LIMIT 件を超えたら、そのイベントは捨てて件数だけ数える。
+# キーは短くしている:
+#   共通    e: 種類, g: ゲームID, n: ゲーム内の通し番号, t: 時刻 (UNIX 秒)
+#   start   ph/ah: 配られた手札, pp/ap: ポイント, ps/as: SPカードの所持数
+#   player  a: hit/stand, c: 引いたカード, tot: 行動後の合計
+#   sp      who: player/ai, c: カードID, ok: 効果が出たか (手札戻しで戻せたか。宣言は常に true)
+#   ai      s: 行動前の [AIの合計, プレイヤーの表のカード, 山札のマスク], a: hit/stand,
+#           r: 1 なら固定ルールの行動, fb: 1 なら未学習の状態のフォールバック, v: 配信方策の版
+#   end     r: 勝敗 (プレイヤーから見て 1/0/-1), pt/at: 最終合計, pp/ap: 決着後のポイント,
+#           dp/da: 宣言されていたSPカード
+EVENT_LOG_DIR = os.environ.get("EVENT_LOG_DIR", "")
+EVENT_LOG_MAX_BYTES = int(os.environ.get("EVENT_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+EVENT_LOG_FLUSH_SECONDS = 1.0
+EVENT_LOG_QUEUE_LIMIT = 100000
+EVENT_LOG_STALE_SECONDS = 3600  # 集計で、これより長く続きのないゲームは放棄されたとみなす
+
+
+class GameEventLog:
+    """ゲームのイベントを JSONL ファイルに追記するレコーダー。record() はキューに積むだけ"""
+    _start_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes=EVENT_LOG_MAX_BYTES, flush_seconds=EVENT_LOG_FLUSH_SECONDS,
+                 queue_limit=EVENT_LOG_QUEUE_LIMIT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_seconds = flush_seconds
+        self.queue_limit = queue_limit
+        self._pid = None
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_bytes = 0
+        self._file_index = 0
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, event):
+        """イベントを1件積む (deque の append はロックなしでスレッドセーフ)"""
+        if self._pid != os.getpid():
+            self._start()
+        if len(self._queue) >= self.queue_limit:
+            self.dropped += 1
+            return
+        self._queue.append(event)
+
+    def _start(self):
+        """このプロセスの書き込みスレッドを起動する (fork されたワーカーでは最初の record() で起動)"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # fork 前の状態は親プロセスのもの。子は自分のキューとファイルで書き始める
+            self._queue = deque()
+            self._lock = threading.Lock()
+            self._file = None
+            self._file_bytes = 0
+            self._file_index = 0
+            self.written = 0
+            self.dropped = 0
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="game-event-log", daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def _open_next_file(self):
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._file_index += 1
+        name = f"events-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._file_index:04d}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._file_bytes = 0
+
+    def flush(self):
+        """キューにたまったイベントを書き出す"""
+        with self._lock:
+            queue = self._queue
+            lines = []
+            while queue:
+                lines.append(json.dumps(queue.popleft(), ensure_ascii=False, separators=(",", ":")))
+            if not lines:
+                return
+            data = ("\n".join(lines) + "\n").encode("utf-8")
+            try:
+                if self._file is None or self._file_bytes >= self.max_bytes:
+                    self._open_next_file()
+                self._file.write(data)
+                self._file.flush()
+            except OSError as e:
+                print(f"イベントログを書き込めませんでした ({len(lines)} 件を破棄): {e}")
+                self.dropped += len(lines)
+                return
+            self._file_bytes += len(data)
+            self.written += len(lines)
+
+
+game_event_log = GameEventLog(EVENT_LOG_DIR) if EVENT_LOG_DIR else None
+
+
+def log_game_event(kind, **fields):
+    """
+    いまのセッションのゲームにイベントを1件記録する (EVENT_LOG_DIR が未設定なら何もしない)。
+    書き出しは後でまとめて行うので、セッションのリストを渡すときはコピーにすること。
+    """
+    if game_event_log is None:
+        return
+    seq = session.get("game_log_seq", 0) + 1
+    session["game_log_seq"] = seq
+    event = {"e": kind, "g": session.get("game_id"), "n": seq, "t": round(time.time(), 3)}
+    event.update(fields)
+    game_event_log.record(event)
+
+
+def _event_log_files(paths):
+    """ファイルとディレクトリ (中の events-*.jsonl / .jsonl.gz) を展開する"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.startswith("events-") and name.endswith((".jsonl", ".jsonl.gz")))
+        else:
+            files.append(path)
+    return files
+
+
+def _read_event_log_file(path):
+    """1ファイルのイベントを1行ずつ返す (書き込み途中で切れた行などは読み飛ばす)"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def read_game_event_log(paths):
+    """
+    ログファイル群のイベントを時刻順に1件ずつ返すジェネレーター。
+    ファイルはワーカーごとに分かれているので時刻でマージするが、同時に開くのは
+    時間帯の重なるファイルだけにする (先頭のイベントの時刻に達してから開く)。
+    """
+    pending = []
+    for path in _event_log_files(paths):
+        events = _read_event_log_file(path)
+        first = next(events, None)
+        events.close()
+        if first is not None:
+            pending.append((first["t"], path))
+    pending.sort(reverse=True)
+    heap = []
+    counter = 0
+    while pending or heap:
+        while pending and (not heap or pending[-1][0] <= heap[0][0]):
+            _, path = pending.pop()
+            events = _read_event_log_file(path)
+            event = next(events, None)
+            if event is not None:
+                heapq.heappush(heap, (event["t"], counter, event, events))
+                counter += 1
+        t, order, event, events = heapq.heappop(heap)
+        yield event
+        following = next(events, None)
+        if following is not None:
+            heapq.heappush(heap, (following["t"], order, following, events))
+
+
+def summarize_game_events(events, stale_seconds=EVENT_LOG_STALE_SECONDS, confidence=0.95):
+    """
+    イベントを1回なめて集計する。メモリに持つのは進行中のゲームだけで、決着したゲームは捨てる。
+    返す値: ゲーム数と勝敗 (プレイヤーから見た勝率と信頼区間)、1ゲームの平均ターン数・秒数、
+    AIの行動の内訳、SPカード (使った側 × カード) ごとの使用数・使った側の勝率・効果が出た割合
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    games = {}  # 進行中のゲーム: ゲームID -> {"start", "last", "turns", "sp"}
+    results = {1: 0, 0: 0, -1: 0}
+    turns_total = 0
+    seconds_total = 0.0
+    abandoned = 0
+    count = 0
+    ai_actions = {"hit": 0, "stand": 0, "rule": 0, "fallback": 0}
+    sp_cards = {}
+    for event in events:
+        count += 1
+        kind, game_id, t = event.get("e"), event.get("g"), event.get("t", 0.0)
+        if kind == "start":
+            games[game_id] = {"start": t, "last": t, "turns": 0, "sp": []}
+        game = games.get(game_id)
+        if game is None:  # 始まりがログにないゲーム
+            continue
+        game["last"] = t
+        if kind == "player":
+            game["turns"] += 1
+        elif kind == "ai":
+            game["turns"] += 1
+            ai_actions[event["a"]] = ai_actions.get(event["a"], 0) + 1
+            ai_actions["rule"] += event.get("r", 0)
+            ai_actions["fallback"] += event.get("fb", 0)
+        elif kind == "sp":
+            game["sp"].append((event["who"], event["c"], event.get("ok", True)))
+        elif kind == "end":
+            del games[game_id]
+            result = event["r"]
+            results[result] += 1
+            turns_total += game["turns"]
+            seconds_total += t - game["start"]
+            for who, card_id, ok in game["sp"]:
+                won = result == (1 if who == "player" else -1)
+                stats = sp_cards.setdefault(f"{who}:{card_id}", {"used": 0, "wins": 0, "effective": 0})
+                stats["used"] += 1
+                stats["wins"] += won
+                # 宣言系は勝ったときだけ効果が出る。即時発動系は使えたかどうか
+                stats["effective"] += bool(ok) and (won or SP_CARDS_MASTER.get(card_id, {}).get(
+                    "effect_type") == "return_last_card")
+        if count % 100000 == 0:  # 放棄されたゲームを捨てる (進行中のゲームの数だけメモリを使う)
+            stale = [key for key, value in games.items() if t - value["last"] > stale_seconds]
+            for key in stale:
+                del games[key]
+            abandoned += len(stale)
+
+    finished = sum(results.values())
+    low, high = wilson_interval(results[1], finished, z)
+    return {
+        "events": count,
+        "games": finished,
+        "abandoned": abandoned + len(games),
+        "player": {"wins": results[1], "draws": results[0], "losses": results[-1],
+                   "win_rate": results[1] / finished if finished else 0.0, "low": low, "high": high},
+        "average_turns": turns_total / finished if finished else 0.0,
+        "average_seconds": seconds_total / finished if finished else 0.0,
+        "ai_actions": ai_actions,
+        "sp_cards": {key: dict(stats, win_rate=stats["wins"] / stats["used"],
+                               effect_rate=stats["effective"] / stats["used"])
+                     for key, stats in sorted(sp_cards.items())},
+        "confidence": confidence,
+    }
+
+
 # --- ゲーム設定 ---
 DECK = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]  # 1～11のカードが1枚ずつ
 BURST_LIMIT = 21
 INITIAL_POINTS = 10
+LOW_TOTAL_THRESHOLD = 8  # Qエージェントが無条件でヒットする合計の上限 (調整可能)
 
 
 # --- 勝敗が決まったときにどれだけポイントを増減させるかを決めるための定数
@@ -42,15 +794,50 @@ SP_CARDS_MASTER = {
 INITIAL_PLAYER_SP_CARD_ID = "sp_minus_3"
 
 
+# --- 乱数ストリーム ---
+# 学習・シミュレーション・ゲームの乱数は、グローバルな random ではなく引数で渡した生成器から引く。
+# 1つの seed から derive_seed で「経路」(用途、ワーカー番号、エピソード数など) ごとの子シードを作れば、
+# 互いに独立で、実行順やプロセス数に左右されずに再現できるストリームに分けられる。
+def derive_seed(seed, *path):
+    """seed と path から 64bit の子シードを作る (ハッシュするので隣り合う経路でも系列が重ならない)"""
+    key = repr((seed,) + path).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def rng_stream(seed, *path):
+    """derive_seed(seed, *path) で初期化した random.Random"""
+    return random.Random(derive_seed(seed, *path))
+
+
+# APIルート (山札のシャッフル、ガチャ) の乱数。GAME_SEED を設定すると、1プロセスで同じ順にリクエストを
+# 送れば同じゲームになる (テスト・デバッグ用)。fork したワーカーどうしで系列が重ならないように、
+# fork 後に pid を経路に加えて初期化し直す (グローバルな random と同じ)。
+GAME_SEED = os.environ.get("GAME_SEED")
+game_rng = random.Random(derive_seed(GAME_SEED, "game") if GAME_SEED is not None else None)
+
+
+def _reseed_game_rng():
+    game_rng.seed(derive_seed(GAME_SEED, "game", os.getpid()) if GAME_SEED is not None else None)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_game_rng)
+
+
+def _as_random_state(state):
+    """JSON に保存した random.Random の状態 (リスト) を setstate できるタプルに戻す"""
+    return state[0], tuple(state[1]), state[2]
+
+
 # --- ユーティリティ関数 ---
 def calculate_total(hand):
     """手札の合計値を単純に計算（各カードの数値をそのまま採用）"""
     return sum(hand)
 
-def shuffle_deck():
-    """デッキをシャッフルして返す"""
+def shuffle_deck(rng=random):
+    """デッキをシャッフルして返す (rng: 使う乱数生成器。省略時はグローバルな random)"""
     deck = DECK[:]
-    random.shuffle(deck)
+    rng.shuffle(deck)
     return deck
 
 def compute_intermediate_reward(prev_total, new_total):
@@ -203,6 +990,8 @@ def _finalize_round():
         final_message += "\nAIのポイントが0になりました。あなたの完全勝利！"
 
     session["turn"] = "end" # ゲーム終了状態にする
+    log_game_event("end", r=result, pt=player_total, at=ai_total, pp=player_points, ap=ai_points,
+                   dp=declared_card_player, da=declared_card_ai)
     return final_message
 
 
@@ -215,14 +1004,15 @@ def calculate_expected_value(hand, deck):
     n = len(deck)
     if n == 0:
         return None, None
-    total_sum = 0
+    # 引いた後の合計は「手札の合計 + カード」なので、手札の合計は1回だけ計算する
+    hand_total = calculate_total(hand)
+    deck_sum = 0
     burst_count = 0
     for card in deck:
-        new_total = calculate_total(hand + [card])
-        total_sum += new_total
-        if new_total > BURST_LIMIT:
+        deck_sum += card
+        if hand_total + card > BURST_LIMIT:
             burst_count += 1
-    expected_value = total_sum / n
+    expected_value = (n * hand_total + deck_sum) / n
     burst_probability = burst_count / n
     return expected_value, burst_probability
 
@@ -233,7 +1023,8 @@ def calculate_burst_probability(hand, deck):
     n = len(deck)
     if n == 0:
         return 0.0
-    burst_count = sum(1 for card in deck if calculate_total(hand + [card]) > BURST_LIMIT)
+    limit = BURST_LIMIT - calculate_total(hand)
+    burst_count = sum(1 for card in deck if card > limit)
     return burst_count / n
 
 def compute_risk_tolerance(ai_total, opponent_total, deck):
@@ -255,37 +1046,366 @@ def should_ai_draw(ai_hand, opponent_hand, deck):
     通常ターンでのAI判断ロジック：
       - 手札合計が12未満なら無条件ヒット
       - 期待値・バースト確率、リスク許容度に基づきヒット/スタンドを判断
+    判断は合計と山札だけで決まるので、事前計算テーブル (omega_should_draw) を引く。
     """
-    ai_total = calculate_total(ai_hand)
-    opponent_total = calculate_total(opponent_hand)
+    return omega_should_draw(calculate_total(ai_hand), calculate_total(opponent_hand), deck_to_mask(deck))
+
+def should_ai_draw_first_turn(ai_hand, opponent_hand, deck):
+    """
+    初手時のAI判断：
+      - 初手カードが6以下なら積極的にヒット
+      - それ以外は期待値に基づいて判断
+    """
+    return omega_should_draw_first_turn(ai_hand[0], calculate_total(ai_hand), deck_to_mask(deck))
+
+# --- OmegaAI の事前計算テーブル ---
+# 山札は 1～11 が1枚ずつなので、残りカードは 11bit のマスク (カード c は bit c-1) で表せる。
+# マスクごとの枚数・合計を事前に持っておくと、1枚引いたときの期待値は
+# 「手札の合計 + 山札の合計 / 枚数」、バースト枚数は「21 - 手札の合計 より大きいカードの枚数」
+# = MASK_COUNT[mask >> (21 - 手札の合計)] で O(1) に求まる。
+# should_ai_draw の結果は (AIの合計, 相手の合計, 山札マスク) だけで決まるので、
+# 初めて引いたときに OMEGA_DRAW_TABLE へ記録して以降は表を引くだけにする。
+MASK_CARDS = tuple(tuple(card for card in DECK if mask >> (card - 1) & 1) for mask in range(1 << len(DECK)))
+MASK_COUNT = bytes(len(cards) for cards in MASK_CARDS)
+MASK_SUM = tuple(sum(cards) for cards in MASK_CARDS)
+FULL_DECK_MASK = (1 << len(DECK)) - 1
+DECK_SUM = sum(DECK)
+
+# AIの合計は 22 以上、相手の合計は 23 以上で判断が変わらないので、そこで打ち切って索引にする
+OMEGA_TOTAL_SLOTS = BURST_LIMIT + 2     # AIの合計 0～21 と 22以上
+OMEGA_OPPONENT_SLOTS = BURST_LIMIT + 3  # 相手の合計 0～22 と 23以上
+OMEGA_UNKNOWN = 2                       # 表の未計算マーク (0: スタンド, 1: ヒット)
+OMEGA_DRAW_TABLE = bytearray([OMEGA_UNKNOWN]) * ((OMEGA_TOTAL_SLOTS * OMEGA_OPPONENT_SLOTS) << len(DECK))
+
+
+def mask_burst_count(hand_total, deck_mask):
+    """手札の合計が hand_total のとき、山札から引くとバーストするカードの枚数"""
+    return MASK_COUNT[deck_mask >> max(BURST_LIMIT - hand_total, 0)]
+
+
+def _omega_draw_rule(ai_total, opponent_total, deck_mask):
+    """should_ai_draw と同じ判断を山札マスクで行う (OMEGA_DRAW_TABLE の中身)"""
     if ai_total < 12:
         return True
-    expected_value, burst_probability = calculate_expected_value(ai_hand, deck)
-    if expected_value is None:
+    n = MASK_COUNT[deck_mask]
+    if n == 0:
         return False
-    risk_tolerance = compute_risk_tolerance(ai_total, opponent_total, deck)
+    burst_probability = mask_burst_count(ai_total, deck_mask) / n
+    risk_tolerance = compute_risk_tolerance(ai_total, opponent_total, MASK_CARDS[deck_mask])
     if ai_total < risk_tolerance and burst_probability < 0.30:
         return True
     if ai_total < opponent_total and burst_probability < 0.25:
         return True
     return False
 
-def should_ai_draw_first_turn(ai_hand, opponent_hand, deck):
+
+def omega_should_draw(ai_total, opponent_total, deck_mask):
+    """should_ai_draw の山札マスク版"""
+    i = ((min(ai_total, OMEGA_TOTAL_SLOTS - 1) * OMEGA_OPPONENT_SLOTS
+          + min(opponent_total, OMEGA_OPPONENT_SLOTS - 1)) << len(DECK)) | deck_mask
+    draws = OMEGA_DRAW_TABLE[i]
+    if draws == OMEGA_UNKNOWN:
+        draws = OMEGA_DRAW_TABLE[i] = _omega_draw_rule(ai_total, opponent_total, deck_mask)
+    return draws == 1
+
+
+def omega_should_draw_first_turn(first_card, ai_total, deck_mask):
+    """should_ai_draw_first_turn の山札マスク版"""
+    if first_card <= 6:
+        return True
+    n = MASK_COUNT[deck_mask]
+    return n > 0 and (n * ai_total + MASK_SUM[deck_mask]) / n < 17
+
+
+class DeckStats:
     """
-    初手時のAI判断：
-      - 初手カードが6以下なら積極的にヒット
-      - それ以外は期待値に基づいて判断
+    山札のマスク・枚数・合計を、カードを引く/戻すたびに差分更新する。
+    期待値、バースト確率、OmegaAI の判断を山札のリストを走査せずに返す。
     """
-    if ai_hand[0] <= 6:
-        return True
-    else:
-        expected_value, _ = calculate_expected_value(ai_hand, deck)
-        return True if (expected_value is not None and expected_value < 17) else False
+    __slots__ = ("mask", "count", "total")
+
+    def __init__(self, deck=()):
+        self.mask = deck_to_mask(deck)
+        self.count = MASK_COUNT[self.mask]
+        self.total = MASK_SUM[self.mask]
+
+    def remove(self, card):
+        """山札からカードが引かれた"""
+        self.mask &= ~(1 << (card - 1))
+        self.count -= 1
+        self.total -= card
+
+    def add(self, card):
+        """山札にカードが戻された (SPカード「手札戻し」など)"""
+        self.mask |= 1 << (card - 1)
+        self.count += 1
+        self.total += card
+
+    def expected_value(self, hand_total):
+        """1枚引いた後の合計の期待値 (山札が空なら None)"""
+        if self.count == 0:
+            return None
+        return (self.count * hand_total + self.total) / self.count
+
+    def burst_probability(self, hand_total):
+        """1枚引いたときのバースト確率"""
+        if self.count == 0:
+            return 0.0
+        return mask_burst_count(hand_total, self.mask) / self.count
+
+    def should_draw(self, ai_total, opponent_total):
+        """OmegaAI の通常ターンの判断 (should_ai_draw)"""
+        return omega_should_draw(ai_total, opponent_total, self.mask)
+
+    def should_draw_first_turn(self, first_card, ai_total):
+        """OmegaAI の初手の判断 (should_ai_draw_first_turn)"""
+        return omega_should_draw_first_turn(first_card, ai_total, self.mask)
+
+
+class BitDeck(DeckStats):
+    """
+    11bit のマスクだけで表す山札 (カードの並び順は持たない)。引くときに残りのカードから一様に選ぶので、
+    シャッフルした山札の末尾から引くのと同じ分布になる。引く・戻す・枚数・状態キーがすべて O(1)。
+    DeckStats の期待値やバースト確率、OmegaAI の判断もそのまま使える。セッションには mask だけを保存する。
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_mask(cls, mask):
+        deck = cls.__new__(cls)
+        deck.mask = mask
+        deck.count = MASK_COUNT[mask]
+        deck.total = MASK_SUM[mask]
+        return deck
+
+    @classmethod
+    def full(cls):
+        """1～11 が揃った山札"""
+        return cls.from_mask(FULL_DECK_MASK)
+
+    @classmethod
+    def coerce(cls, value):
+        """セッションの山札 (マスクの整数、または以前の形式のカードのリスト) を BitDeck にする"""
+        if isinstance(value, int):
+            return cls.from_mask(value)
+        return cls(value or ())
+
+    def draw(self, rng=random):
+        """残りのカードから1枚を一様に選んで引く (山札が空なら IndexError)"""
+        count = self.count
+        if not count:
+            raise IndexError("山札が空です")
+        card = MASK_CARDS[self.mask][int(rng.random() * count)]
+        self.mask ^= 1 << (card - 1)  # remove() と同じ (学習のホットパスなので展開している)
+        self.count = count - 1
+        self.total -= card
+        return card
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(MASK_CARDS[self.mask])
+
+    def __contains__(self, card):
+        return bool(self.mask >> (card - 1) & 1)
+
+    def __repr__(self):
+        return f"BitDeck({list(self)})"
+
+
+# --- コンパクトQテーブル部 (整数インデックス + フラット配列) ---
+# 山札は 1～11 が1枚ずつなので、残りカードは 11bit のマスクで表せる。
+# 状態 (合計, 相手のオープンカード, 山札マスク) を1つの整数にまとめ、
+# Q値は array('d') に hit/stand の順で並べて格納する。
+Q_DECK_BITS = len(DECK)                 # 山札マスクのビット数 (カード c は bit c-1)
+Q_TOTAL_SLOTS = BURST_LIMIT + 2         # 合計 0～21 と、22以上をまとめたバースト枠
+Q_OPPONENT_SLOTS = max(DECK) + 1        # 相手のオープンカード 0 (不明) ～ 11
+Q_NUM_STATES = (Q_TOTAL_SLOTS * Q_OPPONENT_SLOTS) << Q_DECK_BITS
+Q_ACTIONS = ("hit", "stand")            # values[2*i] が hit, values[2*i+1] が stand
+
+# --- バイナリQテーブルファイル (.qtb) ---
+# ヘッダー、状態インデックス (seen: 状態ごとに1バイト)、Q値 (float64 を hit/stand の順) を
+# ページ境界に揃えて並べる。mmap した領域をそのまま CompactQTable の配列として使えるので、
+# 読み込みは一瞬で、同じファイルを読み込んだプロセス同士は物理ページを共有する。
+QTB_MAGIC = b"QTBL"
+QTB_VERSION = 1
+QTB_HEADER = struct.Struct("<4sIQIIIQQQ")  # magic, version, 状態数, 合計枠, 相手カード枠, マスクbit数, 登録数, seen位置, values位置
+QTB_ALIGN = 4096
+
+
+def deck_to_mask(deck):
+    """山札 (カードのリスト、または DeckStats / BitDeck) を 11bit のマスクに変換する"""
+    if isinstance(deck, DeckStats):
+        return deck.mask
+    mask = 0
+    for card in deck:
+        mask |= 1 << (card - 1)
+    return mask
+
+
+class CompactQTable:
+    """
+    配列ベースのQテーブル。
+     - 状態は CompactQTable.index() で作る整数
+     - values: 状態ごとに [hit, stand] のQ値を並べた array('d')
+     - seen: 状態が登録済みか (従来の dict にキーが存在するか) を表す bytearray
+    未登録の状態のQ値は常に 0.0 なので、従来の「未登録なら0」と同じ結果になる。
+    JSON との相互変換は従来と同じ文字列キー ("17_5_1_0_1_...") で行う。
+    """
+    __slots__ = ("values", "seen", "visits", "_count", "_mmap")
+
+    def __init__(self, values=None, seen=None, count=None):
+        # values / seen は array('d') と bytearray のほか、mmap 上の memoryview でもよい
+        self.values = values if values is not None else array('d', bytes(16 * Q_NUM_STATES))
+        self.seen = seen if seen is not None else bytearray(Q_NUM_STATES)
+        self.visits = None  # 並列学習時のみ (状態, 行動) ごとの更新回数を数える array('I')
+        self._mmap = None   # load_binary で mmap した場合のみ
+        if count is None:
+            self.recount()
+        else:
+            self._count = count
+
+    @staticmethod
+    def index(player_total, opponent_card, deck_mask):
+        """状態を整数インデックスに変換する (22以上の合計はバースト枠にまとめる)"""
+        if player_total > BURST_LIMIT:
+            player_total = BURST_LIMIT + 1
+        return ((player_total * Q_OPPONENT_SLOTS + opponent_card) << Q_DECK_BITS) | deck_mask
+
+    @staticmethod
+    def unpack(state):
+        """整数インデックスを (合計, 相手のオープンカード, 山札マスク) に戻す"""
+        deck_mask = state & ((1 << Q_DECK_BITS) - 1)
+        player_total, opponent_card = divmod(state >> Q_DECK_BITS, Q_OPPONENT_SLOTS)
+        return player_total, opponent_card, deck_mask
+
+    @staticmethod
+    def state_key(state):
+        """整数インデックスを従来の文字列キーに変換する"""
+        player_total, opponent_card, deck_mask = CompactQTable.unpack(state)
+        deck_info = "_".join(str((deck_mask >> i) & 1) for i in range(Q_DECK_BITS))
+        return f"{player_total}_{opponent_card}_{deck_info}"
+
+    @staticmethod
+    def parse_key(key):
+        """従来の文字列キーを整数インデックスに変換する"""
+        parts = key.split("_")
+        deck_mask = 0
+        for i, count in enumerate(parts[2:2 + Q_DECK_BITS]):
+            if int(count) > 0:
+                deck_mask |= 1 << i
+        return CompactQTable.index(int(parts[0]), int(parts[1]), deck_mask)
+
+    def touch(self, state):
+        """状態を登録済みにする (従来の「未学習なら {hit: 0, stand: 0} で初期化」に相当)"""
+        if not self.seen[state]:
+            self.seen[state] = 1
+            self._count += 1
+
+    def recount(self):
+        """seen を直接書き換えた後 (バッチ学習など) に登録数を数え直す"""
+        self._count = Q_NUM_STATES - bytes(self.seen).count(0)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, state):
+        if isinstance(state, str):
+            state = self.parse_key(state)
+        return bool(self.seen[state])
+
+    def __getitem__(self, state):
+        if isinstance(state, str):
+            state = self.parse_key(state)
+        if not self.seen[state]:
+            raise KeyError(state)
+        i = state << 1
+        return {"hit": self.values[i], "stand": self.values[i + 1]}
+
+    def states(self):
+        """登録済みの状態インデックスを順に返す"""
+        seen = self.seen if isinstance(self.seen, bytearray) else bytes(self.seen)
+        state = seen.find(1)
+        while state != -1:
+            yield state
+            state = seen.find(1, state + 1)
+
+    def items(self):
+        """従来の dict と同じ (文字列キー, {"hit": q, "stand": q}) を順に返す"""
+        values = self.values
+        for state in self.states():
+            i = state << 1
+            yield self.state_key(state), {"hit": values[i], "stand": values[i + 1]}
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def save_binary(self, filename):
+        """バイナリ形式 (.qtb) で保存する。一時ファイルに書いてから置き換えるので、読み込み中のプロセスに影響しない"""
+        seen_offset = QTB_ALIGN
+        values_offset = -(-(seen_offset + Q_NUM_STATES) // QTB_ALIGN) * QTB_ALIGN
+        header = QTB_HEADER.pack(QTB_MAGIC, QTB_VERSION, Q_NUM_STATES, Q_TOTAL_SLOTS, Q_OPPONENT_SLOTS,
+                                 Q_DECK_BITS, len(self), seen_offset, values_offset)
+        tmp_filename = f"{filename}.tmp{os.getpid()}"
+        with open(tmp_filename, 'wb') as f:
+            f.write(header.ljust(seen_offset, b"\0"))
+            f.write(self.seen)
+            f.write(bytes(values_offset - seen_offset - Q_NUM_STATES))
+            f.write(memoryview(self.values).cast('B'))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load_binary(cls, filename, writable=False):
+        """
+        バイナリ形式 (.qtb) を mmap して読み込む。
+         - writable=False: 読み取り専用 (書き込もうとすると TypeError)
+         - writable=True: コピーオンライト。書き込んだページだけがこのプロセス専用になる
+        """
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY if writable else mmap.ACCESS_READ)
+        if len(mapped) < QTB_HEADER.size:
+            raise ValueError(f"{filename} はQテーブルのバイナリファイルではありません")
+        (magic, version, num_states, total_slots, opponent_slots, deck_bits,
+         count, seen_offset, values_offset) = QTB_HEADER.unpack_from(mapped)
+        if magic != QTB_MAGIC or version != QTB_VERSION:
+            raise ValueError(f"{filename} はQテーブルのバイナリファイルではありません")
+        if (num_states, total_slots, opponent_slots, deck_bits) != (Q_NUM_STATES, Q_TOTAL_SLOTS, Q_OPPONENT_SLOTS, Q_DECK_BITS):
+            raise ValueError(f"{filename} の状態レイアウトが現在のゲーム設定と一致しません")
+        if len(mapped) < max(seen_offset + Q_NUM_STATES, values_offset + 16 * Q_NUM_STATES):
+            raise ValueError(f"{filename} は途中で切れています")
+        view = memoryview(mapped)
+        table = cls(view[values_offset:values_offset + 16 * Q_NUM_STATES].cast('d'),
+                    view[seen_offset:seen_offset + Q_NUM_STATES], count=count)
+        table._mmap = mapped
+        return table
+
+    @staticmethod
+    def is_binary_file(filename):
+        """ファイルがバイナリ形式 (.qtb) かどうかを先頭のマジックで判定する"""
+        with open(filename, 'rb') as f:
+            return f.read(len(QTB_MAGIC)) == QTB_MAGIC
+
+    @classmethod
+    def from_dict(cls, data):
+        """従来形式の dict (JSON) から作成する"""
+        table = cls()
+        values = table.values
+        for key, q_values in data.items():
+            state = cls.parse_key(key)
+            table.touch(state)
+            i = state << 1
+            values[i] = float(q_values.get("hit", 0.0))
+            values[i + 1] = float(q_values.get("stand", 0.0))
+        return table
+
 
 # --- Q学習エージェント部 (0302改良版) ---
 class QLearningAgent:
-    def __init__(self, alpha=0.1, gamma=0.9, epsilon=0.3, epsilon_decay=0.99999, min_epsilon=0.01, reward_scale=1.0, min_epsilon_for_play=0.0):
-        self.q_table = {}
+    def __init__(self, alpha=0.1, gamma=0.9, epsilon=0.3, epsilon_decay=0.99999, min_epsilon=0.01, reward_scale=1.0, min_epsilon_for_play=0.0, storage="compact"):
+        # storage: "compact" は CompactQTable (整数の状態キー)、"dict" は従来の文字列キーの dict
+        self.storage = storage
+        self.q_table = CompactQTable() if storage == "compact" else {}
         self.alpha = alpha              # 学習率
         self.gamma = gamma              # 割引率
         self.epsilon = epsilon          # 初期探索率
@@ -300,18 +1420,27 @@ class QLearningAgent:
          - プレイヤーの合計
          - 相手のオープンカード
          - 残りカード (1～11) の各枚数を '_' で連結した文字列
+        storage="compact" の場合は同じ情報を CompactQTable.index() の整数で返す。
+        deck は山札のリストか DeckStats (学習中はマスクを作り直さずに済む)。
         """
+        if isinstance(deck, DeckStats):
+            if self.storage == "compact":
+                return CompactQTable.index(player_total, opponent_card, deck.mask)
+            deck = MASK_CARDS[deck.mask]
+        if self.storage == "compact":
+            return CompactQTable.index(player_total, opponent_card, deck_to_mask(deck))
         deck_counts = [str(deck.count(i)) for i in range(1, 12)]
         deck_info = "_".join(deck_counts)
         return f"{player_total}_{opponent_card}_{deck_info}"
 
-    def choose_action(self, state, current_total, is_training=True):
+    def choose_action(self, state, current_total, is_training=True, rng=random):
         """
         ε-greedy によるアクション選択：
          - 未学習状態の場合、初期化後ランダム選択（"hit" と "stand" のどちらか）
          - εの確率でランダムに行動を選択し、それ以外はQ値最大の行動を返す
          - current_total: 現在の手札の合計値
          - is_training: 学習モードであればTrue、プレイモードであればFalse
+         - rng: 探索に使う乱数生成器 (省略時はグローバルな random)
         """
         # --- バースト防止追加 ---
         if current_total == BURST_LIMIT: # 既に21の場合
@@ -322,12 +1451,14 @@ class QLearningAgent:
         # --- ここまで ---
 
         # 合計が8以下の場合はほぼ無条件でヒットさせる
-        LOW_TOTAL_THRESHOLD = 8 # この閾値は調整可能
         if current_total <= LOW_TOTAL_THRESHOLD:
             return "hit" 
         
         # 状態が未学習の場合、Qテーブルに初期化
-        if state not in self.q_table:
+        compact = self.storage == "compact"
+        if compact:
+            self.q_table.touch(state)
+        elif state not in self.q_table:
             self.q_table[state] = {"hit": 0.0, "stand": 0.0}
         
         # 使用するepsilonを決定
@@ -338,8 +1469,13 @@ class QLearningAgent:
             current_epsilon_to_use = self.min_epsilon_for_play # プレイ中は固定の最小値を使用
 
         # ε-greedy の探索部分でも、21ならスタンドを優先する (より安全に)
-        if random.uniform(0, 1) < current_epsilon_to_use:
-            return random.choice(["hit", "stand"])
+        if rng.uniform(0, 1) < current_epsilon_to_use:
+            return rng.choice(["hit", "stand"])
+        elif compact:
+            # Q値が最大の行動を選択 (同値なら従来の max と同じく hit)
+            values = self.q_table.values
+            i = state << 1
+            return "stand" if values[i + 1] > values[i] else "hit"
         else:
             # Q値が最大の行動を選択
             return max(self.q_table[state], key=self.q_table[state].get)
@@ -353,6 +1489,20 @@ class QLearningAgent:
          - 次状態の最大Q値を利用して更新（終端状態の場合 next_state は None）
         """
         reward *= self.reward_scale
+        if self.storage == "compact":
+            # 未登録の状態のQ値は 0.0 なので、next_state の登録有無を見なくても従来と同じ値になる
+            table = self.q_table
+            table.touch(state)
+            values = table.values
+            i = (state << 1) + (action == "stand")
+            next_max = 0
+            if next_state is not None:
+                j = next_state << 1
+                next_max = max(values[j], values[j + 1])
+            values[i] += self.alpha * (reward + self.gamma * next_max - values[i])
+            if table.visits is not None:
+                table.visits[i] += 1
+            return
         if state not in self.q_table:
             self.q_table[state] = {"hit": 0.0, "stand": 0.0}
         next_max = 0
@@ -367,30 +1517,134 @@ class QLearningAgent:
         self.epsilon = max(self.min_epsilon, self.epsilon * self.epsilon_decay)
 
     def save(self, filename="q_table.json"):
-        with open(filename, 'w') as f:
-            json.dump(self.q_table, f, indent=4)
-
-    def load(self, filename="q_table.json"):
+        """
+        Qテーブルを保存する。拡張子が .qtb ならバイナリ形式、それ以外は従来の JSON。
+        どちらも一時ファイルに書いてから置き換える。
+        """
+        if filename.endswith(".qtb"):
+            table = self.q_table if self.storage == "compact" else CompactQTable.from_dict(self.q_table)
+            table.save_binary(filename)
+            return
+        q_table = self.q_table.to_dict() if self.storage == "compact" else self.q_table
+        tmp_filename = f"{filename}.tmp{os.getpid()}"
+        with open(tmp_filename, 'w') as f:
+            json.dump(q_table, f, indent=4)
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename="q_table.json", read_only=False):
+        """
+        Qテーブルを読み込む (バイナリ形式か JSON かはファイルの先頭で判定)。
+        バイナリ形式は mmap する。read_only=True なら読み取り専用、それ以外はコピーオンライト。
+        読み込めたら True、ファイルがない・壊れている場合は False を返す。
+        """
         try:
-            with open(filename, 'r') as f:
-                self.q_table = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            if CompactQTable.is_binary_file(filename):
+                table = CompactQTable.load_binary(filename, writable=not read_only)
+                self.q_table = table if self.storage == "compact" else table.to_dict()
+            else:
+                with open(filename, 'r') as f:
+                    q_table = json.load(f)
+                self.q_table = CompactQTable.from_dict(q_table) if self.storage == "compact" else q_table
+            return True
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
             print("Qテーブルファイルが見つからないか、空または壊れています。")
+            return False
+
+
+def convert_q_table(src, dst):
+    """Qテーブルファイルを変換する (JSON ⇔ バイナリ形式 .qtb。形式は拡張子と先頭から判定)"""
+    converter = QLearningAgent()
+    if not converter.load(src, read_only=True):
+        raise ValueError(f"{src} を読み込めませんでした")
+    converter.save(dst)
+    return len(converter.q_table)
+
+
+# --- 配信用の固定方策 (プレイモード専用。Qテーブルを一切書き換えない) ---
+# Qテーブルから状態ごとの greedy 行動を1バイトにまとめた不変の表を作る。
+#   bit0: 行動 (0: hit, 1: stand)
+#   bit1: 未学習の状態で、フォールバックの行動を使ったことを表すフラグ
+# 合計 LOW_TOTAL_THRESHOLD 以下のヒット、21以上のスタンドも表に焼き込むので、
+# 判断は「状態インデックスの計算 + 1回の参照」だけになる。
+POLICY_FALLBACK_FLAG = 2
+
+
+class FrozenPolicy:
+    """
+    不変の greedy 方策。choose_action(..., is_training=False) と同じ行動を返すが、
+    Qテーブルへの登録や探索 (min_epsilon_for_play) は行わない。
+    未学習の状態では fallback_action を返す (既定の "hit" は従来の「Q値が同値なら hit」と同じ)。
+    """
+    __slots__ = ("codes", "fallback_action")
+
+    def __init__(self, codes, fallback_action="hit"):
+        self.codes = codes
+        self.fallback_action = fallback_action
+
+    @classmethod
+    def compile(cls, q_table, fallback_action="hit"):
+        """Qテーブル (CompactQTable または従来の dict) から方策を作る"""
+        if not isinstance(q_table, CompactQTable):
+            q_table = CompactQTable.from_dict(q_table)
+        codes = bytearray([POLICY_FALLBACK_FLAG | Q_ACTIONS.index(fallback_action)]) * Q_NUM_STATES
+        values = q_table.values
+        for state in q_table.states():
+            i = state << 1
+            codes[state] = 1 if values[i + 1] > values[i] else 0
+        # 合計ごとの状態は連続した範囲なので、固定ルールはスライスでまとめて書き込む
+        states_per_total = Q_OPPONENT_SLOTS << Q_DECK_BITS
+        codes[:(LOW_TOTAL_THRESHOLD + 1) * states_per_total] = bytes((LOW_TOTAL_THRESHOLD + 1) * states_per_total)
+        codes[BURST_LIMIT * states_per_total:] = b"\x01" * ((Q_TOTAL_SLOTS - BURST_LIMIT) * states_per_total)
+        return cls(bytes(codes), fallback_action)
+
+    def code(self, player_total, opponent_card, deck):
+        """状態の行動コード (bit0: 行動, bit1: フォールバック) を返す"""
+        return self.codes[CompactQTable.index(player_total, opponent_card, deck_to_mask(deck))]
+
+    def decide(self, player_total, opponent_card, deck):
+        """"hit" か "stand" を返す"""
+        return Q_ACTIONS[self.code(player_total, opponent_card, deck) & 1]
+
+
+# --- 学習の進捗通知 ---
+# 各学習関数は progress(終了エピソード数, ε, 勝敗集計) を定期的に呼ぶ。
+# 勝敗集計は {"agent1_win", "agent2_win", "draw"} の回数 (Phase1 では agent1 が Q学習、agent2 が OmegaAI)。
+# progress が TrainingCancelled を送出すると、学習はその場で中断される。
+PROGRESS_INTERVAL = 500  # 逐次版の学習関数が progress を呼ぶ間隔 (エピソード)
+
+
+class TrainingCancelled(Exception):
+    """学習の中断要求"""
+
+
+OUTCOME_KEYS = {1: "agent1_win", -1: "agent2_win", 0: "draw"}  # judge の結果 → 勝敗集計のキー
 
 
 # --- 学習モード Phase1: OmegaAI vs Q学習 ---
-def train_phase1(agent, episodes=500000):
+def train_phase1(agent, episodes=500000, save_path="q_table.json", log_every=500, progress=None,
+                 start_episode=0, results=None, rng=None):
+    """
+    OmegaAI と対戦しながら agent を学習させ、勝敗集計を返す。
+     - save_path: 学習後の保存先 (None なら保存しない)
+     - log_every: 進捗表示の間隔 (0 なら表示しない)
+     - progress: PROGRESS_INTERVAL エピソードごとに progress(終了エピソード数, ε, 勝敗集計) を呼ぶ。
+       TrainingCancelled を送出すると保存せずに中断する
+     - start_episode, results: チェックポイントから再開するときの開始エピソードと勝敗集計の途中経過
+     - rng: 探索と山札に使う乱数生成器 (省略時はグローバルな random)
+    """
     max_iterations = 50  # 1ゲームあたりの最大ラウンド数
-    for episode in range(episodes):
-        deck = shuffle_deck()
+    rng = rng or random
+    results = dict(results) if results else {"agent1_win": 0, "agent2_win": 0, "draw": 0}
+    for episode in range(start_episode, episodes):
+        deck = BitDeck.full()  # OmegaAI の判断や状態キーもこの山札のマスクから O(1) で求める
         
         # 初期カード配布
         # 最低2枚のカードがデッキにあることを保証 (q_hand, opponent_hand に1枚ずつ)
         if len(deck) < 2:
             print(f"エピソード {episode + 1} スキップ: デッキのカードが不足しています。")
             continue
-        q_hand = [deck.pop()]
-        opponent_hand = [deck.pop()]
+        q_hand = [deck.draw(rng)]
+        opponent_hand = [deck.draw(rng)]
         
         q_agent_stand_count = 0  # Qエージェントの連続スタンド回数
         omega_ai_stand_count = 0 # OmegaAIの連続スタンド回数
@@ -414,7 +1668,7 @@ def train_phase1(agent, episodes=500000):
             opponent_up_card = opponent_hand[0] if opponent_hand else 0 # 相手の手札がなければ0など安全な値を設定
 
             current_q_agent_state = agent.get_state(q_total_before_action, opponent_up_card, deck)
-            q_agent_action = agent.choose_action(current_q_agent_state, q_total_before_action) # is_training=True はデフォルト
+            q_agent_action = agent.choose_action(current_q_agent_state, q_total_before_action, rng=rng) # is_training=True はデフォルト
 
             # Qエージェントの行動前の状態と行動を記録
             last_q_agent_state = current_q_agent_state
@@ -425,7 +1679,7 @@ def train_phase1(agent, episodes=500000):
             if q_agent_action == "hit":
                 q_agent_stand_count = 0 
                 if deck:
-                    q_hand.append(deck.pop())
+                    q_hand.append(deck.draw(rng))
                     new_q_total = calculate_total(q_hand)
                     # compute_intermediate_reward の値を少し大きくする案
                     # reward_for_q_agent = compute_intermediate_reward(q_total_before_action, new_q_total) 
@@ -440,6 +1694,7 @@ def train_phase1(agent, episodes=500000):
                     if new_q_total > BURST_LIMIT:
                         reward_for_q_agent += -10 
                         agent.learn(last_q_agent_state, last_q_agent_action, reward_for_q_agent, None) 
+                        results["agent2_win"] += 1
                         game_terminated = True
                 else:
                     q_agent_action = "stand" 
@@ -469,19 +1724,20 @@ def train_phase1(agent, episodes=500000):
             omega_ai_total_before_action = calculate_total(opponent_hand)
             q_agent_current_total_for_omega = calculate_total(q_hand) # OmegaAIから見たQエージェントの合計
 
-            # OmegaAIの行動決定 (should_ai_draw_first_turn と should_ai_draw を使用)
+            # OmegaAIの行動決定 (should_ai_draw_first_turn / should_ai_draw と同じ判断を事前計算テーブルで行う)
             # opponent_hand が空でないことを確認
             omega_ai_action = "stand" # デフォルト
             if opponent_hand:
                 if iteration == 1: # 初手かどうかは iteration で判断
-                    omega_ai_action = "hit" if should_ai_draw_first_turn(opponent_hand, q_hand, deck) else "stand"
+                    omega_draws = deck.should_draw_first_turn(opponent_hand[0], omega_ai_total_before_action)
                 else:
-                    omega_ai_action = "hit" if should_ai_draw(opponent_hand, q_hand, deck) else "stand"
+                    omega_draws = deck.should_draw(omega_ai_total_before_action, q_agent_current_total_for_omega)
+                omega_ai_action = "hit" if omega_draws else "stand"
             
             if omega_ai_action == "hit":
                 omega_ai_stand_count = 0 # ヒットしたらスタンドカウントリセット
                 if deck:
-                    opponent_hand.append(deck.pop())
+                    opponent_hand.append(deck.draw(rng))
                     new_omega_ai_total = calculate_total(opponent_hand)
                     if new_omega_ai_total > BURST_LIMIT:
                         # OmegaAIがバースト。Qエージェントに大きな正の報酬。
@@ -489,6 +1745,7 @@ def train_phase1(agent, episodes=500000):
                         final_reward_for_q_burst_opponent = 10 + (BURST_LIMIT - q_agent_current_total_for_omega if q_agent_current_total_for_omega <= BURST_LIMIT else 0)
                         reward_for_q_agent += final_reward_for_q_burst_opponent # ここまでの報酬に加算
                         agent.learn(last_q_agent_state, last_q_agent_action, reward_for_q_agent, None) # 終端状態
+                        results["agent1_win"] += 1
                         game_terminated = True
                         # print(f"Debug E{episode+1}-I{iteration}: OmegaAI burst. R_Q={reward_for_q_agent}")
                 else:
@@ -518,6 +1775,7 @@ def train_phase1(agent, episodes=500000):
                 final_reward_val = compute_final_reward(calculate_total(q_hand), calculate_total(opponent_hand))
                 reward_for_q_agent += final_reward_val # ここまでの報酬に加算
                 agent.learn(last_q_agent_state, last_q_agent_action, reward_for_q_agent, None) # 終端状態
+                results[OUTCOME_KEYS[judge(calculate_total(q_hand), calculate_total(opponent_hand))]] += 1
                 game_terminated = True
                 # print(f"Debug E{episode+1}-I{iteration}: Stand決着. R_Q={reward_for_q_agent}")
                 agent.decay_epsilon() # エピソード終了
@@ -541,34 +1799,45 @@ def train_phase1(agent, episodes=500000):
             final_reward_val = compute_final_reward(calculate_total(q_hand), calculate_total(opponent_hand))
             reward_for_q_agent += final_reward_val
             agent.learn(last_q_agent_state, last_q_agent_action, reward_for_q_agent, None) # 終端状態として学習
+            results[OUTCOME_KEYS[judge(calculate_total(q_hand), calculate_total(opponent_hand))]] += 1
             game_terminated = True # 明示的に終了
             # print(f"Debug E{episode+1}-I{iteration}: Max iteration. R_Q={reward_for_q_agent}")
             agent.decay_epsilon() # エピソード終了
 
-        if (episode + 1) % 500 == 0:
+        if log_every and (episode + 1) % log_every == 0:
             print(f"Phase1: {episode + 1}/{episodes} エピソード終了, ε: {agent.epsilon:.4f}")
+        if progress is not None and (episode + 1) % PROGRESS_INTERVAL == 0:
+            progress(episode + 1, agent.epsilon, results)
             
-    agent.save("q_table.json")
+    if save_path:
+        agent.save(save_path)
+    return results
 
 
 # --- 学習モード Phase2: Q学習 vs Q学習 ---
-def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しました
+def simulate_q_vs_q(agent, episodes=2000000, log_every=500, progress=None, start_episode=0,
+                    results=None, rng=None): # episodesは元の値に戻しました
+    """
+    progress, start_episode, rng は train_phase1 と同じ (progress の第3引数に勝敗の集計を渡す)
+    results: 再開するときの勝敗集計の途中経過
+    """
     max_iterations = 50
-    results = {"agent1_win": 0, "agent2_win": 0, "draw": 0}
+    rng = rng or random
+    results = dict(results) if results else {"agent1_win": 0, "agent2_win": 0, "draw": 0}
 
     # 自己対戦では、同じエージェントインスタンス（同じQテーブル）を使って
     # Agent1とAgent2の役割を交互に演じさせることが一般的。
     # ここでは agent をそのまま使用します。
 
-    for episode_num in range(episodes):
-        deck = shuffle_deck()
+    for episode_num in range(start_episode, episodes):
+        deck = BitDeck.full()
 
         if len(deck) < 4: # 初期手札に最低4枚必要
             # print(f"エピソード {episode_num + 1} スキップ: デッキのカードが不足しています。")
             continue
         
-        agent1_hand = [deck.pop(), deck.pop()]
-        agent2_hand = [deck.pop(), deck.pop()]
+        agent1_hand = [deck.draw(rng), deck.draw(rng)]
+        agent2_hand = [deck.draw(rng), deck.draw(rng)]
         
         stand_count1 = 0
         stand_count2 = 0
@@ -588,7 +1857,7 @@ def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しま
                 total1_before_action = calculate_total(agent1_hand)
                 opponent_card_for_a1 = agent2_hand[0] if agent2_hand else 0
                 state1 = agent.get_state(total1_before_action, opponent_card_for_a1, deck)
-                action1 = agent.choose_action(state1, total1_before_action)
+                action1 = agent.choose_action(state1, total1_before_action, rng=rng)
 
                 last_state1, last_action1 = state1, action1 # 記録
                 reward1 = 0
@@ -596,7 +1865,7 @@ def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しま
                 if action1 == "hit":
                     stand_count1 = 0
                     if deck:
-                        agent1_hand.append(deck.pop())
+                        agent1_hand.append(deck.draw(rng))
                         new_total1 = calculate_total(agent1_hand)
                         reward1 = compute_intermediate_reward(total1_before_action, new_total1)
                         if new_total1 > BURST_LIMIT:
@@ -628,7 +1897,7 @@ def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しま
                 total2_before_action = calculate_total(agent2_hand)
                 opponent_card_for_a2 = agent1_hand[0] if agent1_hand else 0
                 state2 = agent.get_state(total2_before_action, opponent_card_for_a2, deck)
-                action2 = agent.choose_action(state2, total2_before_action)
+                action2 = agent.choose_action(state2, total2_before_action, rng=rng)
 
                 last_state2, last_action2 = state2, action2 # 記録
                 reward2 = 0
@@ -636,7 +1905,7 @@ def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しま
                 if action2 == "hit":
                     stand_count2 = 0
                     if deck:
-                        agent2_hand.append(deck.pop())
+                        agent2_hand.append(deck.draw(rng))
                         new_total2 = calculate_total(agent2_hand)
                         reward2 = compute_intermediate_reward(total2_before_action, new_total2)
                         if new_total2 > BURST_LIMIT:
@@ -719,41 +1988,1775 @@ def simulate_q_vs_q(agent, episodes=2000000): # episodesは元の値に戻しま
                 agent.learn(last_state2, last_action2, reward_agent2_final, None) # 終端なのでnext_stateはNone
 
         agent.decay_epsilon()
-        if (episode_num + 1) % 500 == 0:
+        if log_every and (episode_num + 1) % log_every == 0:
             print(f"Phase2: {episode_num + 1}/{episodes} エピソード終了, ε: {agent.epsilon:.4f}, "
                   f"A1勝: {results['agent1_win']}, A2勝: {results['agent2_win']}, 引分: {results['draw']}")
+        if progress is not None and (episode_num + 1) % PROGRESS_INTERVAL == 0:
+            progress(episode_num + 1, agent.epsilon, results)
 
     return results
 
-# --- Q学習エージェントの初期化と読み込み ---
-agent = QLearningAgent()
-q_table_loaded = False # Qテーブルが正常に読み込まれたかのフラグ
+# --- 学習モード Phase2 (バッチ版): NumPy で多数のエピソードを同時に進める ---
+# simulate_q_vs_q と同じルール (初期手札2枚ずつ、バースト即終了、どちらかが3回連続スタンドで
+# judge による勝敗判定) を、エピソードごとの配列 (山札マスク、合計、スタンド回数、終了フラグ) で
+# まとめて処理する。Q値の更新先は agent.q_table (CompactQTable) の配列そのもの。
+# 山札はバッチの最初にエピソードごとの並べ替え (rng.permuted) を一括で作り、先頭から順に引く。
+class _NpDecks:
+    """
+    バッチ内の各エピソードの山札。行ごとにシャッフル済みの並びの末尾に 0 (山札切れ) を付けて平らにした配列と、
+    各エピソードの次に引く位置 (平らな配列の添字) を持つ
+    """
+    card_bit = None
+
+    def __init__(self, n, rng):
+        width = len(DECK) + 1
+        cards = np.zeros((n, width), dtype=np.int64)
+        cards[:, :len(DECK)] = rng.permuted(np.tile(np.array(DECK, dtype=np.int64), (n, 1)), axis=1)
+        self.cards = cards.ravel()
+        self.position = np.arange(n, dtype=np.int64) * width
+        if _NpDecks.card_bit is None:
+            _NpDecks.card_bit = np.array([0] + [1 << (card - 1) for card in range(1, max(DECK) + 1)], dtype=np.int64)
+
+    def draw(self, mask, drawing):
+        """drawing が True のエピソードで1枚ずつ引く。引けなければカードは 0"""
+        card = np.where(drawing, self.cards[self.position], 0)
+        self.position += card > 0
+        return card, mask ^ self.card_bit[card]
+
+
+def _np_state_index(totals, opponent_cards, mask):
+    """CompactQTable.index() の配列版"""
+    totals = np.minimum(totals, BURST_LIMIT + 1)
+    return ((totals * Q_OPPONENT_SLOTS + opponent_cards) << Q_DECK_BITS) | mask
+
+
+def _np_choose_action(agent, values, seen, states, totals, active, rng):
+    """choose_action の配列版。戻り値は 0: hit, 1: stand"""
+    n = states.shape[0]
+    consult = active & (totals > LOW_TOTAL_THRESHOLD) & (totals < BURST_LIMIT)
+    seen[states[consult]] = 1
+    greedy = (values[states << 1 | 1] > values[states << 1]).astype(np.int64)
+    explore = rng.random(n) < agent.epsilon
+    actions = np.where(explore, rng.integers(0, 2, n), greedy)
+    actions = np.where(totals <= LOW_TOTAL_THRESHOLD, 0, actions)
+    return np.where(totals >= BURST_LIMIT, 1, actions)
+
+
+def _np_learn(agent, values, seen, states, actions, rewards, next_states, where):
+    """
+    learn の配列版。where が True のエピソードについて (states, actions) を更新する。
+    next_states が負なら終端 (next_state=None) として扱う。
+    同じ (状態, 行動) への k 件の更新は、目標値の平均 t に向けて
+    Q ← t + (1 - alpha)^k * (Q - t) とまとめて適用する (目標値が同じなら逐次更新と一致)。
+    """
+    idx = np.nonzero(where)[0]
+    if idx.size == 0:
+        return
+    s = states[idx]
+    next_s = next_states[idx]
+    has_next = next_s >= 0
+    j = np.where(has_next, next_s, 0) << 1
+    next_max = np.where(has_next, np.maximum(values[j], values[j + 1]), 0.0)
+    targets = rewards[idx] * agent.reward_scale + agent.gamma * next_max
+    entries, inverse, counts = np.unique((s << 1) + actions[idx], return_inverse=True, return_counts=True)
+    mean_targets = np.bincount(inverse, weights=targets) / counts
+    keep = (1.0 - agent.alpha) ** counts
+    values[entries] = mean_targets + keep * (values[entries] - mean_targets)
+    seen[s] = 1
+    if agent.q_table.visits is not None:
+        np.frombuffer(agent.q_table.visits, dtype=np.uint32)[entries] += counts.astype(np.uint32)
+
+
+def _np_judge(player_total, ai_total):
+    """judge の配列版 (1: player 勝利, -1: ai 勝利, 0: 引き分け)"""
+    player_is_burst = player_total > BURST_LIMIT
+    ai_is_burst = ai_total > BURST_LIMIT
+    player_distance = np.abs(player_total - BURST_LIMIT)
+    ai_distance = np.abs(ai_total - BURST_LIMIT)
+    result = np.where(player_distance < ai_distance, 1, np.where(ai_distance < player_distance, -1, 0))
+    result = np.where(player_is_burst & ~ai_is_burst, -1, result)
+    return np.where(~player_is_burst & ai_is_burst, 1, result)
 
-try:
-    # まず q_table2.json (Phase2の結果) を読み込もうと試みる
-    agent.load("q_table2.json")
-    print("INFO: q_table2.json を読み込みました。")
-    q_table_loaded = True
-except (FileNotFoundError, json.JSONDecodeError):
-    print("INFO: q_table2.json が見つからないか壊れています。q_table.json を試みます。")
+
+def simulate_q_vs_q_batch(agent, episodes=2000000, batch_size=4096, seed=None, log_every=500, progress=None,
+                          start_episode=0, results=None, rng=None):
+    """
+    simulate_q_vs_q のバッチ版。batch_size 個のエピソードを NumPy 配列で同時に進める。
+     - agent は storage="compact" であること
+     - ε はバッチ内で共通とし、バッチ終了時にエピソード数分まとめて減衰させる
+     - 戻り値は simulate_q_vs_q と同じ勝敗集計
+     - log_every: 0 以外ならバッチ終了ごとに進捗を表示する
+     - progress, start_episode, results: simulate_q_vs_q と同じ。progress はバッチ終了ごとに呼ぶ
+     - rng: 使う numpy の Generator (省略時は seed から作る。再開時は保存した状態を復元して渡す)
+    """
+    if np is None:
+        raise RuntimeError("バッチ学習には numpy が必要です (pip install numpy)")
+    if agent.storage != "compact":
+        raise ValueError("バッチ学習は storage='compact' の QLearningAgent のみ対応しています")
+
+    max_iterations = 50
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    values = np.frombuffer(agent.q_table.values, dtype=np.float64)
+    seen = np.frombuffer(agent.q_table.seen, dtype=np.uint8)
+    full_mask = (1 << Q_DECK_BITS) - 1
+    results = dict(results) if results else {"agent1_win": 0, "agent2_win": 0, "draw": 0}
+
+    done_episodes = start_episode
+    while done_episodes < episodes:
+        n = min(batch_size, episodes - done_episodes)
+        everyone = np.ones(n, dtype=bool)
+        none_state = np.full(n, -1, dtype=np.int64)
+        zeros = np.zeros(n, dtype=np.float64)
+
+        # 初期手札 (各2枚)。hand[0] が相手から見えるオープンカード
+        mask = np.full(n, full_mask, dtype=np.int64)
+        decks = _NpDecks(n, rng)
+        up1, mask = decks.draw(mask, everyone)
+        second1, mask = decks.draw(mask, everyone)
+        up2, mask = decks.draw(mask, everyone)
+        second2, mask = decks.draw(mask, everyone)
+        total1 = up1 + second1
+        total2 = up2 + second2
+
+        stand_count1 = np.zeros(n, dtype=np.int64)
+        stand_count2 = np.zeros(n, dtype=np.int64)
+        last_state1 = none_state.copy()
+        last_action1 = np.zeros(n, dtype=np.int64)
+        last_state2 = none_state.copy()
+        last_action2 = np.zeros(n, dtype=np.int64)
+        terminated = np.zeros(n, dtype=bool)
+        burst_ended = np.zeros(n, dtype=bool)
+
+        for _ in range(max_iterations):
+            active = ~terminated
+            if not active.any():
+                break
+
+            # ----- Agent1 のターン -----
+            state1 = _np_state_index(total1, up2, mask)
+            action1 = _np_choose_action(agent, values, seen, state1, total1, active, rng)
+            hit1 = active & (action1 == 0)
+            card, mask = decks.draw(mask, hit1)
+            drew1 = card > 0
+            no_card1 = hit1 & ~drew1  # デッキ切れ → スタンド扱い
+            new_total1 = total1 + card
+            reward1 = np.where(drew1 & (new_total1 <= BURST_LIMIT), 0.1, 0.0)
+            total1 = new_total1
+            action1 = np.where(no_card1, 1, action1)
+            last_state1 = np.where(active, state1, last_state1)
+            last_action1 = np.where(active, action1, last_action1)
+            stand_count1 = np.where(hit1, 0, stand_count1)
+            stand_count1 = np.where(active & (action1 == 1), stand_count1 + 1, stand_count1)
+
+            burst1 = drew1 & (total1 > BURST_LIMIT)
+            reward1 = np.where(burst1, reward1 - 10, reward1)
+            results["agent2_win"] += int(burst1.sum())
+            _np_learn(agent, values, seen, state1, action1, reward1, none_state, burst1)
+            _np_learn(agent, values, seen, last_state2, last_action2, zeros + 1, none_state,
+                      burst1 & (last_state2 >= 0))
+            terminated |= burst1
+            burst_ended |= burst1
+
+            # ----- Agent2 のターン -----
+            active = ~terminated
+            state2 = _np_state_index(total2, up1, mask)
+            action2 = _np_choose_action(agent, values, seen, state2, total2, active, rng)
+            hit2 = active & (action2 == 0)
+            card, mask = decks.draw(mask, hit2)
+            drew2 = card > 0
+            no_card2 = hit2 & ~drew2
+            new_total2 = total2 + card
+            reward2 = np.where(drew2 & (new_total2 <= BURST_LIMIT), 0.1, 0.0)
+            total2 = new_total2
+            action2 = np.where(no_card2, 1, action2)
+            last_state2 = np.where(active, state2, last_state2)
+            last_action2 = np.where(active, action2, last_action2)
+            stand_count2 = np.where(hit2, 0, stand_count2)
+            stand_count2 = np.where(active & (action2 == 1), stand_count2 + 1, stand_count2)
+
+            burst2 = drew2 & (total2 > BURST_LIMIT)
+            reward2 = np.where(burst2, reward2 - 10, reward2)
+            results["agent1_win"] += int(burst2.sum())
+            _np_learn(agent, values, seen, state2, action2, reward2, none_state, burst2)
+            _np_learn(agent, values, seen, last_state1, last_action1, zeros + 1, none_state,
+                      burst2 & (last_state1 >= 0))
+            terminated |= burst2
+            burst_ended |= burst2
+
+            # ----- 1サイクルの終了、学習の実行 -----
+            continuing = active & ~burst2
+            next_state1 = _np_state_index(total1, up2, mask)
+            _np_learn(agent, values, seen, last_state1, last_action1, reward1, next_state1,
+                      continuing & (last_state1 >= 0))
+            next_state2 = _np_state_index(total2, up1, mask)
+            _np_learn(agent, values, seen, last_state2, last_action2, reward2, next_state2,
+                      continuing & (last_state2 >= 0))
+
+            # ----- 連続スタンドチェック -----
+            terminated |= continuing & ((stand_count1 >= 3) | (stand_count2 >= 3))
+
+        # ----- エピソード終了処理 (バースト以外で終了したエピソード) -----
+        judged = ~burst_ended
+        outcome = _np_judge(total1, total2)
+        results["agent1_win"] += int((judged & (outcome == 1)).sum())
+        results["agent2_win"] += int((judged & (outcome == -1)).sum())
+        results["draw"] += int((judged & (outcome == 0)).sum())
+        final_reward1 = outcome.astype(np.float64)
+        _np_learn(agent, values, seen, last_state1, last_action1, final_reward1, none_state,
+                  judged & (last_state1 >= 0))
+        _np_learn(agent, values, seen, last_state2, last_action2, -final_reward1, none_state,
+                  judged & (last_state2 >= 0))
+
+        agent.epsilon = max(agent.min_epsilon, agent.epsilon * agent.epsilon_decay ** n)
+        done_episodes += n
+        if log_every:
+            print(f"Phase2(batch): {done_episodes}/{episodes} エピソード終了, ε: {agent.epsilon:.4f}, "
+                  f"A1勝: {results['agent1_win']}, A2勝: {results['agent2_win']}, 引分: {results['draw']}")
+        if progress is not None:
+            try:
+                progress(done_episodes, agent.epsilon, results)
+            except TrainingCancelled:
+                agent.q_table.recount()
+                raise
+
+    agent.q_table.recount()
+    return results
+
+
+# --- オフライン学習: イベントログに記録された実際の対戦の遷移からまとめて学習する ---
+# 対戦相手をシミュレーションせず、ログの AI の行動 (ai イベント) を (状態, 行動, 報酬, 次の状態) にして
+# シャッフルしたミニバッチごとに _np_learn() で更新する。これを epochs 回繰り返す。
+# 報酬は simulate_q_vs_q_batch と同じ: 引いてバーストしなければ 0.1、バーストしたら -10 で終端、
+# 決着したら最後の行動に AI から見た勝敗 (1/0/-1) を与えて終端とする。
+OFFLINE_TRAIN_EPOCHS = 4
+
+
+def iter_logged_transitions(events, stale_seconds=EVENT_LOG_STALE_SECONDS):
+    """
+    イベントからAIの遷移 (状態, 行動 0: hit / 1: stand, 報酬, 次の状態 (終端なら -1)) を順に返すジェネレーター。
+    メモリに持つのは進行中のゲームの直前の行動だけ。バーストした後の (固定ルールの) 行動は使わない。
+    """
+    pending = {}  # ゲームID -> (状態, 行動, 合計, 時刻)
+    count = 0
+    for event in events:
+        count += 1
+        kind, game_id, t = event.get("e"), event.get("g"), event.get("t", 0.0)
+        if kind == "ai":
+            total, opponent_card, mask = event["s"]
+            previous = pending.pop(game_id, None)
+            if previous is not None:
+                state, action, previous_total, _ = previous
+                if total > BURST_LIMIT:
+                    yield state, action, -10.0, -1
+                else:
+                    drew = action == 0 and previous_total < total
+                    yield state, action, 0.1 if drew else 0.0, CompactQTable.index(total, opponent_card, mask)
+            if total <= BURST_LIMIT:
+                pending[game_id] = (CompactQTable.index(total, opponent_card, mask),
+                                    Q_ACTIONS.index(event["a"]), total, t)
+        elif kind == "end":
+            previous = pending.pop(game_id, None)
+            if previous is not None:
+                yield previous[0], previous[1], float(-event["r"]), -1
+        if count % 100000 == 0:  # 放棄されたゲームを捨てる
+            for key in [key for key, value in pending.items() if t - value[3] > stale_seconds]:
+                del pending[key]
+
+
+def load_logged_transitions(paths):
+    """ログファイル群 (read_game_event_log と同じ指定) の遷移を NumPy 配列 (状態, 行動, 報酬, 次の状態) で返す"""
+    if np is None:
+        raise RuntimeError("オフライン学習には numpy が必要です (pip install numpy)")
+    states, actions, rewards, next_states = array('q'), array('b'), array('d'), array('q')
+    for state, action, reward, next_state in iter_logged_transitions(read_game_event_log(paths)):
+        states.append(state)
+        actions.append(action)
+        rewards.append(reward)
+        next_states.append(next_state)
+    return (np.frombuffer(states, dtype=np.int64), np.frombuffer(actions, dtype=np.int8).astype(np.int64),
+            np.frombuffer(rewards, dtype=np.float64), np.frombuffer(next_states, dtype=np.int64))
+
+
+def _offline_td_error(agent, values, transitions):
+    """全遷移の TD 誤差の絶対値の平均 (エポックごとの収束の目安)"""
+    states, actions, rewards, next_states = transitions
+    has_next = next_states >= 0
+    j = np.where(has_next, next_states, 0) << 1
+    next_max = np.where(has_next, np.maximum(values[j], values[j + 1]), 0.0)
+    targets = rewards * agent.reward_scale + agent.gamma * next_max
+    return float(np.abs(targets - values[(states << 1) + actions]).mean())
+
+
+def train_offline(agent, transitions, epochs=OFFLINE_TRAIN_EPOCHS, batch_size=4096, seed=None, log_every=1,
+                  progress=None):
+    """
+    記録された遷移で Q学習を行う (探索も対戦もしないので ε は変えない)。
+     - agent は storage="compact" であること。transitions は load_logged_transitions() の戻り値
+     - 1エポックごとに遷移をシャッフルし、batch_size 件ずつ _np_learn() でまとめて更新する
+       (ミニバッチ内の次の状態の値は更新前のもの。同じ (状態, 行動) の更新は目標値の平均にまとめる)
+     - log_every: 0 以外ならその間隔のエポックごとに TD 誤差を表示する
+     - progress: エポックごとに progress(更新した遷移数, ε, None) を呼ぶ
+    戻り値は {"transitions", "epochs", "td_error": [エポック前, 各エポック後...]}
+    """
+    if np is None:
+        raise RuntimeError("オフライン学習には numpy が必要です (pip install numpy)")
+    if agent.storage != "compact":
+        raise ValueError("オフライン学習は storage='compact' の QLearningAgent のみ対応しています")
+    states, actions, rewards, next_states = transitions
+    n = states.shape[0]
+    rng = np.random.default_rng(seed)
+    values = np.frombuffer(agent.q_table.values, dtype=np.float64)
+    seen = np.frombuffer(agent.q_table.seen, dtype=np.uint8)
+    everyone = np.ones(min(batch_size, n), dtype=bool)
+    td_errors = [_offline_td_error(agent, values, transitions)] if n else []
+    for epoch in range(epochs):
+        order = rng.permutation(n)
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+            _np_learn(agent, values, seen, states[idx], actions[idx], rewards[idx], next_states[idx],
+                      everyone[:idx.size])
+        td_errors.append(_offline_td_error(agent, values, transitions))
+        if log_every and (epoch + 1) % log_every == 0:
+            print(f"Offline: {epoch + 1}/{epochs} エポック終了, TD誤差の平均: {td_errors[-1]:.5f}")
+        if progress is not None:
+            try:
+                progress((epoch + 1) * n, agent.epsilon, None)
+            except TrainingCancelled:
+                agent.q_table.recount()
+                raise
+    agent.q_table.recount()
+    return {"transitions": n, "epochs": epochs, "td_error": td_errors}
+
+
+# --- 厳密解ソルバー: 固定された相手方策に対する後ろ向き帰納法 ---
+# 山札は11枚しかないので、Qエージェントの手番の状態
+#   (山札マスク, 自分の合計, 自分のオープンカード, 相手のオープンカード,
+#    自分の連続スタンド回数, 相手の連続スタンド回数, 初手かどうか)
+# を全列挙できる。相手の合計は「引かれたカードの合計 - 自分の合計」で決まる。
+# 値は judge による最終結果の期待値 (勝ち 1 / 引き分け 0 / 負け -1)。
+# ゲームの進行は train_phase1 / simulate_q_vs_q と同じ (Q側が先手、バーストで即終了、
+# どちらかが3回連続スタンドで判定)。Qエージェント側の行動は choose_action と同じく
+# 合計 LOW_TOTAL_THRESHOLD 以下はヒット、21以上はスタンドに固定する。
+def _cards_total(mask):
+    """山札マスクに含まれるカードの合計"""
+    return MASK_SUM[mask]
+
+
+class ExactSolver:
+    """
+    固定された相手方策に対して、Qエージェント側の厳密な行動価値を計算する。
+     - opponent="omega": OmegaAI (should_ai_draw_first_turn / should_ai_draw)
+     - opponent="q": 固定した Qテーブル (CompactQTable) の greedy 方策
+     - deal: 初期手札の枚数 (省略時は omega なら1枚 = Phase1、q なら2枚 = Phase2)
+    """
+
+    def __init__(self, opponent="omega", q_table=None, deal=None):
+        if opponent == "q" and q_table is None:
+            raise ValueError("opponent='q' には q_table (CompactQTable) が必要です")
+        if opponent not in ("omega", "q"):
+            raise ValueError(f"未知の相手方策です: {opponent}")
+        self.opponent = opponent
+        self.opponent_table = q_table
+        self.deal = deal or (1 if opponent == "omega" else 2)
+        self.action_values = {}  # 手番の状態 -> (Q(hit), Q(stand))
+
+    # --- 相手の方策 ---
+    def _opponent_draws(self, opponent_total, opponent_up, my_total, my_up, deck_mask, first_turn):
+        if self.opponent == "q":
+            if opponent_total >= BURST_LIMIT:
+                return False
+            if opponent_total <= LOW_TOTAL_THRESHOLD:
+                return True
+            values = self.opponent_table.values
+            i = CompactQTable.index(opponent_total, my_up, deck_mask) << 1
+            return not values[i + 1] > values[i]
+        if first_turn:
+            return omega_should_draw_first_turn(opponent_up, opponent_total, deck_mask)
+        return omega_should_draw(opponent_total, my_total, deck_mask)
+
+    # --- 状態遷移 ---
+    def initial_states(self):
+        """初期配布後の手番の状態と、その確率のリスト"""
+        states = {}
+        if self.deal == 1:
+            deals = [((a,), (u,)) for a in DECK for u in DECK if a != u]
+        else:
+            deals = [((a, a2), (u, u2)) for a in DECK for a2 in DECK for u in DECK for u2 in DECK
+                     if len({a, a2, u, u2}) == 4]
+        probability = 1.0 / len(deals)
+        for my_cards, opponent_cards in deals:
+            mask = FULL_DECK_MASK
+            for card in my_cards + opponent_cards:
+                mask ^= 1 << (card - 1)
+            # OmegaAI は自分のオープンカードを見ないので、状態を減らすため 0 にまとめる
+            my_up = my_cards[0] if self.opponent == "q" else 0
+            state = (mask, sum(my_cards), my_up, opponent_cards[0], 0, 0, True)
+            states[state] = states.get(state, 0.0) + probability
+        return list(states.items())
+
+    def allowed_actions(self, state):
+        """choose_action と同じ固定ルールを適用した、選べる行動"""
+        my_total = state[1]
+        if my_total >= BURST_LIMIT:
+            return ("stand",)
+        if my_total <= LOW_TOTAL_THRESHOLD:
+            return ("hit",)
+        return Q_ACTIONS
+
+    def successors(self, state, action):
+        """(確率, 終局なら judge の結果 / 続くなら None, 次の手番の状態) のリスト"""
+        mask, my_total, my_up, opponent_up, my_stands, opponent_stands, first_turn = state
+        opponent_total = DECK_SUM - _cards_total(mask) - my_total
+        if action == "hit" and mask:
+            cards = MASK_CARDS[mask]
+            p = 1.0 / len(cards)
+            result = []
+            for card in cards:
+                new_total = my_total + card
+                if new_total > BURST_LIMIT:
+                    result.append((p, judge(new_total, opponent_total), None))
+                else:
+                    result.extend((p * q, outcome, nxt) for q, outcome, nxt in self._opponent_phase(
+                        mask ^ (1 << (card - 1)), new_total, my_up, opponent_up, 0, opponent_stands, first_turn))
+            return result
+        # スタンド (デッキ切れのヒットはスタンド扱いで、連続スタンド回数は1から)
+        my_stands = 1 if action == "hit" else my_stands + 1
+        return self._opponent_phase(mask, my_total, my_up, opponent_up, my_stands, opponent_stands, first_turn)
+
+    def _opponent_phase(self, mask, my_total, my_up, opponent_up, my_stands, opponent_stands, first_turn):
+        opponent_total = DECK_SUM - _cards_total(mask) - my_total
+        draws = self._opponent_draws(opponent_total, opponent_up, my_total, my_up, mask, first_turn)
+        if draws and mask:
+            cards = MASK_CARDS[mask]
+            p = 1.0 / len(cards)
+            result = []
+            for card in cards:
+                new_total = opponent_total + card
+                if new_total > BURST_LIMIT:
+                    result.append((p, judge(my_total, new_total), None))
+                else:
+                    result.append(self._end_of_round(p, mask ^ (1 << (card - 1)), my_total, my_up, opponent_up,
+                                                     my_stands, 0, new_total))
+            return result
+        opponent_stands = 1 if draws else opponent_stands + 1
+        return [self._end_of_round(1.0, mask, my_total, my_up, opponent_up, my_stands, opponent_stands,
+                                   opponent_total)]
+
+    @staticmethod
+    def _end_of_round(p, mask, my_total, my_up, opponent_up, my_stands, opponent_stands, opponent_total):
+        # 山札が空の状態は誰かが必ずバーストしているので通常は来ないが、念のため判定で終える
+        if my_stands >= 3 or opponent_stands >= 3 or not mask:
+            return (p, judge(my_total, opponent_total), None)
+        return (p, None, (mask, my_total, my_up, opponent_up, my_stands, opponent_stands, False))
+
+    # --- 後ろ向き帰納法 ---
+    def q_values(self, state):
+        """手番の状態での (Q(hit), Q(stand))。どちらも選んだ後は最適に行動するとした期待値"""
+        values = self.action_values.get(state)
+        if values is None:
+            values = tuple(sum(p * (outcome if nxt is None else self.value(nxt))
+                               for p, outcome, nxt in self.successors(state, action))
+                           for action in Q_ACTIONS)
+            self.action_values[state] = values
+        return values
+
+    def best_action(self, state):
+        """選べる行動のうち価値が最大のもの (同値なら greedy と同じく hit)"""
+        allowed = self.allowed_actions(state)
+        if len(allowed) == 1:
+            return allowed[0]
+        q_hit, q_stand = self.q_values(state)
+        return "stand" if q_stand > q_hit else "hit"
+
+    def value(self, state):
+        q_hit, q_stand = self.q_values(state)
+        return q_hit if self.best_action(state) == "hit" else q_stand
+
+    def reach_probabilities(self, action_for=None):
+        """
+        初期状態から action_for(state) の方策 (省略時は最適方策) で進んだときの各手番の到達確率。
+        遷移は「カードが引かれる」か「連続スタンド回数の合計が増える」のどちらかなので、
+        (引かれた枚数, スタンド回数の合計) の順に処理すれば前の状態から順に確定できる。
+        """
+        action_for = action_for or self.best_action
+        reach = {}
+        heap = []
+        for state, p in self.initial_states():
+            reach[state] = reach.get(state, 0.0) + p
+            heapq.heappush(heap, (self._order(state), state))
+        done = set()
+        while heap:
+            _, state = heapq.heappop(heap)
+            if state in done:
+                continue
+            done.add(state)
+            p_state = reach[state]
+            for p, _, nxt in self.successors(state, action_for(state)):
+                if nxt is not None:
+                    if nxt not in reach:
+                        heapq.heappush(heap, (self._order(nxt), nxt))
+                    reach[nxt] = reach.get(nxt, 0.0) + p_state * p
+        return reach
+
+    @staticmethod
+    def _order(state):
+        return (Q_DECK_BITS - len(MASK_CARDS[state[0]]), state[4] + state[5])
+
+    def solve(self):
+        """
+        全状態を解き、Qエージェントが読み込める CompactQTable と期待値を返す。
+        Qテーブルの状態 (合計, 相手のオープンカード, 山札マスク) には複数の手番の状態
+        (連続スタンド回数や自分のオープンカードが異なる) が対応するため、最適方策での
+        到達確率で重み付け平均する (最適方策で到達しない状態は単純平均)。
+        """
+        initial = self.initial_states()
+        expected = sum(p * self.value(state) for state, p in initial)
+        reach = self.reach_probabilities()
+
+        sums = {}
+        for state, (q_hit, q_stand) in self.action_values.items():
+            mask, my_total, _, opponent_up = state[:4]
+            index = CompactQTable.index(my_total, opponent_up, mask)
+            w = reach.get(state, 0.0)
+            entry = sums.setdefault(index, [0.0, 0.0, 0.0, 0.0, 0.0, 0])
+            entry[0] += w * q_hit
+            entry[1] += w * q_stand
+            entry[2] += w
+            entry[3] += q_hit
+            entry[4] += q_stand
+            entry[5] += 1
+
+        table = CompactQTable()
+        values = table.values
+        for index, (w_hit, w_stand, w, hit_sum, stand_sum, n) in sums.items():
+            table.touch(index)
+            if w > 0:
+                values[index << 1] = w_hit / w
+                values[(index << 1) + 1] = w_stand / w
+            else:
+                values[index << 1] = hit_sum / n
+                values[(index << 1) + 1] = stand_sum / n
+        return table, expected
+
+    def policy_value(self, q_table):
+        """
+        Qテーブルの greedy 方策 (choose_action と同じ固定ルール込み) の厳密な期待値。
+        solve() の期待値と比べると、学習済みテーブルが最適からどれだけ離れているか分かる。
+        """
+        def action_for(state):
+            allowed = self.allowed_actions(state)
+            if len(allowed) == 1:
+                return allowed[0]
+            i = CompactQTable.index(state[1], state[3], state[0]) << 1
+            return "stand" if q_table.values[i + 1] > q_table.values[i] else "hit"
+
+        reach = self.reach_probabilities(action_for)
+        expected = 0.0
+        for state, p_state in reach.items():
+            for p, outcome, nxt in self.successors(state, action_for(state)):
+                if nxt is None:
+                    expected += p_state * p * outcome
+        return expected
+
+
+def solve_exact_policy(opponent="omega", q_table=None, deal=None):
+    """
+    ExactSolver で厳密解を求める入口。
+    戻り値: (ExactSolver, CompactQTable, 最適方策での期待値)
+    テーブルは QLearningAgent.q_table にそのまま代入するか、save() で JSON に保存できる。
+    """
+    solver = ExactSolver(opponent, q_table=q_table, deal=deal)
+    table, expected = solver.solve()
+    return solver, table, expected
+
+
+# --- 並列学習: 複数プロセスで学習し、同期ごとに訪問回数で重み付け平均する ---
+# 各ワーカープロセスは自分専用のQテーブルと乱数系列を持ち、sync_interval エピソードごとに
+# 「このラウンドで更新した (状態, 行動) のQ値と更新回数」だけを親プロセスへ送る。
+# 親は Σ(回数 × Q値) / Σ回数 でマージし、変化した要素だけを全ワーカーへ配り直す。
+def _sparse_visits(table):
+    """更新回数が1以上の要素の (インデックス, Q値, 回数) を返し、回数をリセットする"""
+    visits = table.visits
+    if np is not None:
+        counts = np.frombuffer(visits, dtype=np.uint32)
+        indices = np.flatnonzero(counts)
+        result = (indices.astype(np.int64), np.frombuffer(table.values, dtype=np.float64)[indices].copy(),
+                  counts[indices].copy())
+        counts[indices] = 0
+        return result
+    indices = array('q', (i for i, count in enumerate(visits) if count))
+    values = array('d', (table.values[i] for i in indices))
+    counts = array('I', (visits[i] for i in indices))
+    for i in indices:
+        visits[i] = 0
+    return indices, values, counts
+
+
+def _apply_sparse(table, indices, values):
+    """マージ済みの Q値を table に書き込む"""
+    if np is not None:
+        np.frombuffer(table.values, dtype=np.float64)[np.asarray(indices, dtype=np.int64)] = values
+        return
+    table_values = table.values
+    for i, value in zip(indices, values):
+        table_values[i] = value
+
+
+def _merge_sparse(updates):
+    """ワーカーごとの (インデックス, Q値, 回数) を訪問回数で重み付け平均する"""
+    if np is not None:
+        indices = np.concatenate([u[0] for u in updates])
+        values = np.concatenate([u[1] for u in updates])
+        counts = np.concatenate([u[2] for u in updates]).astype(np.float64)
+        merged_indices, inverse = np.unique(indices, return_inverse=True)
+        weighted = np.bincount(inverse, weights=values * counts)
+        return merged_indices, weighted / np.bincount(inverse, weights=counts)
+    weighted = {}
+    totals = {}
+    for indices, values, counts in updates:
+        for i, value, count in zip(indices, values, counts):
+            weighted[i] = weighted.get(i, 0.0) + value * count
+            totals[i] = totals.get(i, 0) + count
+    merged_indices = array('q', sorted(weighted))
+    return merged_indices, array('d', (weighted[i] / totals[i] for i in merged_indices))
+
+
+def _merge_seen(seen_list):
+    """各ワーカーの seen (bytes) の論理和をとる"""
+    merged = 0
+    for seen in seen_list:
+        merged |= int.from_bytes(seen, "little")
+    return bytearray(merged.to_bytes(Q_NUM_STATES, "little"))
+
+
+def _parallel_train_worker(conn, kind, agent_params, batch_size):
+    """並列学習のワーカープロセス本体。親からの指示 (conn) に従ってラウンドごとに学習する"""
+    worker_agent = QLearningAgent(**agent_params)
+    values_bytes, seen_bytes = conn.recv()
+    worker_agent.q_table = CompactQTable(array('d', values_bytes), bytearray(seen_bytes))
+    worker_agent.q_table.visits = array('I', bytes(4 * 2 * Q_NUM_STATES))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        episodes, epsilon, round_seed, merged_indices, merged_values, merged_seen = message
+        if merged_seen is not None:
+            _apply_sparse(worker_agent.q_table, merged_indices, merged_values)
+            worker_agent.q_table.seen[:] = merged_seen
+        worker_agent.epsilon = epsilon
+        results = {"agent1_win": 0, "agent2_win": 0, "draw": 0}
+        if episodes > 0:
+            rng = rng_stream(round_seed, "actions")
+            if kind == "phase1":
+                results = train_phase1(worker_agent, episodes=episodes, save_path=None, log_every=0, rng=rng)
+            elif batch_size:
+                results = simulate_q_vs_q_batch(worker_agent, episodes=episodes, batch_size=batch_size,
+                                                seed=derive_seed(round_seed, "batch"), log_every=0)
+            else:
+                results = simulate_q_vs_q(worker_agent, episodes=episodes, log_every=0, rng=rng)
+        conn.send((_sparse_visits(worker_agent.q_table), bytes(worker_agent.q_table.seen), results))
+    conn.close()
+
+
+def train_parallel(agent, kind="phase1", episodes=500000, workers=None, sync_interval=20000,
+                   seed=None, batch_size=None, save_path=None, progress=None, start_episode=0, results=None):
+    """
+    train_phase1 (kind="phase1") / simulate_q_vs_q (kind="phase2") を複数プロセスで並列実行する。
+     - workers: プロセス数 (省略時は CPU コア数)
+     - sync_interval: 1ラウンドで各ワーカーが進めるエピソード数 (ラウンドごとにQテーブルを同期)
+     - seed: ワーカーの乱数系列はラウンドごとに derive_seed(seed, ワーカー番号, ラウンド開始時のエピソード数) から作る
+       (同期後は全ワーカーのQテーブルが親と一致するので、チェックポイントから同じ系列で再開できる)
+     - batch_size: phase2 で指定するとワーカー内でバッチ版 (simulate_q_vs_q_batch) を使う
+     - ε は全ワーカー合計のエピソード数で減衰させる (逐次学習と同じスケジュール)
+     - progress, start_episode, results: simulate_q_vs_q と同じ。progress は同期ラウンドの終了ごとに呼ぶ
+    戻り値は勝敗集計。
+    """
+    if agent.storage != "compact":
+        raise ValueError("並列学習は storage='compact' の QLearningAgent のみ対応しています")
+    if kind not in ("phase1", "phase2"):
+        raise ValueError(f"未知の学習種別です: {kind}")
+    workers = workers or os.cpu_count() or 1
+    if seed is None:
+        seed = random.getrandbits(64)
+    agent_params = {
+        "alpha": agent.alpha, "gamma": agent.gamma, "epsilon": agent.epsilon,
+        "epsilon_decay": agent.epsilon_decay ** workers, "min_epsilon": agent.min_epsilon,
+        "reward_scale": agent.reward_scale, "min_epsilon_for_play": agent.min_epsilon_for_play,
+    }
+
+    processes = []
+    connections = []
+    for worker_id in range(workers):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_parallel_train_worker,
+            args=(child_conn, kind, agent_params, batch_size),
+            daemon=True)
+        process.start()
+        child_conn.close()
+        parent_conn.send((bytes(agent.q_table.values), bytes(agent.q_table.seen)))
+        processes.append(process)
+        connections.append(parent_conn)
+
+    results = dict(results) if results else {"agent1_win": 0, "agent2_win": 0, "draw": 0}
+    merged = (None, None, None)
+    done_episodes = start_episode
     try:
-        # q_table2.json がなければ q_table.json (Phase1の結果) を読み込む
-        agent.load("q_table.json")
-        print("INFO: q_table.json を読み込みました。")
-        q_table_loaded = True
-    except (FileNotFoundError, json.JSONDecodeError):
-        print("WARNING: q_table.json も見つからないか壊れています。新しいQテーブルで開始します。")
-        # どちらのファイルもなければ、agent.q_table は空のまま (QLearningAgentの__init__で初期化されている)
-
-if not q_table_loaded:
+        while done_episodes < episodes:
+            round_episodes = min(sync_interval * workers, episodes - done_episodes)
+            shares = [round_episodes // workers + (1 if i < round_episodes % workers else 0)
+                      for i in range(workers)]
+            for worker_id, (conn, share) in enumerate(zip(connections, shares)):
+                conn.send((share, agent.epsilon, derive_seed(seed, worker_id, done_episodes)) + merged)
+            replies = [conn.recv() for conn in connections]
+
+            merged_indices, merged_values = _merge_sparse([reply[0] for reply in replies])
+            merged_seen = _merge_seen([reply[1] for reply in replies])
+            _apply_sparse(agent.q_table, merged_indices, merged_values)
+            agent.q_table.seen[:] = merged_seen
+            agent.q_table.recount()
+            merged = (merged_indices, merged_values, merged_seen)
+            for reply in replies:
+                for key in results:
+                    results[key] += reply[2][key]
+
+            done_episodes += round_episodes
+            agent.epsilon = max(agent.min_epsilon, agent.epsilon * agent.epsilon_decay ** round_episodes)
+            print(f"Parallel {kind}: {done_episodes}/{episodes} エピソード終了 ({workers} プロセス), "
+                  f"ε: {agent.epsilon:.4f}, 状態数: {len(agent.q_table)}")
+            if progress is not None:
+                progress(done_episodes, agent.epsilon, results)
+    finally:
+        for conn in connections:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass  # 既に終了したワーカー
+            conn.close()
+        for process in processes:
+            process.join()
+
+    if save_path:
+        agent.save(save_path)
+    return results
+
+
+# --- 学習のチェックポイント (途中保存と再開) ---
+# checkpoint_dir には次のファイルを置く。
+#   manifest.json      : 学習の設定、進捗 (エピソード数、ε、勝敗集計)、乱数の状態、使うファイルの一覧
+#   base-NNNNNN.qtb    : ある時点のQテーブル全体 (バイナリ形式)
+#   delta-NNNNNN.qtd   : 前回のチェックポイントから変わったチャンク (CHECKPOINT_CHUNK バイト単位) だけ
+# 読み込むときは base にデルタを順に当てる。デルタが CHECKPOINT_COMPACT_AFTER 個たまったら新しい base に
+# まとめる。manifest は最後に os.replace で書き換えるので、途中で落ちても直前のチェックポイントが残る。
+# チェックポイントは学習関数の progress (エピソードの区切り) で取り、そのときの乱数ストリームの状態も
+# 保存するので、そこから同じ乱数系列で再開できる。
+CHECKPOINT_EVERY = 50000          # チェックポイントの間隔 (エピソード)
+CHECKPOINT_CHUNK = 256            # デルタの単位 (バイト = 16状態分)
+CHECKPOINT_COMPACT_AFTER = 16     # この数のデルタがたまったら base にまとめる
+CHECKPOINT_MANIFEST = "manifest.json"
+CHECKPOINT_DELTA_MAGIC = b"QTBD"
+CHECKPOINT_DELTA_VERSION = 1
+CHECKPOINT_DELTA_HEADER = struct.Struct("<4sIII")  # magic, version, 変更チャンク数 (values), 同 (seen)
+CHECKPOINT_CHUNK_INDEX = struct.Struct("<I")
+
+
+def _table_buffers(table):
+    """CompactQTable の values / seen をバイト列の memoryview で返す"""
+    return memoryview(table.values).cast('B'), memoryview(table.seen).cast('B')
+
+
+def _changed_chunks(current, previous):
+    """current と previous (同じ長さ) で内容が違うチャンクの番号"""
+    return [start // CHECKPOINT_CHUNK for start in range(0, len(current), CHECKPOINT_CHUNK)
+            if current[start:start + CHECKPOINT_CHUNK] != previous[start:start + CHECKPOINT_CHUNK]]
+
+
+def _write_checkpoint_delta(path, values, seen, value_chunks, seen_chunks):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(CHECKPOINT_DELTA_HEADER.pack(CHECKPOINT_DELTA_MAGIC, CHECKPOINT_DELTA_VERSION,
+                                             len(value_chunks), len(seen_chunks)))
+        for buffer, chunks in ((values, value_chunks), (seen, seen_chunks)):
+            for chunk in chunks:
+                f.write(CHECKPOINT_CHUNK_INDEX.pack(chunk))
+                f.write(buffer[chunk * CHECKPOINT_CHUNK:(chunk + 1) * CHECKPOINT_CHUNK])
+    os.replace(tmp_path, path)
+
+
+def _apply_checkpoint_delta(path, values, seen):
+    """デルタファイルのチャンクを values / seen (書き込み可能なバイト列) に書き戻す"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, value_count, seen_count = CHECKPOINT_DELTA_HEADER.unpack_from(data)
+    if magic != CHECKPOINT_DELTA_MAGIC or version != CHECKPOINT_DELTA_VERSION:
+        raise ValueError(f"{path} はチェックポイントのデルタファイルではありません")
+    offset = CHECKPOINT_DELTA_HEADER.size
+    for buffer, count in ((values, value_count), (seen, seen_count)):
+        for _ in range(count):
+            (chunk,) = CHECKPOINT_CHUNK_INDEX.unpack_from(data, offset)
+            offset += CHECKPOINT_CHUNK_INDEX.size
+            start = chunk * CHECKPOINT_CHUNK
+            end = min(start + CHECKPOINT_CHUNK, len(buffer))
+            buffer[start:end] = data[offset:offset + end - start]
+            offset += end - start
+
+
+def _write_checkpoint_manifest(directory, manifest):
+    path = os.path.join(directory, CHECKPOINT_MANIFEST)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_unused_checkpoint_files(directory, manifest):
+    used = {manifest["base"], CHECKPOINT_MANIFEST, *manifest["deltas"]}
+    for name in os.listdir(directory):
+        if name not in used and (name.startswith("base-") or name.startswith("delta-")):
+            os.remove(os.path.join(directory, name))
+
+
+def load_checkpoint(directory):
+    """(manifest, base にデルタを当てた CompactQTable) を返す"""
+    with open(os.path.join(directory, CHECKPOINT_MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    base = CompactQTable.load_binary(os.path.join(directory, manifest["base"]))
+    values = array('d')
+    values.frombytes(memoryview(base.values).cast('B'))
+    seen = bytearray(base.seen)
+    value_bytes = memoryview(values).cast('B')
+    for name in manifest["deltas"]:
+        _apply_checkpoint_delta(os.path.join(directory, name), value_bytes, seen)
+    value_bytes.release()
+    return manifest, CompactQTable(values, seen)
+
+
+def compact_checkpoint(directory):
+    """デルタを新しい base にまとめる。まとめたデルタの数を返す"""
+    manifest, table = load_checkpoint(directory)
+    merged = len(manifest["deltas"])
+    if merged:
+        manifest["sequence"] += 1
+        manifest["base"] = f"base-{manifest['sequence']:06d}.qtb"
+        manifest["deltas"] = []
+        table.save_binary(os.path.join(directory, manifest["base"]))
+        _write_checkpoint_manifest(directory, manifest)
+        _remove_unused_checkpoint_files(directory, manifest)
+    return merged
+
+
+class TrainingCheckpointer:
+    """
+    学習関数の progress として使うと、every エピソードごとに directory へチェックポイントを書く。
+     - config: 再開に必要な学習の設定 (kind, episodes, params, agent_params)。manifest にそのまま入れる
+     - rng, np_rng: 学習で使う乱数ストリーム (run_training と同じ。状態も保存する)
+     - manifest: 再開時に load_checkpoint で読んだ manifest (続きのデルタを書き足す)
+    """
+
+    def __init__(self, directory, agent, config, every=CHECKPOINT_EVERY,
+                 compact_after=CHECKPOINT_COMPACT_AFTER, rng=None, np_rng=None, manifest=None):
+        self.directory = directory
+        self.agent = agent
+        self.config = config
+        self.every = every
+        self.compact_after = compact_after
+        self.rng = rng
+        self.np_rng = np_rng
+        self.manifest = manifest
+        self._snapshot = None  # 直前のチェックポイントの (values, seen) のバイト列
+        self._last = None      # 直近の progress の引数
+        if manifest is not None:
+            self._snapshot = tuple(bytes(buffer) for buffer in _table_buffers(agent.q_table))
+
+    def __call__(self, episodes_done, epsilon, results):
+        self._last = (episodes_done, epsilon, dict(results) if results is not None else None)
+        if self.manifest is None or episodes_done - self.manifest["episodes_done"] >= self.every:
+            self.save(*self._last)
+
+    def flush(self):
+        """最後の progress の時点がまだ保存されていなければ保存する (中断時・終了時)"""
+        if self._last is not None and self._last[0] != self.manifest["episodes_done"]:
+            self.save(*self._last)
+
+    def save(self, episodes_done, epsilon, results):
+        os.makedirs(self.directory, exist_ok=True)
+        values, seen = _table_buffers(self.agent.q_table)
+        manifest = dict(self.manifest or {"sequence": 0, "deltas": []}, **self.config)
+        manifest["sequence"] += 1
+        name = f"{manifest['sequence']:06d}"
+        if self._snapshot is None or len(manifest["deltas"]) >= self.compact_after:
+            manifest["base"] = f"base-{name}.qtb"
+            manifest["deltas"] = []
+            self.agent.q_table.save_binary(os.path.join(self.directory, manifest["base"]))
+        else:
+            value_chunks = _changed_chunks(values, self._snapshot[0])
+            seen_chunks = _changed_chunks(seen, self._snapshot[1])
+            manifest["deltas"] = manifest["deltas"] + [f"delta-{name}.qtd"]
+            _write_checkpoint_delta(os.path.join(self.directory, manifest["deltas"][-1]),
+                                    values, seen, value_chunks, seen_chunks)
+        manifest.update(
+            episodes_done=episodes_done, epsilon=epsilon, results=results, updated_at=time.time(),
+            random_state=self.rng.getstate() if self.rng is not None else None,
+            numpy_rng_state=self.np_rng.bit_generator.state if self.np_rng is not None else None,
+        )
+        _write_checkpoint_manifest(self.directory, manifest)
+        _remove_unused_checkpoint_files(self.directory, manifest)
+        self.manifest = manifest
+        self._snapshot = (bytes(values), bytes(seen))
+
+
+def _chain_progress(*callbacks):
+    """複数の progress を順に呼ぶ progress を作る"""
+    def progress(episodes_done, epsilon, results):
+        for callback in callbacks:
+            callback(episodes_done, epsilon, results)
+    return progress
+
+
+def run_training(agent, kind, params, progress=None, start_episode=0, results=None, rng=None, np_rng=None,
+                 log_every=500):
+    """
+    学習の種別とパラメータ (/train, /train2 の JSON と同じ) に応じて学習関数を呼び分ける。
+    params: {"episodes": N, "workers": 並列数, "mode": "batch", "batch_size": N, "seed": 乱数シード}
+    rng: 逐次版の乱数生成器、np_rng: バッチ版の numpy の Generator (並列学習では params["seed"] を使う)
+    """
+    episodes = params["episodes"]
+    workers = params.get("workers")
+    batch_size = params.get("batch_size") if params.get("mode") == "batch" else None
+    if workers:
+        return train_parallel(agent, kind, episodes=episodes, workers=workers, batch_size=batch_size,
+                              seed=params.get("seed"), progress=progress, start_episode=start_episode,
+                              results=results)
+    if kind == "phase1":
+        return train_phase1(agent, episodes=episodes, save_path=None, log_every=log_every, progress=progress,
+                            start_episode=start_episode, results=results, rng=rng)
+    if batch_size:
+        return simulate_q_vs_q_batch(agent, episodes=episodes, batch_size=batch_size, log_every=log_every,
+                                     progress=progress, start_episode=start_episode, results=results, rng=np_rng)
+    return simulate_q_vs_q(agent, episodes=episodes, log_every=log_every, progress=progress,
+                           start_episode=start_episode, results=results, rng=rng)
+
+
+def run_checkpointed_training(agent, kind, params, checkpoint_dir, resume=False, every=CHECKPOINT_EVERY,
+                              progress=None, log_every=500):
+    """
+    チェックポイントを取りながら run_training を実行し、(agent, 勝敗集計) を返す。
+     - resume=True: checkpoint_dir の最後のチェックポイントから、保存した設定・乱数の状態で続きを学習する
+       (agent と kind, params は無視し、チェックポイントから作り直す)
+     - progress: チェックポイントの後に呼ぶ progress (ジョブの進捗報告など)
+    中断 (TrainingCancelled) されたときは、その時点のチェックポイントを書いてから送出し直す。
+    """
+    manifest = None
+    start_episode, results = 0, None
+    if resume:
+        manifest, table = load_checkpoint(checkpoint_dir)
+        kind, params = manifest["kind"], manifest["params"]
+        agent = QLearningAgent(**manifest["agent_params"])
+        agent.q_table = table
+        agent.epsilon = manifest["epsilon"]
+        start_episode, results = manifest["episodes_done"], manifest["results"]
+    else:
+        if agent.storage != "compact":
+            raise ValueError("チェックポイントは storage='compact' の QLearningAgent のみ対応しています")
+        params = dict(params)
+        params.setdefault("seed", random.getrandbits(64))  # 乱数ストリームはすべてこの seed から作る
+    seed = params["seed"]
+    rng = rng_stream(seed, "actions")
+    np_rng = None
+    if params.get("mode") == "batch" and not params.get("workers"):
+        np_rng = np.random.default_rng(derive_seed(seed, "batch"))
+    if manifest is not None:
+        rng.setstate(_as_random_state(manifest["random_state"]))
+        if np_rng is not None:
+            np_rng.bit_generator.state = manifest["numpy_rng_state"]
+    config = {
+        "kind": kind, "params": params, "episodes": params["episodes"],
+        "agent_params": {
+            "alpha": agent.alpha, "gamma": agent.gamma, "epsilon": agent.epsilon,
+            "epsilon_decay": agent.epsilon_decay, "min_epsilon": agent.min_epsilon,
+            "reward_scale": agent.reward_scale, "min_epsilon_for_play": agent.min_epsilon_for_play,
+        } if manifest is None else manifest["agent_params"],
+    }
+    checkpointer = TrainingCheckpointer(checkpoint_dir, agent, config, every=every, rng=rng, np_rng=np_rng,
+                                        manifest=manifest)
+    if manifest is None:
+        checkpointer.save(0, agent.epsilon, None)
+    try:
+        results = run_training(agent, kind, params,
+                               progress=checkpointer if progress is None else _chain_progress(checkpointer, progress),
+                               start_episode=start_episode, results=results, rng=rng, np_rng=np_rng,
+                               log_every=log_every)
+    except TrainingCancelled:
+        checkpointer.flush()
+        raise
+    if checkpointer.manifest["episodes_done"] != params["episodes"]:
+        checkpointer.save(params["episodes"], agent.epsilon, results)
+    return agent, results
+
+
+# --- 方策の評価: 固定した方策を学習・探索なしで大量に対戦させ、勝率を信頼区間付きで求める ---
+# 山札はマスクで持ち、1ゲームを学習関数と同じルールで進める。
+#   opponent="omega": OmegaAI と対戦 (train_phase1 と同じく1枚ずつ配り、評価する方策が先手)
+#   opponent="self" : 同じ方策どうし (simulate_q_vs_q と同じく2枚ずつ配る)
+#   opponent="q"    : 別のQテーブルの方策 (opponent_policy) と対戦
+# ゲームは EVALUATION_ROUND_GAMES ずつのラウンドで各プロセスに割り振り、ラウンドごとに信頼区間を
+# 計算して precision に達したら打ち切る。乱数はラウンドごとに derive_seed(seed, ワーカー番号, 終了ゲーム数) から作る。
+EVALUATION_ROUND_GAMES = 20000  # 1ラウンドで各プロセスが進めるゲーム数
+EVALUATION_OPPONENTS = ("omega", "self", "q")
+
+
+def _policy_action(codes, total, opponent_card, mask):
+    """FrozenPolicy.codes から行動 (0: hit, 1: stand) を引く"""
+    if total > BURST_LIMIT:
+        total = BURST_LIMIT + 1
+    return codes[((total * Q_OPPONENT_SLOTS + opponent_card) << Q_DECK_BITS) | mask] & 1
+
+
+def _draw_card(mask, rng):
+    """山札マスクからカードを1枚引いて (カード, 新しいマスク) を返す"""
+    cards = MASK_CARDS[mask]
+    card = cards[rng.randrange(len(cards))]
+    return card, mask & ~(1 << (card - 1))
+
+
+def _play_vs_omega(codes, rng, max_iterations=50):
+    """train_phase1 と同じ進行で1ゲーム行い、方策側から見た勝敗 (1/0/-1) を返す"""
+    mask = FULL_DECK_MASK
+    total, mask = _draw_card(mask, rng)
+    omega_first, mask = _draw_card(mask, rng)
+    omega_total = omega_first
+    stands = omega_stands = 0
+    for iteration in range(max_iterations):
+        if _policy_action(codes, total, omega_first, mask) == 0:
+            stands = 0
+            if mask:
+                card, mask = _draw_card(mask, rng)
+                total += card
+                if total > BURST_LIMIT:
+                    return -1
+            else:
+                stands += 1  # デッキ切れはスタンド扱い
+        else:
+            stands += 1
+        if iteration == 0:
+            omega_draws = omega_should_draw_first_turn(omega_first, omega_total, mask)
+        else:
+            omega_draws = omega_should_draw(omega_total, total, mask)
+        if omega_draws and mask:
+            omega_stands = 0
+            card, mask = _draw_card(mask, rng)
+            omega_total += card
+            if omega_total > BURST_LIMIT:
+                return 1
+        else:
+            omega_stands += 1
+        if stands >= 3 or omega_stands >= 3:
+            break
+    return judge(total, omega_total)
+
+
+def _play_vs_policy(codes1, codes2, rng, max_iterations=50):
+    """simulate_q_vs_q と同じ進行で1ゲーム行い、先手 (codes1) から見た勝敗 (1/0/-1) を返す"""
+    mask = FULL_DECK_MASK
+    up1, mask = _draw_card(mask, rng)
+    second1, mask = _draw_card(mask, rng)
+    up2, mask = _draw_card(mask, rng)
+    second2, mask = _draw_card(mask, rng)
+    total1, total2 = up1 + second1, up2 + second2
+    stands1 = stands2 = 0
+    for _ in range(max_iterations):
+        if _policy_action(codes1, total1, up2, mask) == 0:
+            stands1 = 0
+            if mask:
+                card, mask = _draw_card(mask, rng)
+                total1 += card
+                if total1 > BURST_LIMIT:
+                    return -1
+            else:
+                stands1 += 1
+        else:
+            stands1 += 1
+        if _policy_action(codes2, total2, up1, mask) == 0:
+            stands2 = 0
+            if mask:
+                card, mask = _draw_card(mask, rng)
+                total2 += card
+                if total2 > BURST_LIMIT:
+                    return 1
+            else:
+                stands2 += 1
+        else:
+            stands2 += 1
+        if stands1 >= 3 or stands2 >= 3:
+            break
+    return judge(total1, total2)
+
+
+def play_evaluation_games(codes, opponent, games, rng, opponent_codes=None, alternate_seats=False,
+                          first_game=0):
+    """
+    games ゲームを行い、codes の方策から見た [勝ち, 引き分け, 負け] を返す。
+    alternate_seats=True なら通し番号 (first_game から) が奇数のゲームで後手になる (omega 以外)。
+    """
+    counts = [0, 0, 0]
+    if opponent == "omega":
+        for _ in range(games):
+            counts[1 - _play_vs_omega(codes, rng)] += 1
+        return counts
+    opponent_codes = codes if opponent == "self" else opponent_codes
+    for game in range(first_game, first_game + games):
+        if alternate_seats and game & 1:
+            counts[1 + _play_vs_policy(opponent_codes, codes, rng)] += 1
+        else:
+            counts[1 - _play_vs_policy(codes, opponent_codes, rng)] += 1
+    return counts
+
+
+def wilson_interval(successes, n, z):
+    """二項比率の Wilson スコア信頼区間 (下限, 上限)"""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def summarize_evaluation(counts, confidence=0.95):
+    """
+    [勝ち, 引き分け, 負け] から勝率・引き分け率・負け率 (Wilson 区間) と、
+    1ゲームあたりの得点 (勝ち1/引き分け0/負け-1) の平均 (正規近似の区間) をまとめる。
+    half_width は3つの率の区間の半幅の最大値 (早期終了の判定に使う)
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    n = sum(counts)
+    summary = {"games": n, "confidence": confidence}
+    half_width = 0.0
+    for key, count in zip(("win", "draw", "loss"), counts):
+        low, high = wilson_interval(count, n, z)
+        summary[key] = {"count": count, "rate": count / n if n else 0.0, "low": low, "high": high}
+        half_width = max(half_width, (high - low) / 2)
+    mean = (counts[0] - counts[2]) / n if n else 0.0
+    variance = (counts[0] + counts[2]) / n - mean * mean if n else 0.0
+    score_half = z * math.sqrt(variance / n) if n else 1.0
+    summary["score"] = {"mean": mean, "low": mean - score_half, "high": mean + score_half}
+    summary["half_width"] = half_width
+    return summary
+
+
+def _evaluation_worker(conn, codes, opponent, opponent_codes, alternate_seats):
+    """評価のワーカープロセス本体。(ゲーム数, 乱数シード, 通し番号) を受け取って勝敗数を返す"""
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        games, round_seed, first_game = message
+        conn.send(play_evaluation_games(codes, opponent, games, random.Random(round_seed),
+                                        opponent_codes, alternate_seats, first_game))
+    conn.close()
+
+
+def evaluate_policy(policy, opponent="omega", opponent_policy=None, max_games=1000000, precision=None,
+                    confidence=0.95, workers=None, seed=None, alternate_seats=None,
+                    round_games=EVALUATION_ROUND_GAMES, progress=None):
+    """
+    固定した方策 (FrozenPolicy) を評価し、summarize_evaluation の結果に次を加えて返す。
+      stopped_early: precision に達して max_games より前に打ち切ったか, seconds, games_per_sec
+     - opponent: "omega" / "self" / "q" (q は opponent_policy が必要)
+     - precision: 勝率・引き分け率・負け率の信頼区間の半幅がすべてこれ以下になったら打ち切る
+     - workers: プロセス数 (省略時は CPU コア数、1 ならこのプロセスで実行)
+     - alternate_seats: 先手・後手を1ゲームごとに入れ替える (省略時は opponent="q" のときだけ入れ替える)
+     - progress: ラウンドごとに progress(途中経過の summary) を呼ぶ
+    """
+    if opponent not in EVALUATION_OPPONENTS:
+        raise ValueError(f"未知の対戦相手です: {opponent}")
+    if opponent == "q" and opponent_policy is None:
+        raise ValueError("opponent='q' には opponent_policy が必要です")
+    workers = workers or os.cpu_count() or 1
+    if seed is None:
+        seed = random.getrandbits(64)
+    if alternate_seats is None:
+        alternate_seats = opponent == "q"
+    opponent_codes = opponent_policy.codes if opponent_policy is not None else None
+
+    processes = []
+    connections = []
+    if workers > 1:
+        for _ in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_evaluation_worker,
+                args=(child_conn, policy.codes, opponent, opponent_codes, alternate_seats),
+                daemon=True)
+            process.start()
+            child_conn.close()
+            processes.append(process)
+            connections.append(parent_conn)
+
+    started = time.perf_counter()
+    counts = [0, 0, 0]
+    done_games = 0
+    summary = summarize_evaluation(counts, confidence)
+    try:
+        while done_games < max_games:
+            round_total = min(round_games * workers, max_games - done_games)
+            shares = [round_total // workers + (1 if i < round_total % workers else 0) for i in range(workers)]
+            messages = []
+            first_game = done_games
+            for worker_id, share in enumerate(shares):
+                messages.append((share, derive_seed(seed, worker_id, done_games), first_game))
+                first_game += share
+            if connections:
+                for conn, message in zip(connections, messages):
+                    conn.send(message)
+                replies = [conn.recv() for conn in connections]
+            else:
+                games, round_seed, first = messages[0]
+                replies = [play_evaluation_games(policy.codes, opponent, games, random.Random(round_seed),
+                                                 opponent_codes, alternate_seats, first)]
+            for reply in replies:
+                counts = [a + b for a, b in zip(counts, reply)]
+            done_games += round_total
+            summary = summarize_evaluation(counts, confidence)
+            if progress is not None:
+                progress(summary)
+            if precision is not None and summary["half_width"] <= precision:
+                break
+    finally:
+        for conn in connections:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process in processes:
+            process.join()
+
+    seconds = time.perf_counter() - started
+    summary.update(opponent=opponent, alternate_seats=alternate_seats, seed=seed, workers=workers,
+                   stopped_early=done_games < max_games, seconds=seconds,
+                   games_per_sec=done_games / seconds if seconds > 0 else None)
+    return summary
+
+
+# --- ハイパーパラメータの探索 ---
+# QLearningAgent のパラメータの組み合わせ (試行) ごとに短い学習を行い、全試行で共通の評価用ゲーム
+# (同じ乱数シード) で方策を評価する。試行はプロセスプールで並列に実行する。
+SWEEP_PARAMETERS = ("alpha", "gamma", "epsilon", "epsilon_decay", "min_epsilon", "reward_scale")
+
+
+def sweep_configs(space, mode="grid", trials=None, rng=None):
+    """
+    探索する QLearningAgent のパラメータの組み合わせ (dict のリスト) を作る。
+     - space: {パラメータ名: 値のリスト} (random では (下限, 上限) のタプルで一様分布も指定できる)
+     - mode="grid": 全組み合わせ (trials を指定すると先頭から trials 個)
+     - mode="random": trials 個をランダムに選ぶ
+    """
+    unknown = set(space) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f"探索できないパラメータです: {', '.join(sorted(unknown))}")
+    names = list(space)
+    if mode == "grid":
+        configs = [{}]
+        for name in names:
+            configs = [dict(config, **{name: value}) for config in configs for value in space[name]]
+        return configs[:trials] if trials else configs
+    if mode == "random":
+        rng = rng or random.Random()
+        return [{name: rng.uniform(*space[name]) if isinstance(space[name], tuple) else rng.choice(space[name])
+                 for name in names} for _ in range(trials or 20)]
+    raise ValueError(f"未知の探索方法です: {mode}")
+
+
+def _run_sweep_trial(task):
+    """プールのワーカーで1試行 (学習 → 評価 → Qテーブルの保存) を行い、結果の行を返す"""
+    trial, config, kind, params, start_table, table_path, train_seed, eval_seed, eval_games, \
+        opponent, opponent_codes = task
+    started = time.perf_counter()
+    agent = QLearningAgent(**config)
+    if start_table:
+        agent.load(start_table)
+    np_rng = np.random.default_rng(derive_seed(train_seed, "batch")) if params.get("mode") == "batch" else None
+    run_training(agent, kind, params, rng=rng_stream(train_seed, "actions"), np_rng=np_rng, log_every=0)
+    train_seconds = time.perf_counter() - started
+    policy = FrozenPolicy.compile(agent.q_table)
+    counts = play_evaluation_games(policy.codes, opponent, eval_games, random.Random(eval_seed), opponent_codes,
+                                   alternate_seats=opponent == "q")
+    agent.q_table.save_binary(table_path)
+    summary = summarize_evaluation(counts)
+    return {
+        "trial": trial, **config, "score": summary["score"]["mean"], "score_low": summary["score"]["low"],
+        "score_high": summary["score"]["high"], "win_rate": summary["win"]["rate"],
+        "draw_rate": summary["draw"]["rate"], "loss_rate": summary["loss"]["rate"],
+        "states": len(agent.q_table), "train_seconds": round(train_seconds, 2),
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def run_sweep(configs, out_dir, kind="phase1", params=None, start_table=None, eval_games=100000,
+              opponent="omega", opponent_policy=None, workers=None, seed=None, progress=None):
+    """
+    configs の各試行を workers 個のプロセスで並列に学習・評価し、得点の高い順の結果の行 (dict) を返す。
+     - params: 1試行の学習 (run_training と同じ。既定は {"episodes": 100000})
+     - start_table: 学習を始めるQテーブル (phase2 で学習済みテーブルから自己対戦させるときなど)
+     - eval_games, opponent, opponent_policy: 評価 (全試行で同じ乱数シードのゲームを使う)
+     - 結果は out_dir/results.json に書き、最良の試行のQテーブルを out_dir/best.qtb に残す
+     - progress: 試行が終わるごとに progress(結果の行) を呼ぶ
+    """
+    if opponent not in EVALUATION_OPPONENTS:
+        raise ValueError(f"未知の対戦相手です: {opponent}")
+    params = dict(params or {"episodes": 100000})
+    params.pop("workers", None)  # 試行の中では並列学習しない (試行どうしを並列に実行する)
+    if seed is None:
+        seed = random.getrandbits(64)
+    os.makedirs(out_dir, exist_ok=True)
+    opponent_codes = opponent_policy.codes if opponent_policy is not None else None
+    tasks = [(trial, config, kind, params, start_table, os.path.join(out_dir, f"trial-{trial:04d}.qtb"),
+              derive_seed(seed, "train"), derive_seed(seed, "eval"), eval_games, opponent, opponent_codes)
+             for trial, config in enumerate(configs)]
+    rows = []
+    with multiprocessing.Pool(workers or os.cpu_count() or 1) as pool:
+        for row in pool.imap_unordered(_run_sweep_trial, tasks):
+            rows.append(row)
+            if progress is not None:
+                progress(row)
+    rows.sort(key=lambda row: row["score"], reverse=True)
+    for row in rows[1:]:
+        os.remove(os.path.join(out_dir, f"trial-{row['trial']:04d}.qtb"))
+    if rows:
+        os.replace(os.path.join(out_dir, f"trial-{rows[0]['trial']:04d}.qtb"), os.path.join(out_dir, "best.qtb"))
+    with open(os.path.join(out_dir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump({"kind": kind, "params": params, "start_table": start_table, "eval_games": eval_games,
+                   "opponent": opponent, "seed": seed, "results": rows}, f, ensure_ascii=False, indent=2)
+    return rows
+
+
+# --- Q学習エージェントの初期化と読み込み ---
+def find_q_table_file(stem):
+    """stem.qtb と stem.json のうち、存在して新しい方のファイル名を返す (なければ None)"""
+    candidates = [f"{stem}{ext}" for ext in (".qtb", ".json") if os.path.exists(f"{stem}{ext}")]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def load_latest_q_table(agent):
+    """
+    まず q_table2 (Phase2の結果)、なければ q_table (Phase1の結果) を agent に読み込む。読み込めたら True
+    バイナリ形式 (.qtb) は mmap するので、同じホストのワーカー間で物理メモリを共有する
+    """
+    for q_table_stem in ("q_table2", "q_table"):
+        q_table_file = find_q_table_file(q_table_stem)
+        if q_table_file and agent.load(q_table_file):
+            print(f"INFO: {q_table_file} を読み込みました。")
+            return True
+        print(f"INFO: {q_table_stem}.qtb / {q_table_stem}.json が見つからないか壊れています。")
     print("INFO: 有効な学習済みQテーブルが見つからなかったため、空のQテーブルで開始します。")
+    return False
+
+
+# --- 共有メモリの配信方策 ---
+# SHARED_POLICY_DIR (例: /dev/shm/blackjack-policy) を指定すると、配信用の固定方策を
+# そのディレクトリの policy-<版>.bin に1度だけ書き出し、各ワーカーは Qテーブルを読み込まずに
+# それを読み取り専用で mmap する (ワーカー数を増やしても方策は1つ分のメモリしか使わない)。
+# current ファイルが今の版のファイル名を指し、公開は「新しい .bin を書く → current を os.replace」の順で行う。
+# ワーカーは current の変化を確認して新しい版に付け替える (下の「配信方策のスナップショット」)。
+# gunicorn.conf.py の on_starting が起動時に `manage.py publish-policy` で公開する。
+SHARED_POLICY_DIR = os.environ.get("SHARED_POLICY_DIR", "")
+SHARED_POLICY_MAGIC = b"BJPOLv1\0"
+SHARED_POLICY_HEADER = struct.Struct("<8sQIB3x")  # マジック, 版, 状態数, フォールバック行動
+
+
+def publish_shared_policy(policy, directory=SHARED_POLICY_DIR):
+    """policy を共有ディレクトリに新しい版として書き出して公開し、版を返す"""
+    os.makedirs(directory, exist_ok=True)
+    version = time.time_ns() // 1_000_000  # ミリ秒 (メトリクスの float でも正確に表せる)
+    while os.path.exists(os.path.join(directory, f"policy-{version}.bin")):
+        version += 1
+    name = f"policy-{version}.bin"
+    path = os.path.join(directory, name)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(SHARED_POLICY_HEADER.pack(SHARED_POLICY_MAGIC, version, len(policy.codes),
+                                          Q_ACTIONS.index(policy.fallback_action)))
+        f.write(policy.codes)
+    os.replace(f"{path}.tmp", path)
+    current = os.path.join(directory, "current")
+    with open(f"{current}.{os.getpid()}.tmp", "w") as f:
+        f.write(name)
+    os.replace(f"{current}.{os.getpid()}.tmp", current)
+    # 古い版は消してよい (mmap 済みのワーカーは unlink 後も付け替えるまで読める)
+    for old in os.listdir(directory):
+        if old.startswith("policy-") and old.endswith(".bin") and old != name:
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:
+                pass
+    return version
+
+
+def attach_shared_policy(directory=SHARED_POLICY_DIR):
+    """公開中の方策を読み取り専用で mmap して (FrozenPolicy, 版) を返す。公開されていなければ None"""
+    try:
+        with open(os.path.join(directory, "current")) as f:
+            name = f.read().strip()
+        with open(os.path.join(directory, name), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < SHARED_POLICY_HEADER.size:
+        magic = states = None
+    else:
+        magic, version, states, fallback = SHARED_POLICY_HEADER.unpack_from(mapped)
+    if magic != SHARED_POLICY_MAGIC or states != Q_NUM_STATES or len(mapped) != SHARED_POLICY_HEADER.size + states:
+        print(f"警告: {name} は配信方策のファイルではないか、状態数が合いません。")
+        return None
+    codes = memoryview(mapped)[SHARED_POLICY_HEADER.size:]
+    return FrozenPolicy(codes, Q_ACTIONS[fallback]), version
+
+
+def _shared_policy_stat(directory=SHARED_POLICY_DIR):
+    try:
+        st = os.stat(os.path.join(directory, "current"))
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+# --- 配信方策のスナップショットとホットリロード ---
+# 配信中の方策は不変のスナップショット (serving_policy とその版 serving_policy_version) で、入れ替えは
+# モジュール変数の付け替えだけで行う (Qテーブルをその場で書き換えない)。各リクエストは開始時に
+# g.serving_policy へ取り込み、途中で新しい版が出ても終わるまで同じものを使う。読み手はロックを取らない。
+# 新しい版の確認はワーカーごとに POLICY_CHECK_INTERVAL 秒に1回まで:
+#  - SHARED_POLICY_DIR あり: current の (inode, 更新時刻) が変わっていれば、新しい版を mmap し直す
+#  - なし: q_table2 / q_table の .qtb・.json の (inode, 更新時刻, サイズ) が変わっていれば、読み込み直して
+#    コンパイルする。保存は一時ファイル + os.replace なので、書きかけのファイルを読むことはない
+# 確認は1スレッドだけが行い (取れなければ待たない)、他のスレッドは今の版のまま進む。
+POLICY_CHECK_INTERVAL = float(os.environ.get("POLICY_CHECK_INTERVAL", "1.0"))  # 負の値なら確認しない
+serving_policy = None
+serving_policy_version = 0
+q_table_loaded = False  # 学習済みのQテーブル (または公開された方策) を配信しているか
+_policy_source_key = None  # 最後に読み込んだときの current / Qテーブルファイルの状態
+_next_policy_check = 0.0
+_policy_reload_lock = threading.Lock()
+
+
+def _q_table_files_key():
+    key = []
+    for stem in ("q_table2", "q_table"):
+        for ext in (".qtb", ".json"):
+            try:
+                st = os.stat(f"{stem}{ext}")
+            except OSError:
+                continue
+            key.append((f"{stem}{ext}", st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(key)
+
+
+def install_serving_policy(policy, version, new_agent=None, loaded=True):
+    """配信方策を新しいスナップショットに付け替える (new_agent があれば学習用の agent も差し替える)"""
+    global serving_policy, serving_policy_version, q_table_loaded, agent, _agent_loaded
+    if new_agent is not None:
+        agent, _agent_loaded = new_agent, True
+    serving_policy, serving_policy_version, q_table_loaded = policy, version, loaded
+
+
+def _new_policy_version():
+    return max(time.time_ns() // 1_000_000, serving_policy_version + 1)
+
+
+def _load_local_snapshot(keep_current_on_failure=False):
+    """保存済みの最新Qテーブルを読み込んでスナップショットにする。読めず今の版を残したときは False"""
+    new_agent = QLearningAgent()
+    loaded = load_latest_q_table(new_agent)
+    if not loaded and keep_current_on_failure and serving_policy is not None:
+        print("警告: Qテーブルを読み込めなかったので、今の配信方策のまま続けます。")
+        return False
+    install_serving_policy(FrozenPolicy.compile(new_agent.q_table), _new_policy_version(), new_agent, loaded)
+    return True
+
+
+def reload_serving_policy(force=False):
+    """方策の元 (共有の current か Qテーブルファイル) が変わっていれば新しい版に付け替える。付け替えたら True"""
+    global _policy_source_key
+    key = _shared_policy_stat() if SHARED_POLICY_DIR else _q_table_files_key()
+    if key == _policy_source_key and not force:
+        return False
+    _policy_source_key = key
+    if SHARED_POLICY_DIR:
+        attached = attach_shared_policy() if key is not None else None
+        if attached is None or attached[1] == serving_policy_version:
+            return False
+        install_serving_policy(*attached)
+    elif not _load_local_snapshot(keep_current_on_failure=not force):
+        return False
+    print(f"INFO: 配信方策を版 {serving_policy_version} に切り替えました。")
+    return True
+
+
+def publish_q_table(path):
+    """学習が終わったQテーブルを新しい版として配信する (共有していれば全ワーカーに公開する)。できたら True"""
+    global _policy_source_key
+    new_agent = QLearningAgent()
+    if not new_agent.load(path):
+        return False
+    policy = FrozenPolicy.compile(new_agent.q_table)
+    with _policy_reload_lock:
+        if SHARED_POLICY_DIR:
+            publish_shared_policy(policy)
+            reload_serving_policy()
+        else:
+            install_serving_policy(policy, _new_policy_version(), new_agent)
+            _policy_source_key = _q_table_files_key()
+    return True
+
+
+agent = QLearningAgent()  # 学習用。共有の方策で動くワーカーでは ensure_agent_loaded() まで空のまま
+_agent_loaded = False
+# プレイモード (/ai_turn) は学習用の agent ではなく、読み込んだQテーブルから作った固定方策を使う
+reload_serving_policy(force=True)
+if serving_policy is None:  # 共有の方策がまだ公開されていない
+    _load_local_snapshot()
+
+
+def ensure_agent_loaded():
+    """共有メモリの方策だけで起動したワーカーで、agent に保存済みの最新Qテーブルを読み込む"""
+    global _agent_loaded
+    if not _agent_loaded:
+        load_latest_q_table(agent)
+        _agent_loaded = True
+
+
+def current_serving_policy():
+    """このリクエストが使う配信方策 (リクエストの外では最新の版)"""
+    return g.get("serving_policy", serving_policy) if has_request_context() else serving_policy
+
+
+@app.before_request
+def _capture_serving_policy():
+    global _next_policy_check
+    now = time.monotonic()
+    if POLICY_CHECK_INTERVAL >= 0 and now >= _next_policy_check and _policy_reload_lock.acquire(blocking=False):
+        try:
+            _next_policy_check = now + POLICY_CHECK_INTERVAL
+            reload_serving_policy()
+        except Exception as e:  # 読み込みに失敗しても今の版で応答を続ける
+            print(f"警告: 配信方策の更新に失敗しました: {type(e).__name__}: {e}")
+        finally:
+            _policy_reload_lock.release()
+    g.serving_policy = serving_policy
+
+
+# --- バックグラウンド学習ジョブ ---
+# /train, /train2 はリクエスト内で学習せず、別プロセス (spawn) で学習ジョブを起動してすぐ返す。
+# ジョブの状態は TRAINING_JOBS_DIR/<job_id>.json に書き出すので、どの gunicorn ワーカーからでも
+# 参照できる。キャンセルは <job_id>.cancel ファイルを置くと、学習側が次の progress で中断する。
+# 学習済みテーブルは完了時にだけ保存 (一時ファイル + os.replace) し、中断・失敗時は何も書き換えない。
+TRAINING_JOBS_DIR = os.environ.get("TRAINING_JOBS_DIR", "training_jobs")
+TRAINING_JOB_STATUS_INTERVAL = 1.0  # 実行中の状態ファイルを書き直す最短間隔 (秒)
+TRAINING_JOB_ACTIVE = ("queued", "running")
+TRAINING_JOB_OUTPUTS = {
+    "phase1": ("q_table.json", "q_table.qtb"),
+    "phase2": ("q_table2.json", "q_table2.qtb"),
+}
+_training_job_processes = {}  # このプロセスが起動したジョブ (job_id -> Process)
+_training_job_start_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _training_job_lock():
+    """
+    「実行中のジョブがないか確認してジョブファイルを書く」を排他する。
+    同じプロセスのスレッドはロックで、別のワーカーは TRAINING_JOBS_DIR/.lock の flock で待たせる。
+    """
+    os.makedirs(TRAINING_JOBS_DIR, exist_ok=True)
+    with _training_job_start_lock, open(os.path.join(TRAINING_JOBS_DIR, ".lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # ファイルを閉じると解放される
+        yield
+
+
+def _training_job_path(job_id, suffix=".json"):
+    return os.path.join(TRAINING_JOBS_DIR, f"{job_id}{suffix}")
+
+
+def _write_training_job(job):
+    """ジョブの状態ファイルを一時ファイル + os.replace で書き換える"""
+    job["updated_at"] = time.time()
+    path = _training_job_path(job["id"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_training_job(job_id):
+    """ジョブの状態を返す (存在しなければ None)"""
+    if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+        return None
+    try:
+        with open(_training_job_path(job_id), encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # 実行中のはずのプロセスが消えていたら (強制終了など) 失敗扱いにする
+    if job["status"] == "running" and job.get("pid") and not _pid_alive(job["pid"]):
+        job["status"] = "failed"
+        job["error"] = "学習プロセスが異常終了しました。"
+    return job
+
+
+def list_training_jobs():
+    """全ジョブの状態を作成日時の新しい順に返す"""
+    try:
+        names = os.listdir(TRAINING_JOBS_DIR)
+    except FileNotFoundError:
+        return []
+    jobs = [read_training_job(name[:-5]) for name in names if name.endswith(".json")]
+    return sorted((job for job in jobs if job), key=lambda job: job["created_at"], reverse=True)
+
+
+class TrainingJobReporter:
+    """学習関数の progress に渡すコールバック。キャンセルの確認と状態ファイルの更新を行う"""
+
+    def __init__(self, job):
+        self.job = job
+        self.cancel_path = _training_job_path(job["id"], ".cancel")
+        self._started = time.monotonic()
+        self._last_write = 0.0
+
+    def __call__(self, episodes_done, epsilon, results):
+        if os.path.exists(self.cancel_path):
+            raise TrainingCancelled(self.job["id"])
+        elapsed = time.monotonic() - self._started
+        rate = (episodes_done - self.job.get("start_episode", 0)) / elapsed if elapsed > 0 else None
+        self.job.update(episodes_done=episodes_done, epsilon=epsilon,
+                        episodes_per_sec=round(rate, 1) if rate is not None else None)
+        if results is not None:
+            self.job["results"] = dict(results)
+        if time.monotonic() - self._last_write >= TRAINING_JOB_STATUS_INTERVAL:
+            self.write()
+
+    def write(self):
+        self._last_write = time.monotonic()
+        _write_training_job(self.job)
+
+
+def _run_training_job(job):
+    """学習ジョブのプロセス本体 (spawn で起動するので、agent は最新の保存済みテーブルから読み直されている)"""
+    job.update(status="running", pid=os.getpid(), started_at=time.time())
+    ensure_agent_loaded()
+    reporter = TrainingJobReporter(job)
+    reporter.write()
+    try:
+        trained_agent, results = run_checkpointed_training(
+            agent, job["kind"], job["params"], job["checkpoint_dir"], resume=bool(job["params"].get("resume")),
+            every=job["params"].get("checkpoint_every", CHECKPOINT_EVERY), progress=reporter)
+        for path in job["outputs"]:  # .json の後に .qtb を書くので、次回の読み込みは .qtb になる
+            trained_agent.save(path)
+    except TrainingCancelled:
+        job["status"] = "cancelled"  # チェックポイントは残すので {"resume": job_id} で続きから学習できる
+    except Exception as e:
+        job.update(status="failed", error=f"{type(e).__name__}: {e}")
+    else:
+        job.update(status="completed", episodes_done=job["episodes"])
+        if results is not None:
+            job["results"] = results
+        shutil.rmtree(job["checkpoint_dir"], ignore_errors=True)
+    finally:
+        job["finished_at"] = time.time()
+        reporter.write()
+        try:
+            os.remove(reporter.cancel_path)
+        except FileNotFoundError:
+            pass
+
+
+def _watch_training_job(job_id, process):
+    """ジョブのプロセスを回収し、状態を書けずに終わった場合は失敗として記録する"""
+    process.join()
+    _training_job_processes.pop(job_id, None)
+    job = read_training_job(job_id)
+    if job and job["status"] in TRAINING_JOB_ACTIVE:
+        job.update(status="failed", error=f"学習プロセスが終了コード {process.exitcode} で終了しました。",
+                   finished_at=time.time())
+        _write_training_job(job)
+    elif job and job["status"] == "completed":
+        publish_q_table(job["outputs"][-1])  # ジョブを起動したワーカーはすぐ新しいテーブルで配信する
+
+
+def start_training_job(kind, params):
+    """
+    学習ジョブを起動して状態を返す。実行中のジョブがあれば起動せずにそのジョブを返す。
+    params に {"resume": job_id} があれば、中断・失敗したそのジョブのチェックポイントから続きを学習する
+    (再開できないときは ValueError)。
+    戻り値: (job, started)
+    """
+    with _training_job_lock():
+        active = [job for job in list_training_jobs() if job["status"] in TRAINING_JOB_ACTIVE]
+        if active:
+            return active[0], False
+        job = _new_training_job(kind, params)
+        _write_training_job(job)
+    # 学習プロセスは並列学習のワーカーを起動できるよう daemon にしない
+    process = multiprocessing.get_context("spawn").Process(target=_run_training_job, args=(job,))
+    process.start()
+    _training_job_processes[job["id"]] = process
+    threading.Thread(target=_watch_training_job, args=(job["id"], process), daemon=True).start()
+    return job, True
+
+
+def _new_training_job(kind, params):
+    """新しい学習ジョブの状態 (queued) を作る。再開できないときは ValueError"""
+    job_id = uuid.uuid4().hex
+    checkpoint_dir = _training_job_path(job_id, ".ckpt")
+    start_episode = 0
+    if params.get("resume"):
+        source = read_training_job(params["resume"])
+        if source is None or source["kind"] != kind:
+            raise ValueError("再開する学習ジョブが見つかりません。")
+        checkpoint_dir = source["checkpoint_dir"]
+        try:
+            with open(os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            raise ValueError("このジョブにはチェックポイントがありません (完了したジョブは再開できません)。")
+        params = dict(manifest["params"], resume=source["id"])
+        start_episode = manifest["episodes_done"]
+    now = time.time()
+    return {
+        "id": job_id, "kind": kind, "params": params, "status": "queued", "pid": None,
+        "episodes": params["episodes"], "start_episode": start_episode, "episodes_done": start_episode,
+        "episodes_per_sec": None, "epsilon": agent.epsilon, "results": None,
+        "outputs": list(TRAINING_JOB_OUTPUTS[kind]), "checkpoint_dir": checkpoint_dir,
+        "error": None, "created_at": now, "started_at": None, "finished_at": None,
+    }
+
+
+def cancel_training_job(job_id):
+    """ジョブにキャンセルを要求して状態を返す (存在しなければ None)"""
+    job = read_training_job(job_id)
+    if job and job["status"] in TRAINING_JOB_ACTIVE:
+        with open(_training_job_path(job_id, ".cancel"), "w"):
+            pass
+        job["cancel_requested"] = True
+    return job
 
 
 # --- API エンドポイント ---
 @app.route("/")
 def index():
     """トップページ (ゲーム選択)"""
-    return render_template("index.html")
+    return render_template("index.html", game_events_enabled=GAME_EVENTS_ENABLED)
 
 
 
@@ -799,7 +3802,7 @@ def start_game():
     if current_game_count % 5 == 0:
         gacha_success = True
         print(f"DEBUG: Game count {current_game_count} is a multiple of 5.")
-    if random.randint(1, 5) == 1:
+    if game_rng.randint(1, 5) == 1:
         gacha_success = True
         print(f"DEBUG: Random gacha success for return card.")
 
@@ -832,7 +3835,7 @@ def start_game():
     # AIへの確率補充 (card_id_return を使用) 
     gacha_success_ai = False # AI用のガチャ成功フラグ
     if current_game_count % 5 == 0: gacha_success_ai = True
-    if random.randint(1, 5) == 1: gacha_success_ai = True # 上と同様、orで繋ぐか検討
+    if game_rng.randint(1, 5) == 1: gacha_success_ai = True # 上と同様、orで繋ぐか検討
 
     if gacha_success_ai:
         if card_id_return in SP_CARDS_MASTER:
@@ -848,8 +3851,9 @@ def start_game():
 
 
     # --- デッキと手札の準備 ---
-    session["deck"] = shuffle_deck()
-    if len(session["deck"]) < 4:
+    # 山札は BitDeck のマスク (整数) でセッションに保存する
+    deck = BitDeck.full()
+    if len(deck) < 4:
         return jsonify({
             "error": "Not enough cards in the deck.",
             "player_points": session.get('player_points', INITIAL_POINTS),
@@ -858,8 +3862,9 @@ def start_game():
             "ai_sp_cards": session.get('ai_sp_cards', {}),
         }), 500
 
-    session["player_hand"] = [session["deck"].pop(), session["deck"].pop()]
-    session["ai_hand"] = [session["deck"].pop(), session["deck"].pop()]
+    session["player_hand"] = [deck.draw(game_rng), deck.draw(game_rng)]
+    session["ai_hand"] = [deck.draw(game_rng), deck.draw(game_rng)]
+    session["deck"] = deck.mask
 
     # --- ゲーム状態リセット ---
     session["player_stand"] = False
@@ -869,8 +3874,13 @@ def start_game():
     session.pop('declared_sp_card', None)
     session.pop('ai_declared_sp_card', None)
     # session.modified = True # 不要なら削除
+    session["game_id"] = secrets.token_hex(8)
+    session["game_log_seq"] = 0
+    log_game_event("start", ph=list(session["player_hand"]), ah=list(session["ai_hand"]),
+                   pp=session['player_points'], ap=session['ai_points'],
+                   ps=dict(session['player_sp_cards']), **{"as": dict(session['ai_sp_cards'])})
 
-    load_status = "学習済みファイルを読み込みました。" if agent.q_table else "学習済みファイルが空です。"
+    load_status = "学習済みファイルを読み込みました。" if q_table_loaded else "学習済みファイルが空です。"
 
     
     # ゲーム開始時は game_over: False なので、最初のカードを隠す
@@ -886,7 +3896,7 @@ def start_game():
 
 
     # --- レスポンス ---
-    return jsonify({
+    return jsonify(versioned_payload({
         "player_hand": session["player_hand"],
         "ai_hand": ai_hand_display, # ★★★ 作成した ai_hand_display を渡す ★★★
         "player_points": session.get('player_points', INITIAL_POINTS),
@@ -898,12 +3908,11 @@ def start_game():
         "game_over": False,
         "load_status": load_status,
         "message": "ゲーム開始！あなたのターンです。"
-    })
+    }))
 
 
-@app.route("/hit", methods=["POST"])
-def hit():
-    """プレイヤーがヒット"""
+def _player_hit():
+    """プレイヤーがヒット。(レスポンス, ステータスコード) を返す"""
     print(f"--- HIT request received. Current turn in session: {session.get('turn')}")
 
     # --- ガード節1: プレイヤーのターンではない場合 ---
@@ -913,7 +3922,7 @@ def hit():
         ai_hand_display = [0] + current_ai_hand[1:] if current_ai_hand else []
         
         print("INFO: Hit rejected, not player's turn.")
-        return jsonify({
+        return {
             "message": "Not your turn",
             "player_hand": session.get("player_hand", []),
             "ai_hand": ai_hand_display,
@@ -924,18 +3933,19 @@ def hit():
             "declared_sp_card": session.get('declared_sp_card'),
             "ai_declared_sp_card": session.get('ai_declared_sp_card'),
             "game_over": session.get("turn") == "end" # ゲームが終了している可能性も考慮
-        })
+        }, 200
 
     # --- ガード節2: デッキが空の場合 ---
-    if not session.get("deck"):
+    deck = BitDeck.coerce(session.get("deck"))
+    if not deck:
         print("ERROR: Hit failed, deck is empty.")
-        return jsonify({
+        return {
             "error": "No more cards in the deck.",
             "player_points": session.get('player_points', INITIAL_POINTS),
             "ai_points": session.get('ai_points', INITIAL_POINTS),
             "player_sp_cards": session.get('player_sp_cards', {}),
             "ai_sp_cards": session.get('ai_sp_cards', {}),
-        }), 400
+        }, 400
 
     # --- メインのヒット処理 ---
     
@@ -944,10 +3954,13 @@ def hit():
     session['player_chose_stand_this_turn'] = False
     
     # デッキからカードを引いて手札に加える
-    session["player_hand"].append(session["deck"].pop())
+    drawn_card = deck.draw(game_rng)
+    session["player_hand"].append(drawn_card)
+    session["deck"] = deck.mask
     
     # メッセージを組み立てる
     player_total = calculate_total(session["player_hand"])
+    log_game_event("player", a="hit", c=drawn_card, tot=player_total)
     message = f"あなたがヒットしました。合計: {player_total}"
 
     # バーストした場合のみ、メッセージに追記
@@ -964,7 +3977,7 @@ def hit():
 
     session.modified = True
     
-    return jsonify({
+    return {
         "player_hand": session["player_hand"],
         "ai_hand": ai_hand_display,
         "player_points": session.get('player_points', INITIAL_POINTS),
@@ -975,12 +3988,11 @@ def hit():
         "ai_declared_sp_card": session.get('ai_declared_sp_card'),
         "game_over": False, # ヒット直後にゲームオーバーになることはない
         "message": message
-    })
+    }, 200
 
 
-@app.route("/stand", methods=["POST"])
-def stand():
-    """プレイヤーがスタンド"""
+def _player_stand():
+    """プレイヤーがスタンド。(レスポンス, ステータスコード) を返す"""
     print(f"--- STAND request received. Current turn in session: {session.get('turn')}")
     if session.get("turn") == "player":
         session["player_consecutive_stands_for_ai_logic"] = session.get("player_consecutive_stands_for_ai_logic", 0) + 1 #プレイヤーの連続スタンド回数をインクリメント
@@ -989,6 +4001,7 @@ def stand():
         
         print(f"Stand successful. Setting turn to 'ai'")
         session["turn"] = "ai"
+        log_game_event("player", a="stand", tot=calculate_total(session.get("player_hand", [])))
         message = "あなたがスタンドしました。AIのターンです。"
 
         # --- ↓↓↓ レスポンス作成前に ai_hand_display を作成 ↓↓↓ ---
@@ -1004,7 +4017,7 @@ def stand():
         # --- ↑↑↑ レスポンス作成前に ai_hand_display を作成 ↑↑↑ ---
 
         # ★ スタンド時のレスポンスを変更 ★
-        return jsonify({
+        return {
             "player_hand": session["player_hand"],
             "ai_hand": ai_hand_display, # ★ 隠したAI手札 ★
             "player_points": session.get('player_points', INITIAL_POINTS),
@@ -1015,7 +4028,7 @@ def stand():
             "ai_declared_sp_card": session.get('ai_declared_sp_card'),
             "game_over": False,
             "message": message,
-        })
+        }, 200
 
     else: # --- "Not your turn" の場合 ---
         # --- ↓↓↓ レスポンス作成前に ai_hand_display を作成 ↓↓↓ ---
@@ -1031,7 +4044,7 @@ def stand():
             ai_hand_display = []
         # --- ↑↑↑ レスポンス作成前に ai_hand_display を作成 ↑↑↑ ---
 
-        return jsonify({
+        return {
             "message": "Not your turn",
             "player_points": session.get('player_points', INITIAL_POINTS),
             "ai_points": session.get('ai_points', INITIAL_POINTS),
@@ -1041,12 +4054,11 @@ def stand():
             "ai_hand": ai_hand_display, # ★ 隠したAI手札 ★
             "declared_sp_card": session.get('declared_sp_card'),
             "ai_declared_sp_card": session.get('ai_declared_sp_card'),
-        })
+        }, 200
 
 
-@app.route("/ai_turn", methods=["POST"])
-def ai_turn():
-    """AIのターン"""
+def _ai_turn():
+    """AIのターン。(レスポンス, ステータスコード) を返す"""
     print(f"--- AI_TURN request received. Current turn in session: {session.get('turn')}")
 
     # --- ガード節: AIのターンではない場合 ---
@@ -1056,7 +4068,7 @@ def ai_turn():
         if not is_game_over:
             ai_hand_to_return = [0] + ai_hand_to_return[1:] if ai_hand_to_return else []
         
-        return jsonify({
+        return {
             "message": "Not AI turn" if not is_game_over else "Game already over",
             "player_hand": session.get("player_hand", []),
             "ai_hand": ai_hand_to_return,
@@ -1067,12 +4079,12 @@ def ai_turn():
             "declared_sp_card": session.get('declared_sp_card'),
             "ai_declared_sp_card": session.get('ai_declared_sp_card'),
             "game_over": is_game_over
-        })
+        }, 200
 
     # --- ターン開始時の準備 ---
     player_hand = session.get("player_hand", [])
     ai_hand = session.get("ai_hand", [])
-    deck = session.get("deck", [])
+    deck = BitDeck.coerce(session.get("deck"))
     ai_sp_cards = session.get('ai_sp_cards', {}).copy()
     
     # --- 1. AIによる即時発動系SPカード「手札戻し」の使用判断 ---
@@ -1081,19 +4093,19 @@ def ai_turn():
         print(f"INFO: AI is using INSTANT SP card: {card_id_return}")
         ai_sp_cards[card_id_return] -= 1
         returned_card = ai_hand.pop()
-        deck.append(returned_card)
-        random.shuffle(deck)
+        deck.add(returned_card)
         
         card_name_return = SP_CARDS_MASTER.get(card_id_return, {}).get('name', card_id_return)
         message = f"AIは '{card_name_return}' を使用！ 最後に引いたカード ({returned_card}) を山札に戻しました。あなたのターンです。"
         
         session['ai_sp_cards'] = ai_sp_cards
-        session["deck"] = deck
+        session["deck"] = deck.mask
         session["ai_hand"] = ai_hand
         session["turn"] = "player"
+        log_game_event("sp", who="ai", c=card_id_return, ok=True)
 
         ai_hand_display = [0] + session["ai_hand"][1:] if session.get("ai_hand") else []
-        return jsonify({
+        return {
             "message": message,
             "player_hand": player_hand,
             "ai_hand": ai_hand_display,
@@ -1104,7 +4116,7 @@ def ai_turn():
             "declared_sp_card": session.get('declared_sp_card'),
             "ai_declared_sp_card": session.get('ai_declared_sp_card'),
             "game_over": False
-        })
+        }, 200
     
     # --- 2. AIによる宣言系SPカードの使用判断 ---
     sp_declare_message = ""
@@ -1119,17 +4131,26 @@ def ai_turn():
             sp_declare_message = f"\nAIは '{card_name_declare}' の使用を宣言しました！"
             print(f"INFO: AI declared '{card_name_declare}'.")
             session['ai_sp_cards'] = ai_sp_cards # 消費したのでセッションを更新
+            log_game_event("sp", who="ai", c=card_id_declare_type, ok=True)
 
     # --- 3. AIのヒット/スタンド行動選択 ---
     player_total = calculate_total(player_hand)
     player_consecutive_stands = session.get("player_consecutive_stands_for_ai_logic", 0)
+    player_open_card_for_q = player_hand[0] if player_hand else 0
+    policy_code = None
     if ai_total > player_total and player_consecutive_stands >= 2:
         action_by_ai = "stand"
+        metrics.count_policy_decision("rule")
         print(f"INFO: AI forced to stand by player牽制rule.")
     else:
-        player_open_card_for_q = player_hand[0] if player_hand else 0
-        state_for_q_agent = agent.get_state(ai_total, player_open_card_for_q, deck)
-        action_by_ai = agent.choose_action(state_for_q_agent, ai_total, is_training=False)
+        policy_code = current_serving_policy().code(ai_total, player_open_card_for_q, deck)
+        action_by_ai = Q_ACTIONS[policy_code & 1]
+        metrics.count_policy_code(policy_code, ai_total)
+
+    # 行動前の状態と行動を記録する (オフライン学習の遷移になる。決着の end より前に書く)
+    log_game_event("ai", s=[ai_total, player_open_card_for_q, deck.mask], a=action_by_ai,
+                   r=int(policy_code is None), fb=int(bool(policy_code and policy_code & POLICY_FALLBACK_FLAG)),
+                   v=serving_policy_version)
 
     # --- 4. AIの行動実行と、それに伴う状態遷移 ---
     action_message = ""
@@ -1140,7 +4161,8 @@ def ai_turn():
         if not deck:
             action_message = "AI: ヒット。しかしデッキにカードがありませんでした。"
         else:
-            session["ai_hand"].append(deck.pop())
+            session["ai_hand"].append(deck.draw(game_rng))
+            session["deck"] = deck.mask
             new_ai_total = calculate_total(session["ai_hand"])
             action_message = "AI: ヒット。"
             if new_ai_total > BURST_LIMIT:
@@ -1176,7 +4198,7 @@ def ai_turn():
         ai_hand_to_return = [0] + ai_hand_to_return[1:] if ai_hand_to_return else []
 
     session.modified = True
-    return jsonify({
+    return {
         "message": final_message.strip(),
         "player_hand": player_hand,
         "ai_hand": ai_hand_to_return,
@@ -1187,7 +4209,103 @@ def ai_turn():
         "declared_sp_card": session.get('declared_sp_card'),
         "ai_declared_sp_card": session.get('ai_declared_sp_card'),
         "game_over": is_game_over
-    })
+    }, 200
+
+
+@app.route("/hit", methods=["POST"])
+def hit():
+    """プレイヤーがヒット"""
+    payload, status = _player_hit()
+    return jsonify(versioned_payload(payload) if status == 200 else payload), status
+
+
+@app.route("/stand", methods=["POST"])
+def stand():
+    """プレイヤーがスタンド"""
+    payload, status = _player_stand()
+    return jsonify(versioned_payload(payload) if status == 200 else payload), status
+
+
+@app.route("/ai_turn", methods=["POST"])
+def ai_turn():
+    """AIのターン"""
+    payload, status = _ai_turn()
+    return jsonify(versioned_payload(payload) if status == 200 else payload), status
+
+
+@app.route("/turn", methods=["POST"])
+def turn():
+    """
+    プレイヤーの行動と、それに続くAIのターンを1回のリクエストで処理する
+    JSON: {"action": "hit" | "stand", "push": true (省略可)}
+    レスポンス: {"player": /hit・/stand と同じ内容, "ai": /ai_turn と同じ内容}
+    AIのターンに進まなかった場合 (自分のターンでない、エラーなど) は "ai" が null になる
+    "push": true のときはAIのターンを /events に送り、"ai" は null、"ai_event_id" にそのイベントIDを入れる
+    (GAME_EVENTS_ENABLED でなければ "push" は無視して "ai" に入れる)
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    if action not in ("hit", "stand"):
+        return jsonify({"error": "action は 'hit' か 'stand' を指定してください。"}), 400
+    players_turn = session.get("turn") == "player"
+    player_payload, status = _player_hit() if action == "hit" else _player_stand()
+    if status != 200:
+        return jsonify({"player": player_payload, "ai": None}), status
+    player_payload = versioned_payload(player_payload)
+    ai_payload = None
+    if players_turn and session.get("turn") == "ai":
+        declared_before = session.get("ai_declared_sp_card")
+        ai_payload, status = _ai_turn()
+        if status == 200 and data.get("push") and GAME_EVENTS_ENABLED:
+            event_id = push_ai_turn_events(ai_payload, declared_before)
+            return jsonify({"player": player_payload, "ai": None, "ai_event_id": event_id}), status
+        if status == 200:
+            ai_payload = versioned_payload(ai_payload)
+    return jsonify({"player": player_payload, "ai": ai_payload}), status
+
+
+@app.route("/events", methods=["GET"])
+def game_events():
+    """
+    このセッションのゲームのイベントを Server-Sent Events で送る。
+    Last-Event-ID (ブラウザが再接続時に付ける) があればその続きから、なければ今より後のイベントだけを送る。
+    GAME_EVENTS_ENABLED でなければ 404
+    """
+    if not GAME_EVENTS_ENABLED:
+        return jsonify({"error": "イベントストリームは無効です (GAME_EVENTS=1 で有効)。"}), 404
+    sid = getattr(session, "sid", None)
+    if sid is None or "turn" not in session:
+        return jsonify({"error": "ゲームが開始されていません。"}), 404
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    except (TypeError, ValueError):
+        last_id = session.get("game_event_seq", 0)
+    response = Response(stream_game_events(app.session_interface.store, sid, last_id),
+                        mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx にバッファさせない
+    return response
+
+
+@app.route("/state", methods=["GET"])
+def game_state_route():
+    """
+    現在のゲーム状態を全項目で返す (再読み込みや版がずれたときの取り直し用)。
+    ETag は状態の版で、If-None-Match が一致して状態も変わっていなければ 304 を返す。
+    """
+    if "turn" not in session:
+        return jsonify({"error": "ゲームが開始されていません。"}), 404
+    state = current_game_state()
+    version = str(session.get("state_version", 0))
+    if session.get("client_state") == state and request.if_none_match.contains(version):
+        response = Response(status=304)
+        response.set_etag(version)
+        return response
+    g.client_state_version = None  # 常に全項目を返す
+    body = versioned_payload(state)
+    response = jsonify(body)
+    response.set_etag(str(body["state_version"]))
+    return response
 
 
 @app.route('/use_sp_card', methods=['POST'])
@@ -1235,8 +4353,9 @@ def use_sp_card():
             # ここでは「手札が2枚より多い場合」に戻せるとする (初期手札2枚 + 1枚以上引いている)
             if len(player_hand) > 2: 
                 returned_card = player_hand.pop()
-                session.setdefault("deck", []).append(returned_card) # deckキーがなくてもエラーにならないように
-                random.shuffle(session["deck"])
+                deck = BitDeck.coerce(session.get("deck")) # deckキーがなくてもエラーにならないように
+                deck.add(returned_card)
+                session["deck"] = deck.mask
                 session["player_hand"] = player_hand
                 
                 message = f"あなたが '{card_name}' を使用！ 最後に引いたカード ({returned_card}) を山札に戻しました。"
@@ -1271,6 +4390,8 @@ def use_sp_card():
         session["turn"] = "player" # 宣言後もプレイヤーのターンが継続
 
     session.modified = True # セッションの変更を確実に保存
+    log_game_event("sp", who="player", c=card_id,
+                   ok=additional_data.get("player_hand_updated", not is_instant_effect_card))
 
     # レスポンスに必要なデータを準備
     try:
@@ -1295,24 +4416,152 @@ def use_sp_card():
     }
     response_data.update(additional_data) # player_hand_updated などのフラグを追加
 
-    return jsonify(response_data)
+    return jsonify(versioned_payload(response_data))
+
+
+def _start_training_job_response(kind, params, job_params):
+    """
+    /train, /train2 共通のジョブ起動 (起動できたら 202、実行中のジョブがあれば 409、再開できなければ 400)
+    {"checkpoint_every": N} でチェックポイントの間隔、{"seed": N} で乱数シード (同じシードなら同じQテーブル)、
+    {"resume": job_id} で中断したジョブの再開
+    """
+    try:
+        if params.get("checkpoint_every") is not None:
+            job_params["checkpoint_every"] = _int_param(params, "checkpoint_every")
+        if params.get("seed") is not None:
+            job_params["seed"] = _int_param(params, "seed", minimum=0)
+        if params.get("resume"):
+            job_params = {"resume": str(params["resume"])}
+        job, started = start_training_job(kind, job_params)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body = {"job_id": job["id"], "status_url": f"/train/jobs/{job['id']}", "job": job}
+    if not started:
+        body["error"] = "別の学習ジョブが実行中です。"
+        return jsonify(body), 409
+    body["message"] = f"{job['kind']} 学習ジョブを開始しました。"
+    return jsonify(body), 202
+
+
+def _int_param(params, name, default=None, minimum=1):
+    """JSON パラメーター params[name] を整数で返す (なければ default)。整数でないか minimum 未満なら ValueError"""
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value) if isinstance(value, (int, str)) and not isinstance(value, bool) else None
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise ValueError(f"{name} は {minimum} 以上の整数で指定してください。")
+    return number
 
 
 @app.route("/train", methods=["POST"])
 def train_route():
-    """Phase1 学習モード実行"""
-    train_phase1(agent)
-    return jsonify({"message": "Phase1 学習完了 (q_table.json 生成)"})
+    """
+    Phase1 学習ジョブを起動する (完了すると q_table.json / q_table.qtb を生成)
+    JSON で {"workers": 8} を送ると複数プロセスで並列に学習する。{"episodes": N} で回数を変更できる
+    """
+    params = request.get_json(silent=True) or {}
+    try:
+        job_params = {"episodes": _int_param(params, "episodes", 500000)}
+        if params.get("workers") is not None:
+            job_params["workers"] = _int_param(params, "workers")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _start_training_job_response("phase1", params, job_params)
 
 @app.route("/train2", methods=["POST"])
 def train2_route():
-    """Phase2 学習モード実行"""
-    simulation_results = simulate_q_vs_q(agent, episodes=2000000)
-    agent.save("q_table2.json")
-    return jsonify({
-        "message": "Phase2 学習完了 (q_table2.json 生成)",
-        "simulation_results": simulation_results
-    })
+    """
+    Phase2 学習ジョブを起動する (完了すると q_table2.json / q_table2.qtb を生成)
+    JSON で {"mode": "batch", "batch_size": 4096} を送ると NumPy のバッチ版で学習する
+    {"workers": 8} を加えると複数プロセスで並列に学習する (batch と併用可)
+    """
+    params = request.get_json(silent=True) or {}
+    try:
+        job_params = {"episodes": _int_param(params, "episodes", 2000000)}
+        if params.get("mode") == "batch":
+            job_params.update(mode="batch", batch_size=_int_param(params, "batch_size", 4096))
+        if params.get("workers") is not None:
+            job_params["workers"] = _int_param(params, "workers")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _start_training_job_response("phase2", params, job_params)
+
+
+@app.route("/train/jobs", methods=["GET"])
+def training_jobs_route():
+    """学習ジョブの一覧"""
+    return jsonify({"jobs": list_training_jobs()})
+
+
+@app.route("/train/jobs/<job_id>", methods=["GET"])
+def training_job_route(job_id):
+    """学習ジョブの状態 (進捗エピソード数、毎秒エピソード数、ε、勝敗集計など)"""
+    job = read_training_job(job_id)
+    if job is None:
+        return jsonify({"error": "学習ジョブが見つかりません。"}), 404
+    return jsonify(job)
+
+
+@app.route("/train/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_training_job_route(job_id):
+    """学習ジョブのキャンセル (学習プロセスが次の進捗通知で中断し、Qテーブルは書き換えない)"""
+    job = cancel_training_job(job_id)
+    if job is None:
+        return jsonify({"error": "学習ジョブが見つかりません。"}), 404
+    return jsonify(job)
+
+
+def _q_table_bytes(q_table):
+    """Qテーブルのおおよそのメモリ量 (bytes)"""
+    if isinstance(q_table, CompactQTable):
+        size = memoryview(q_table.values).nbytes + memoryview(q_table.seen).nbytes
+        if q_table.visits is not None:
+            size += memoryview(q_table.visits).nbytes
+        return size
+    return sys.getsizeof(q_table) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in q_table.items())
+
+
+def _process_rss_bytes():
+    """このプロセスの常駐メモリ量 (Linux 以外は最大値で代用)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    """このワーカープロセスのメトリクス (Prometheus テキスト形式)"""
+    jobs = list_training_jobs()
+    job_counts = {}
+    for job in jobs:
+        job_counts[job["status"]] = job_counts.get(job["status"], 0) + 1
+    running = [job for job in jobs if job["status"] == "running"]
+    gauges = [
+        ("q_table_entries", "States stored in the Q-table.", [({}, len(agent.q_table))]),
+        ("q_table_bytes", "Approximate memory used by the Q-table.", [({}, _q_table_bytes(agent.q_table))]),
+        ("serving_policy_bytes", "Size of the compiled serving policy.", [({}, len(serving_policy.codes))]),
+        ("serving_policy_version", "Version of the serving policy snapshot (publish time in ms).",
+         [({"shared": str(bool(SHARED_POLICY_DIR)).lower()}, serving_policy_version)]),
+        ("process_resident_memory_bytes", "Resident memory of this worker.", [({}, _process_rss_bytes())]),
+        ("training_jobs", "Training jobs by status.",
+         [({"status": status}, count) for status, count in sorted(job_counts.items())]),
+        ("training_job_episodes_per_second", "Throughput of running training jobs.",
+         [({"job": job["id"], "kind": job["kind"]}, job["episodes_per_sec"] or 0) for job in running]),
+        ("training_job_episodes_done", "Episodes finished by running training jobs.",
+         [({"job": job["id"], "kind": job["kind"]}, job["episodes_done"]) for job in running]),
+    ]
+    if game_event_log is not None:
+        gauges.append(("game_events_logged", "Game events written to the event log by this worker.",
+                       [({"result": "written"}, game_event_log.written),
+                        ({"result": "dropped"}, game_event_log.dropped)]))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/reset_all', methods=['POST'])
@@ -0,0 +1,293 @@
+"""
+仮想プレイヤーを同時に走らせる負荷試験
+
+使い方:
+  python benchmarks/loadtest.py --spawn-workers 2                   # gunicorn -w 2 を起動して 1,2,4,...,64 人で計測
+  python benchmarks/loadtest.py --spawn-workers 4 --threads 8 --levels 8,16,32,64,128 --duration 30
+  python benchmarks/loadtest.py --url http://127.0.0.1:8000 --levels 1,4,16   # 起動済みのサーバーに対して計測
+
+仮想プレイヤーは1人1本の HTTP 接続とセッション Cookie を持ち、ブラウザを使わない以前の流れで遊ぶ:
+  /start_game → (ときどき /use_sp_card) → /hit か /stand と /ai_turn を交互に決着まで
+ポイントが尽きたら /reset_all する。同時接続数 (レベル) ごとに --duration 秒ずつ計測し、
+ゲーム数・リクエスト数の毎秒の値、ルートごとのレイテンシのパーセンタイル、エラー率を表示する。
+スループットが伸びなくなってレイテンシだけが増えるところ (ニー) も目安として示す。
+負荷をかける側もこのマシンの CPU を使うので、サーバーのワーカー数と合わせて見ること。
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED = 12345
+KNEE_GAIN = 0.10  # スループットの伸びがこれ未満になったレベルをニーとみなす
+
+
+def _percentiles(samples_ms):
+    samples = sorted(samples_ms)
+
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+    return {"count": len(samples), "mean_ms": round(sum(samples) / len(samples), 3),
+            "p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99)}
+
+
+# --- 仮想プレイヤー ---
+class VirtualPlayer:
+    """1本の HTTP 接続でゲームを繰り返すプレイヤー。結果は stats に書き込む"""
+
+    def __init__(self, host, port, stats, rng, sp_rate, hit_below, timeout=30):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.stats = stats
+        self.rng = rng
+        self.sp_rate = sp_rate
+        self.hit_below = hit_below
+        self.cookie = None
+        self.conn = None
+
+    def request(self, path, body=None):
+        """POST して (ステータス, JSON) を返す。通信エラーは stats に記録してステータス 0"""
+        headers = {"Content-Type": "application/json"}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        data = json.dumps(body).encode() if body is not None else b""
+        started = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.conn.request("POST", path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+            status = response.status
+            cookie = response.getheader("Set-Cookie")
+            if cookie:
+                self.cookie = cookie.split(";", 1)[0]
+        except (OSError, http.client.HTTPException) as e:
+            self.stats.record(path, (time.perf_counter() - started) * 1000, 0, type(e).__name__)
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            return 0, {}
+        self.stats.record(path, (time.perf_counter() - started) * 1000, status)
+        try:
+            return status, json.loads(raw) if raw else {}
+        except ValueError:
+            return status, {}
+
+    def play_game(self):
+        """1ゲーム遊ぶ。最後まで進めば True"""
+        status, state = self.request("/start_game")
+        if status != 200:
+            return False
+        cards = [card_id for card_id, count in (state.get("player_sp_cards") or {}).items() if count > 0]
+        if cards and self.rng.random() < self.sp_rate:
+            self.request("/use_sp_card", {"card_id": self.rng.choice(cards)})
+        for _ in range(40):
+            total = sum(state.get("player_hand") or [])
+            action = "hit" if total < self.hit_below and self.rng.random() < 0.9 else "stand"
+            status, state = self.request(f"/{action}")
+            if status != 200:
+                return False
+            if state.get("game_over"):
+                break
+            status, state = self.request("/ai_turn")
+            if status != 200:
+                return False
+            if state.get("game_over"):
+                break
+        else:
+            return False
+        if min(state.get("player_points", 1), state.get("ai_points", 1)) <= 0:
+            self.request("/reset_all")
+        return True
+
+    def run(self, stop):
+        while not stop.is_set():
+            if self.play_game():
+                self.stats.count_game()
+        if self.conn is not None:
+            self.conn.close()
+
+
+class LevelStats:
+    """1レベル分の計測値 (全プレイヤーのスレッドから書き込む)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.requests = {}
+        self.errors = {}
+        self.error_kinds = {}
+        self.games = 0
+
+    def record(self, path, ms, status, error=None):
+        with self._lock:
+            self.latencies.setdefault(path, []).append(ms)
+            self.requests[path] = self.requests.get(path, 0) + 1
+            if error or status >= 400:
+                self.errors[path] = self.errors.get(path, 0) + 1
+                kind = error or f"HTTP {status}"
+                self.error_kinds[kind] = self.error_kinds.get(kind, 0) + 1
+
+    def count_game(self):
+        with self._lock:
+            self.games += 1
+
+    def summary(self, seconds):
+        with self._lock:
+            return self._summary(seconds)
+
+    def _summary(self, seconds):
+        total_requests = sum(self.requests.values())
+        total_errors = sum(self.errors.values())
+        return {
+            "seconds": round(seconds, 2),
+            "games": self.games,
+            "games_per_sec": round(self.games / seconds, 2),
+            "requests_per_sec": round(total_requests / seconds, 1),
+            "error_rate": round(total_errors / total_requests, 5) if total_requests else 0.0,
+            "errors": dict(self.error_kinds),
+            "overall": _percentiles([ms for values in self.latencies.values() for ms in values])
+            if total_requests else {},
+            "routes": {path: dict(_percentiles(values), errors=self.errors.get(path, 0))
+                       for path, values in sorted(self.latencies.items())},
+        }
+
+
+def run_level(host, port, players, duration, warmup, args):
+    """players 人で warmup 秒慣らしてから duration 秒計測する"""
+    stop = threading.Event()
+    warm = LevelStats()
+    threads, virtual_players = [], []
+    for i in range(players):
+        player = VirtualPlayer(host, port, warm, random.Random(SEED * 1000 + i), args.sp_rate, args.hit_below)
+        virtual_players.append(player)
+        thread = threading.Thread(target=player.run, args=(stop,), daemon=True)
+        threads.append(thread)
+        thread.start()
+    time.sleep(warmup)
+    stats = LevelStats()
+    for player in virtual_players:
+        player.stats = stats
+    started = time.perf_counter()
+    time.sleep(duration)
+    seconds = time.perf_counter() - started
+    result = stats.summary(seconds)  # 止める前に集計する (終わりかけのゲームを含めない)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=60)
+    return result
+
+
+def find_knee(levels):
+    """スループットの伸びが KNEE_GAIN 未満になった最初のレベル (見つからなければ None)"""
+    for previous, current in zip(levels, levels[1:]):
+        if current["requests_per_sec"] < previous["requests_per_sec"] * (1 + KNEE_GAIN):
+            return previous["players"]
+    return None
+
+
+# --- サーバーの起動 ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(args):
+    """gunicorn を起動して (プロセス, ポート) を返す。ゲーム状態は一時ディレクトリの SQLite に置く"""
+    port = _free_port()
+    command = [sys.executable, "-m", "gunicorn", "-w", str(args.spawn_workers), "-b", f"127.0.0.1:{port}",
+               "--log-level", "warning"]
+    if args.threads:
+        command += ["-k", "gthread", "--threads", str(args.threads)]
+    command.append("app:app")
+    state_dir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ, GAME_STATE_BACKEND="sqlite",
+               GAME_STATE_SQLITE_PATH=os.path.join(state_dir, "game_state.sqlite3"))
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"サーバーが起動しませんでした (終了コード {process.returncode}): {' '.join(command)}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("60秒以内にサーバーが応答しませんでした。")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="起動済みのサーバーの URL (例: http://127.0.0.1:8000)")
+    target.add_argument("--spawn-workers", type=int, help="この数のワーカーで gunicorn を起動して計測する")
+    parser.add_argument("--threads", type=int, default=0, help="--spawn-workers のとき gthread のスレッド数 (0 で sync)")
+    parser.add_argument("--levels", default="1,2,4,8,16,32,64", help="同時プレイヤー数 (カンマ区切り)")
+    parser.add_argument("--duration", type=float, default=20, help="1レベルの計測秒数")
+    parser.add_argument("--warmup", type=float, default=3, help="計測前の慣らし秒数")
+    parser.add_argument("--sp-rate", type=float, default=0.3, help="ゲーム開始時に SP カードを使う確率")
+    parser.add_argument("--hit-below", type=int, default=17, help="手札の合計がこれ未満ならヒットする")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="エラー率がこれを超えたら以降のレベルを打ち切る")
+    parser.add_argument("--out", help="結果を保存する JSON")
+    args = parser.parse_args(argv)
+
+    levels = [int(value) for value in args.levels.split(",") if value.strip()]
+    process = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+        server = args.url
+    else:
+        process, port = spawn_server(args)
+        host = "127.0.0.1"
+        kind = f"gthread x{args.threads}" if args.threads else "sync"
+        server = f"gunicorn -w {args.spawn_workers} ({kind})"
+
+    results = []
+    try:
+        print(f"対象: {server}  計測 {args.duration:g}秒/レベル")
+        print(f"{'players':>8} {'games/s':>9} {'req/s':>9} {'errors':>8} {'p50 ms':>9} {'p99 ms':>9}")
+        for players in levels:
+            result = run_level(host, port, players, args.duration, args.warmup, args)
+            result["players"] = players
+            results.append(result)
+            p50 = result["overall"].get("p50_ms", 0)
+            p99 = result["overall"].get("p99_ms", 0)
+            print(f"{players:>8} {result['games_per_sec']:>9} {result['requests_per_sec']:>9} "
+                  f"{result['error_rate']:>8.2%} {p50:>9} {p99:>9}")
+            if result["error_rate"] > args.max_error_rate:
+                print(f"  エラー率が {args.max_error_rate:.0%} を超えたので打ち切ります: {result['errors']}")
+                break
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    if results:
+        print("\nルートごとのレイテンシ (最後のレベル):")
+        for path, route in results[-1]["routes"].items():
+            print(f"  {path:14s} n={route['count']:>7} p50={route['p50_ms']:>8} p90={route['p90_ms']:>8} "
+                  f"p99={route['p99_ms']:>8} errors={route['errors']}")
+    knee = find_knee(results)
+    if knee is not None:
+        print(f"\nスループットは {knee} 人あたりで頭打ちになりました (次のレベルで +{KNEE_GAIN:.0%} 未満)。")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"server": server, "duration": args.duration, "knee_players": knee, "levels": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"{args.out} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
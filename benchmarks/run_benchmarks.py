@@ -0,0 +1,228 @@
+"""
+ゲームエンジン・学習・APIルートのベンチマーク
+
+使い方:
+  python benchmarks/run_benchmarks.py                      # 計測して benchmarks/baselines/<リビジョン>.json に保存
+  python benchmarks/run_benchmarks.py --quick --only micro  # 回数を減らして一部だけ計測
+  python benchmarks/run_benchmarks.py --compare benchmarks/baselines/abc1234.json
+
+計測内容:
+  micro    : get_state / choose_action / learn / judge / calculate_expected_value / should_ai_draw など 1回あたりの ns
+  training : train_phase1 / simulate_q_vs_q (/ simulate_q_vs_q_batch) の毎秒エピソード数 (同じシードの乱数ストリーム)
+  routes   : Flask のテストクライアントで1ゲームずつ進めたときの各ルートのレイテンシ (ms) のパーセンタイル
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(REPO_ROOT, "benchmarks", "baselines")
+SEED = 12345
+
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)  # app は起動時にカレントディレクトリの Qテーブルを読み込む
+with contextlib.redirect_stdout(open(os.devnull, "w")):
+    import app  # noqa: E402
+
+
+# --- 計測の補助 ---
+def _quiet():
+    """ルートや学習関数のデバッグ出力を捨てる"""
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+def _ns_per_op(func, args, number, repeat=5):
+    """func(*args) を number 回呼んだときの1回あたりの時間 (ns, repeat 回の最小値)"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in range(number):
+            func(*args)
+        elapsed = (time.perf_counter_ns() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 1)
+
+
+def _percentiles(samples_ms):
+    samples = sorted(samples_ms)
+
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+    return {"count": len(samples), "mean_ms": round(sum(samples) / len(samples), 3),
+            "p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99)}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# --- micro: ホットパスの関数単体 ---
+def bench_micro(quick):
+    number = 20000 if quick else 100000
+    random.seed(SEED)
+    deck = [1, 3, 4, 6, 9, 10, 11]
+    hand = [7, 8]
+    results = {}
+    for storage in ("compact", "dict"):
+        agent = app.QLearningAgent(storage=storage)
+        state = agent.get_state(15, 5, deck)
+        next_state = agent.get_state(18, 5, deck[1:])
+        agent.learn(state, "hit", 0.2, next_state)
+        results[f"get_state[{storage}]"] = _ns_per_op(agent.get_state, (15, 5, deck), number)
+        results[f"choose_action[{storage}]"] = _ns_per_op(agent.choose_action, (state, 15), number)
+        results[f"learn[{storage}]"] = _ns_per_op(agent.learn, (state, "hit", 0.2, next_state), number)
+    results["judge"] = _ns_per_op(app.judge, (18, 20), number)
+    results["calculate_expected_value"] = _ns_per_op(app.calculate_expected_value, (hand, deck), number)
+    results["should_ai_draw"] = _ns_per_op(app.should_ai_draw, (hand, [9], deck), number)
+    results["should_ai_draw_first_turn"] = _ns_per_op(app.should_ai_draw_first_turn, ([8], [9], deck), number)
+    results["FrozenPolicy.decide"] = _ns_per_op(app.serving_policy.decide, (15, 5, deck), number)
+    results["shuffle_deck"] = _ns_per_op(app.shuffle_deck, (random.Random(SEED),), number)
+    bit_deck = app.BitDeck(deck)
+    results["get_state[compact, BitDeck]"] = _ns_per_op(app.QLearningAgent().get_state, (15, 5, bit_deck), number)
+    results["BitDeck.draw+add"] = _ns_per_op(lambda rng: bit_deck.add(bit_deck.draw(rng)), (random.Random(SEED),),
+                                             number)
+    return {name: {"ns_per_op": value} for name, value in results.items()}
+
+
+# --- training: 学習関数のスループット ---
+def bench_training(quick):
+    scale = 4 if quick else 1
+    def streams():
+        return {"rng": app.rng_stream(SEED, "actions")}
+
+    cases = [
+        ("train_phase1", lambda agent, n: app.train_phase1(agent, episodes=n, save_path=None, log_every=0,
+                                                           **streams()), 20000 // scale),
+        ("simulate_q_vs_q", lambda agent, n: app.simulate_q_vs_q(agent, episodes=n, log_every=0, **streams()),
+         20000 // scale),
+    ]
+    if app.np is not None:
+        cases.append(("simulate_q_vs_q_batch",
+                      lambda agent, n: app.simulate_q_vs_q_batch(agent, episodes=n, seed=SEED, log_every=0),
+                      200000 // scale))
+    results = {}
+    for name, run, episodes in cases:
+        agent = app.QLearningAgent()
+        started = time.perf_counter()
+        with _quiet():
+            run(agent, episodes)
+        seconds = time.perf_counter() - started
+        results[name] = {"episodes": episodes, "seconds": round(seconds, 3),
+                         "episodes_per_sec": round(episodes / seconds, 1)}
+    return results
+
+
+# --- routes: テストクライアント経由のレイテンシ ---
+def bench_routes(quick):
+    games = 50 if quick else 200
+    app.game_rng.seed(SEED)
+    client = app.app.test_client()
+    samples = {}
+
+    def post(path, **kwargs):
+        started = time.perf_counter()
+        response = client.post(path, **kwargs)
+        samples.setdefault(path, []).append((time.perf_counter() - started) * 1000)
+        return response.get_json() or {}
+
+    with _quiet():
+        for game in range(games):
+            if game % 20 == 0:
+                client.post("/reset_all")  # ポイントが尽きないように定期的にリセット (計測しない)
+            state = post("/start_game")
+            post("/use_sp_card", json={"card_id": app.INITIAL_PLAYER_SP_CARD_ID})
+            # 偶数ゲームは /hit・/stand + /ai_turn、奇数ゲームは /turn で進める
+            for _ in range(30):
+                action = "hit" if sum(state.get("player_hand") or []) < 17 else "stand"
+                if game % 2 == 0:
+                    post(f"/{action}")
+                    state = post("/ai_turn")
+                else:
+                    state = post("/turn", json={"action": action}).get("ai") or {}
+                if state.get("game_over"):
+                    break
+    return {path: _percentiles(values) for path, values in samples.items()}
+
+
+SECTIONS = {"micro": bench_micro, "training": bench_training, "routes": bench_routes}
+# 値が大きいほど良い指標 (それ以外は小さいほど良い)
+HIGHER_IS_BETTER = {"episodes_per_sec"}
+COMPARED_METRICS = ("ns_per_op", "episodes_per_sec", "p50_ms", "p90_ms", "p99_ms")
+
+
+def compare(baseline, current, threshold):
+    """baseline と current を比べて表を表示し、悪化した指標の数を返す"""
+    regressions = 0
+    print(f"\n比較: {baseline['meta']['revision']} → {current['meta']['revision']} (悪化の閾値 {threshold:.0%})")
+    for section in SECTIONS:
+        for name, metrics in current.get(section, {}).items():
+            old_metrics = baseline.get(section, {}).get(name)
+            if not old_metrics:
+                continue
+            for metric in COMPARED_METRICS:
+                if metric not in metrics or not old_metrics.get(metric):
+                    continue
+                old, new = old_metrics[metric], metrics[metric]
+                change = new / old - 1
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                flag = "  悪化" if worse > threshold else ""
+                regressions += bool(flag)
+                print(f"  {section:8s} {name:32s} {metric:16s} {old:>12} → {new:>12} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=",".join(SECTIONS), help="計測するセクション (カンマ区切り)")
+    parser.add_argument("--quick", action="store_true", help="回数を減らして短時間で計測する")
+    parser.add_argument("--save", help="結果の保存先 (省略時は benchmarks/baselines/<リビジョン>.json)")
+    parser.add_argument("--no-save", action="store_true", help="結果を保存しない")
+    parser.add_argument("--compare", help="比較するベースラインの JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="悪化とみなす変化率 (既定 0.10)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="悪化した指標があれば終了コード 1")
+    args = parser.parse_args(argv)
+
+    sections = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"未知のセクションです: {', '.join(sorted(unknown))}")
+
+    result = {"meta": {
+        "revision": _git_revision(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "numpy": getattr(app.np, "__version__", None), "quick": args.quick, "seed": SEED,
+    }}
+    for name in sections:
+        started = time.perf_counter()
+        result[name] = SECTIONS[name](args.quick)
+        print(f"[{name}] {time.perf_counter() - started:.1f}秒")
+        print(json.dumps(result[name], ensure_ascii=False, indent=2))
+
+    if not args.no_save:
+        path = args.save or os.path.join(BASELINE_DIR, f"{result['meta']['revision']}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"{path} に保存しました。")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, result, args.threshold)
+        print(f"悪化した指標: {regressions}")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+静的アセットのビルド
+
+使い方:
+  python build_assets.py            # static/dist/ にスプライトシート・指紋付きファイル・manifest.json を出力
+  python build_assets.py --clean    # 新しい manifest にない古いファイルも消す
+  python build_assets.py --dev-css  # ビルドしないとき用の static/css/images.css (個別の画像を参照) を作り直す
+
+出力:
+  images/cards.png, images/buttons.png : カードとボタンの画像を1枚にまとめたスプライトシート
+  css/images.css                       : 各画像のクラス (.card-N, .sprite-*) をシートの位置で定義した CSS
+  css/style.css, js/script.js          : そのままコピー
+ファイル名には内容のハッシュを付ける (例: dist/script.3f9a1c2b7d.js) ので、アプリは1年の immutable で配信できる。
+CSS・JS は .gz も作り、gzip を受け付けるクライアントにはそれを返す。
+PNG の読み書きは標準ライブラリだけで行う (8bit RGB/RGBA、インターレースなしの PNG のみ対応)。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(REPO_ROOT, "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+DEV_CSS_PATH = os.path.join(STATIC_DIR, "css", "images.css")
+
+# シート名 → (並べ方, [(CSS セレクタ, 画像ファイル, 要素の縦横比を画像に合わせるか)])
+# カードは .card の枠 (130x180) いっぱいに引き伸ばし、ボタンは幅だけ CSS で決めて高さは縦横比から決める。
+SPRITE_SHEETS = {
+    "cards": ("row", [(f".card-{n}", "card_unknown.png" if n == 0 else f"card_{n}.png", False)
+                      for n in range(12)]),
+    "buttons": ("column", [
+        (f"{prefix}.sprite-{name}", f"{name}_button{suffix}.png", True)
+        for name in ("play", "end", "hit", "stand", "next_game")
+        for prefix, suffix in (("", ""), ("body.dark-mode ", "_dark"))
+    ]),
+}
+COPIED_ASSETS = ("css/style.css", "js/script.js")
+PRECOMPRESSED_TYPES = (".css", ".js")
+SPRITE_PADDING = 2  # 拡大縮小したときに隣の画像がにじまないように空ける余白 (px)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+CSS_HEADER = ".sprite { display: inline-block; background-repeat: no-repeat; vertical-align: middle; }\n"
+
+
+# --- PNG の読み書き ---
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def read_png(path):
+    """PNG を読み込んで (幅, 高さ, RGBA のバイト列) を返す"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError(f"{path} は PNG ではありません。")
+    pos, idat = len(PNG_SIGNATURE), []
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if kind == b"IHDR":
+            width, height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", body)
+            if depth != 8 or color not in (2, 6) or interlace:
+                raise ValueError(f"{path}: 8bit RGB/RGBA、インターレースなしの PNG のみ対応しています。")
+        elif kind == b"IDAT":
+            idat.append(body)
+        elif kind == b"IEND":
+            break
+        pos += 12 + length
+    bpp = 4 if color == 6 else 3
+    stride = width * bpp
+    raw = zlib.decompress(b"".join(idat))
+    prev = bytearray(stride)
+    rows = []
+    for y in range(height):
+        start = y * (stride + 1)
+        kind, line = raw[start], bytearray(raw[start + 1:start + 1 + stride])
+        if kind == 1:
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xFF
+        elif kind == 2:
+            line = bytearray((x + p) & 0xFF for x, p in zip(line, prev))
+        elif kind == 3:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prev[i]) >> 1)) & 0xFF
+        elif kind == 4:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                upper_left = prev[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + _paeth(left, prev[i], upper_left)) & 0xFF
+        rows.append(line)
+        prev = line
+    pixels = b"".join(rows)
+    if bpp == 3:
+        rgba = bytearray(width * height * 4)
+        rgba[0::4], rgba[1::4], rgba[2::4] = pixels[0::3], pixels[1::3], pixels[2::3]
+        rgba[3::4] = b"\xff" * (width * height)
+        pixels = bytes(rgba)
+    return width, height, pixels
+
+
+def encode_png(width, height, rgba):
+    """RGBA のバイト列を PNG にする (不透明なら RGB で保存する)。各行は None/Sub/Up のうち小さくなりそうなフィルタを使う"""
+    opaque = rgba[3::4] == b"\xff" * (width * height)
+    bpp = 3 if opaque else 4
+    if opaque:
+        rgb = bytearray(width * height * 3)
+        rgb[0::3], rgb[1::3], rgb[2::3] = rgba[0::4], rgba[1::4], rgba[2::4]
+        pixels = bytes(rgb)
+    else:
+        pixels = rgba
+    stride = width * bpp
+    prev = bytes(stride)
+    out = []
+    for y in range(height):
+        line = pixels[y * stride:(y + 1) * stride]
+        candidates = (
+            (0, line),
+            (1, line[:bpp] + bytes((x - l) & 0xFF for x, l in zip(line[bpp:], line))),
+            (2, bytes((x - p) & 0xFF for x, p in zip(line, prev))),
+        )
+        # 符号付きの絶対値の和が最小のフィルタを選ぶ (PNG 仕様の推奨する簡易ヒューリスティック)
+        kind, filtered = min(candidates, key=lambda c: sum(v if v < 128 else 256 - v for v in c[1]))
+        out.append(bytes((kind,)) + filtered)
+        prev = line
+
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2 if opaque else 6, 0, 0, 0)
+    return (PNG_SIGNATURE + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(out), 9))
+            + chunk(b"IEND", b""))
+
+
+# --- スプライトシート ---
+def build_sheet(layout, files):
+    """画像を横 (row) または縦 (column) に並べ、(幅, 高さ, RGBA, [(x, y, w, h)]) を返す"""
+    images = [read_png(os.path.join(STATIC_DIR, "images", name)) for name in files]
+    if layout == "row":
+        width = sum(w for w, _, _ in images) + SPRITE_PADDING * (len(images) - 1)
+        height = max(h for _, h, _ in images)
+    else:
+        width = max(w for w, _, _ in images)
+        height = sum(h for _, h, _ in images) + SPRITE_PADDING * (len(images) - 1)
+    sheet = bytearray(width * height * 4)
+    rects, x, y = [], 0, 0
+    for w, h, pixels in images:
+        for row in range(h):
+            offset = ((y + row) * width + x) * 4
+            sheet[offset:offset + w * 4] = pixels[row * w * 4:(row + 1) * w * 4]
+        rects.append((x, y, w, h))
+        if layout == "row":
+            x += w + SPRITE_PADDING
+        else:
+            y += h + SPRITE_PADDING
+    return width, height, bytes(sheet), rects
+
+
+def _percent(value):
+    return f"{value:.4f}".rstrip("0").rstrip(".") + "%"
+
+
+def sprite_rule(selector, url, sheet_size, rect, keep_ratio):
+    """シートの rect の部分を要素いっぱいに表示する CSS ルール"""
+    sheet_w, sheet_h = sheet_size
+    x, y, w, h = rect
+    pos_x = x / (sheet_w - w) * 100 if sheet_w > w else 0
+    pos_y = y / (sheet_h - h) * 100 if sheet_h > h else 0
+    declarations = [f"background-image: url({url})",
+                    f"background-size: {_percent(sheet_w / w * 100)} {_percent(sheet_h / h * 100)}",
+                    f"background-position: {_percent(pos_x)} {_percent(pos_y)}"]
+    if keep_ratio:
+        declarations.append(f"aspect-ratio: {w} / {h}")
+    return f"{selector} {{ {'; '.join(declarations)}; }}\n"
+
+
+def dev_css():
+    """個別の画像を参照する images.css (ビルドしないときに使う)"""
+    lines = ["/* build_assets.py --dev-css で生成。ビルド後は static/dist/ のスプライト版に置き換わる */\n", CSS_HEADER]
+    for _, entries in SPRITE_SHEETS.values():
+        for selector, name, keep_ratio in entries:
+            w, h, _ = read_png(os.path.join(STATIC_DIR, "images", name))
+            lines.append(sprite_rule(selector, f"../images/{name}", (w, h), (0, 0, w, h), keep_ratio))
+    return "".join(lines)
+
+
+# --- 出力 ---
+def fingerprinted_name(logical_name, data):
+    stem, ext = os.path.splitext(os.path.basename(logical_name))
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def write_asset(logical_name, data, assets):
+    """内容のハッシュ付きの名前で dist に書き出し、manifest の対応表に追加する"""
+    name = fingerprinted_name(logical_name, data)
+    path = os.path.join(DIST_DIR, name)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    if name.endswith(PRECOMPRESSED_TYPES) and not os.path.exists(path + ".gz"):
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    assets[logical_name] = f"dist/{name}"
+    return name
+
+
+def build(clean=False):
+    os.makedirs(DIST_DIR, exist_ok=True)
+    assets, preload = {}, []
+    css = [CSS_HEADER]
+    for sheet_name, (layout, entries) in SPRITE_SHEETS.items():
+        width, height, rgba, rects = build_sheet(layout, [name for _, name, _ in entries])
+        logical_name = f"images/{sheet_name}.png"
+        name = write_asset(logical_name, encode_png(width, height, rgba), assets)
+        preload.append(logical_name)
+        for (selector, _, keep_ratio), rect in zip(entries, rects):
+            css.append(sprite_rule(selector, name, (width, height), rect, keep_ratio))
+    write_asset("css/images.css", "".join(css).encode("utf-8"), assets)
+    for logical_name in COPIED_ASSETS:
+        with open(os.path.join(STATIC_DIR, logical_name), "rb") as f:
+            write_asset(logical_name, f.read(), assets)
+
+    # manifest は最後に置き換える (書き出し途中のファイルを参照させない)
+    manifest_path = os.path.join(DIST_DIR, "manifest.json")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"assets": assets, "preload": preload}, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    if clean:
+        keep = {os.path.basename(path) for path in assets.values()} | {"manifest.json"}
+        for name in os.listdir(DIST_DIR):
+            if name not in keep and name.removesuffix(".gz") not in keep:
+                os.remove(os.path.join(DIST_DIR, name))
+    return assets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clean", action="store_true", help="manifest にない古いファイルを dist から消す")
+    parser.add_argument("--dev-css", action="store_true", help="static/css/images.css を作り直す")
+    args = parser.parse_args(argv)
+
+    if args.dev_css:
+        with open(DEV_CSS_PATH, "w", encoding="utf-8") as f:
+            f.write(dev_css())
+        print(f"{DEV_CSS_PATH} に書き出しました。")
+        return
+    for logical_name, path in build(clean=args.clean).items():
+        size = os.path.getsize(os.path.join(STATIC_DIR, path))
+        print(f"  {logical_name:20s} → static/{path} ({size:,} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+gunicorn の設定 (gunicorn -c gunicorn.conf.py app:app で使う)
+
+起動時にマスターが配信方策を共有メモリ (SHARED_POLICY_DIR、既定 /dev/shm/blackjack-policy) に
+1度だけ公開し、各ワーカーは自分でQテーブルを読み込まずにそれを読み取り専用で mmap する。
+マスターで app を import するとワーカーに SQLite の接続などが引き継がれてしまうので、公開は別プロセスで行う。
+"""
+import os
+import subprocess
+import sys
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+if os.environ.get("GAME_EVENTS") == "1":
+    # /events のストリームは接続している間ずっと待つので、スレッドを占有しない gevent で受ける (pip install gevent)
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", "1000"))
+else:
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+os.environ.setdefault("SHARED_POLICY_DIR", "/dev/shm/blackjack-policy")
+os.environ.setdefault("GAME_STATE_BACKEND", "sqlite")
+os.environ.setdefault("EVENT_LOG_DIR", "game_logs")
+
+
+def on_starting(server):
+    """ワーカーを起動する前に、配信方策を共有メモリに公開する"""
+    subprocess.run([sys.executable, "manage.py", "publish-policy"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                   check=True)
@@ -0,0 +1,331 @@
+"""
+学習・運用向けのコマンドラインツール (Webサーバーを起動せずに app.py の機能を使う)
+
+使い方:
+  python manage.py solve --opponent omega --out q_table_exact.json
+  python manage.py solve --opponent q --q-table q_table2.json --compare q_table2.json
+  python manage.py convert q_table2.json q_table2.qtb
+  python manage.py train phase2 --episodes 2000000 --mode batch --checkpoint-dir ckpt_phase2
+  python manage.py resume ckpt_phase2 --out q_table2.qtb
+  python manage.py compact ckpt_phase2
+  python manage.py evaluate q_table2.qtb --opponent omega --precision 0.002
+  python manage.py evaluate q_table2.qtb --opponent q --opponent-table q_table.qtb
+  python manage.py sweep --alpha 0.05,0.1,0.2 --gamma 0.9,0.95 --episodes 200000 --out q_table_sweep.qtb
+  python manage.py sweep --search random --trials 40 --alpha 0.02:0.3 --epsilon-decay 0.9999:0.999995
+  python manage.py publish-policy --dir /dev/shm/blackjack-policy
+  python manage.py log-stats game_logs
+  python manage.py offline-train game_logs --q-table q_table2.qtb --epochs 4 --out q_table_offline.qtb
+"""
+import argparse
+import json
+import random
+import time
+
+import app
+
+
+def _load_agent(path):
+    """Qテーブルファイルを読み込んだ QLearningAgent を返す"""
+    agent = app.QLearningAgent()
+    agent.load(path)
+    return agent
+
+
+def cmd_solve(args):
+    """厳密解ソルバーで最適方策を求め、Qテーブルとして保存する"""
+    q_table = _load_agent(args.q_table).q_table if args.opponent == "q" else None
+    started = time.perf_counter()
+    solver, table, expected = app.solve_exact_policy(args.opponent, q_table=q_table, deal=args.deal)
+    elapsed = time.perf_counter() - started
+    print(f"状態数: {len(solver.action_values)}, Qテーブルの状態数: {len(table)}, 計算時間: {elapsed:.1f}秒")
+    print(f"最適方策の期待値 (勝ち1/引き分け0/負け-1): {expected:.6f}")
+    print(f"保存したテーブルの greedy 方策の期待値: {solver.policy_value(table):.6f}")
+    for path in args.compare or []:
+        print(f"{path} の greedy 方策の期待値: {solver.policy_value(_load_agent(path).q_table):.6f}")
+    if args.out:
+        agent = app.QLearningAgent()
+        agent.q_table = table
+        agent.save(args.out)
+        print(f"{args.out} に保存しました。")
+
+
+def cmd_convert(args):
+    """Qテーブルを JSON ⇔ バイナリ形式 (.qtb) で変換する"""
+    started = time.perf_counter()
+    count = app.convert_q_table(args.src, args.dst)
+    print(f"{args.src} → {args.dst} ({count} 状態, {time.perf_counter() - started:.2f}秒)")
+
+
+def _save_trained(agent, results, out, started):
+    print(f"学習時間: {time.perf_counter() - started:.1f}秒, ε: {agent.epsilon:.4f}, 勝敗: {results}")
+    if out:
+        agent.save(out)
+        print(f"{out} に保存しました。")
+
+
+def cmd_train(args):
+    """チェックポイントを取りながら学習する (Ctrl+C で中断しても resume で続きから再開できる)"""
+    agent = _load_agent(args.q_table) if args.q_table else app.QLearningAgent()
+    params = {"episodes": args.episodes}
+    if args.workers:
+        params["workers"] = args.workers
+    if args.mode == "batch":
+        params.update(mode="batch", batch_size=args.batch_size)
+    if args.seed is not None:
+        params["seed"] = args.seed
+    started = time.perf_counter()
+    try:
+        agent, results = app.run_checkpointed_training(agent, args.kind, params, args.checkpoint_dir,
+                                                       every=args.checkpoint_every, log_every=args.log_every)
+    except KeyboardInterrupt:
+        print(f"中断しました。python manage.py resume {args.checkpoint_dir} で再開できます。")
+        return
+    _save_trained(agent, results, args.out, started)
+
+
+def cmd_resume(args):
+    """チェックポイントから学習を再開する"""
+    manifest, _ = app.load_checkpoint(args.checkpoint_dir)
+    print(f"{manifest['kind']}: {manifest['episodes_done']}/{manifest['episodes']} エピソードから再開します。")
+    started = time.perf_counter()
+    agent, results = app.run_checkpointed_training(None, None, None, args.checkpoint_dir, resume=True,
+                                                   every=args.checkpoint_every, log_every=args.log_every)
+    _save_trained(agent, results, args.out, started)
+
+
+def cmd_compact(args):
+    """チェックポイントのデルタを1つの base にまとめる"""
+    merged = app.compact_checkpoint(args.checkpoint_dir)
+    print(f"{merged} 個のデルタをまとめました。")
+
+
+def _format_evaluation(summary):
+    lines = []
+    for key, label in (("win", "勝ち"), ("draw", "引き分け"), ("loss", "負け")):
+        rate = summary[key]
+        lines.append(f"  {label}: {rate['rate']:.4%} [{rate['low']:.4%}, {rate['high']:.4%}] ({rate['count']})")
+    score = summary["score"]
+    lines.append(f"  得点 (勝ち1/引き分け0/負け-1): {score['mean']:+.5f} [{score['low']:+.5f}, {score['high']:+.5f}]")
+    return "\n".join(lines)
+
+
+def cmd_evaluate(args):
+    """Qテーブルの greedy 方策を学習・探索なしで対戦させ、勝率を信頼区間付きで表示する"""
+    policy = app.FrozenPolicy.compile(_load_agent(args.q_table).q_table)
+    opponent_policy = None
+    if args.opponent == "q":
+        opponent_policy = app.FrozenPolicy.compile(_load_agent(args.opponent_table).q_table)
+
+    def progress(summary):
+        print(f"{summary['games']} ゲーム, 区間の半幅: {summary['half_width']:.5f}, 得点: {summary['score']['mean']:+.5f}")
+
+    summary = app.evaluate_policy(policy, args.opponent, opponent_policy, max_games=args.games,
+                                  precision=args.precision, confidence=args.confidence, workers=args.workers,
+                                  seed=args.seed, alternate_seats=args.alternate_seats,
+                                  progress=progress if args.verbose else None)
+    seats = "先手・後手を交互" if summary["alternate_seats"] else "常に先手"
+    print(f"{args.q_table} vs {args.opponent_table if args.opponent == 'q' else args.opponent} ({seats}): "
+          f"{summary['games']} ゲーム ({summary['seconds']:.1f}秒, {summary['games_per_sec']:.0f} ゲーム/秒"
+          f"{', 精度に達したので打ち切り' if summary['stopped_early'] else ''}), 信頼度 {summary['confidence']:.0%}")
+    print(_format_evaluation(summary))
+
+
+def _sweep_values(text, search):
+    """"0.1,0.2" → [0.1, 0.2]。random 探索では "0.05:0.3" を一様分布の範囲 (0.05, 0.3) とする"""
+    if search == "random" and ":" in text:
+        low, high = text.split(":")
+        return float(low), float(high)
+    return [float(value) for value in text.split(",")]
+
+
+def cmd_sweep(args):
+    """QLearningAgent のハイパーパラメータをグリッド/ランダム探索する"""
+    space = {name: _sweep_values(getattr(args, name), args.search)
+             for name in app.SWEEP_PARAMETERS if getattr(args, name)}
+    configs = app.sweep_configs(space, args.search, args.trials, random.Random(args.seed))
+    params = {"episodes": args.episodes}
+    if args.mode == "batch":
+        params.update(mode="batch", batch_size=args.batch_size)
+    opponent_policy = None
+    if args.opponent == "q":
+        opponent_policy = app.FrozenPolicy.compile(_load_agent(args.opponent_table).q_table)
+    print(f"{len(configs)} 試行 ({args.search}), 1試行 {args.episodes} エピソード + 評価 {args.eval_games} ゲーム")
+
+    def progress(row):
+        print(f"試行 {row['trial']}: 得点 {row['score']:+.4f} ({row['seconds']:.0f}秒) "
+              + ", ".join(f"{name}={row[name]:g}" for name in space))
+
+    started = time.perf_counter()
+    rows = app.run_sweep(configs, args.out_dir, kind=args.kind, params=params, start_table=args.q_table,
+                         eval_games=args.eval_games, opponent=args.opponent, opponent_policy=opponent_policy,
+                         workers=args.workers, seed=args.seed, progress=progress)
+    print(f"\n所要時間: {time.perf_counter() - started:.0f}秒 (結果: {args.out_dir}/results.json)")
+    columns = ["trial", *space, "score", "score_low", "score_high", "win_rate", "draw_rate", "loss_rate"]
+    widths = [max(11, len(column)) for column in columns]
+    print("  ".join(f"{column:>{width}s}" for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(f"{row[column]:>{width}.5g}" for column, width in zip(columns, widths)))
+    if rows and args.out:
+        _load_agent(f"{args.out_dir}/best.qtb").save(args.out)
+        print(f"最良の試行 {rows[0]['trial']} のQテーブルを {args.out} に保存しました。")
+
+
+def cmd_publish_policy(args):
+    """Qテーブルから配信方策を作り、共有メモリに公開する (起動中のワーカーは次のリクエストで切り替わる)"""
+    directory = args.dir or app.SHARED_POLICY_DIR
+    if not directory:
+        raise SystemExit("--dir か環境変数 SHARED_POLICY_DIR で公開先を指定してください。")
+    agent = app.QLearningAgent()
+    if args.q_table:
+        if not agent.load(args.q_table):
+            raise SystemExit(f"{args.q_table} を読み込めませんでした。")
+    else:
+        app.load_latest_q_table(agent)
+    version = app.publish_shared_policy(app.FrozenPolicy.compile(agent.q_table), directory)
+    print(f"{directory} に配信方策 (版 {version}, {len(agent.q_table)} 状態) を公開しました。")
+
+
+def cmd_log_stats(args):
+    """ゲームのイベントログを1回なめて、勝率・ゲームの長さ・SPカードの効果を集計する"""
+    started = time.perf_counter()
+    summary = app.summarize_game_events(app.read_game_event_log(args.paths), confidence=args.confidence)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return
+    player = summary["player"]
+    print(f"{summary['events']} イベント, {summary['games']} ゲーム (放棄 {summary['abandoned']}), "
+          f"{time.perf_counter() - started:.1f}秒")
+    print(f"  プレイヤーの勝率: {player['win_rate']:.2%} [{player['low']:.2%}, {player['high']:.2%}] "
+          f"(勝ち {player['wins']} / 引き分け {player['draws']} / 負け {player['losses']})")
+    print(f"  1ゲームの平均: {summary['average_turns']:.2f} ターン, {summary['average_seconds']:.1f}秒")
+    print(f"  AIの行動: {summary['ai_actions']}")
+    for key, stats in summary["sp_cards"].items():
+        print(f"  {key}: {stats['used']} 回, 使った側の勝率 {stats['win_rate']:.2%}, "
+              f"効果が出た割合 {stats['effect_rate']:.2%}")
+
+
+def cmd_offline_train(args):
+    """イベントログに記録された実際の対戦の遷移から、シミュレーションせずにまとめてQ学習する"""
+    agent = _load_agent(args.q_table) if args.q_table else app.QLearningAgent()
+    agent.alpha, agent.gamma = args.alpha, args.gamma
+    started = time.perf_counter()
+    transitions = app.load_logged_transitions(args.paths)
+    count = len(transitions[0])
+    print(f"{count} 件の遷移を読み込みました ({time.perf_counter() - started:.1f}秒)")
+    if not count:
+        raise SystemExit("学習に使える AI の行動がログにありません (EVENT_LOG_DIR を設定して記録してください)。")
+    started = time.perf_counter()
+    summary = app.train_offline(agent, transitions, epochs=args.epochs, batch_size=args.batch_size, seed=args.seed)
+    seconds = time.perf_counter() - started
+    print(f"学習時間: {seconds:.1f}秒 ({count * args.epochs / seconds:.0f} 遷移/秒), "
+          f"TD誤差の平均: {summary['td_error'][0]:.5f} → {summary['td_error'][-1]:.5f}, 状態数: {len(agent.q_table)}")
+    agent.save(args.out)
+    print(f"{args.out} に保存しました。")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    solve = subparsers.add_parser("solve", help="固定した相手方策に対する最適方策を厳密に計算する")
+    solve.add_argument("--opponent", choices=["omega", "q"], default="omega",
+                       help="相手方策 (omega: OmegaAI, q: --q-table の greedy 方策)")
+    solve.add_argument("--q-table", default="q_table2.json", help="opponent=q で使うQテーブル")
+    solve.add_argument("--deal", type=int, choices=[1, 2], help="初期手札の枚数 (省略時は omega=1, q=2)")
+    solve.add_argument("--out", default="q_table_exact.json", help="結果のQテーブルの保存先")
+    solve.add_argument("--compare", nargs="*", help="最適方策と期待値を比較するQテーブル")
+    solve.set_defaults(func=cmd_solve)
+
+    convert = subparsers.add_parser("convert", help="Qテーブルを JSON ⇔ バイナリ形式 (.qtb) で変換する")
+    convert.add_argument("src", help="変換元 (q_table2.json など)")
+    convert.add_argument("dst", help="変換先 (拡張子 .qtb ならバイナリ形式、それ以外は JSON)")
+    convert.set_defaults(func=cmd_convert)
+
+    train = subparsers.add_parser("train", help="チェックポイントを取りながら学習する")
+    train.add_argument("kind", choices=["phase1", "phase2"], help="phase1: OmegaAI と対戦, phase2: 自己対戦")
+    train.add_argument("--episodes", type=int, default=500000)
+    train.add_argument("--workers", type=int, help="並列学習のプロセス数")
+    train.add_argument("--mode", choices=["batch"], help="batch: NumPy のバッチ学習 (phase2)")
+    train.add_argument("--batch-size", type=int, default=4096)
+    train.add_argument("--q-table", help="学習を始めるQテーブル (省略時は空のテーブル)")
+    train.add_argument("--seed", type=int, help="乱数シード (同じシード・設定なら同じQテーブルになる)")
+    train.add_argument("--checkpoint-dir", required=True, help="チェックポイントの保存先ディレクトリ")
+    train.add_argument("--checkpoint-every", type=int, default=app.CHECKPOINT_EVERY, help="チェックポイントの間隔")
+    train.add_argument("--log-every", type=int, default=10000, help="進捗を表示する間隔 (0 で表示しない)")
+    train.add_argument("--out", help="学習後のQテーブルの保存先")
+    train.set_defaults(func=cmd_train)
+
+    resume = subparsers.add_parser("resume", help="チェックポイントから学習を再開する")
+    resume.add_argument("checkpoint_dir", help="train の --checkpoint-dir、または学習ジョブの <id>.ckpt")
+    resume.add_argument("--checkpoint-every", type=int, default=app.CHECKPOINT_EVERY, help="チェックポイントの間隔")
+    resume.add_argument("--log-every", type=int, default=10000, help="進捗を表示する間隔 (0 で表示しない)")
+    resume.add_argument("--out", help="学習後のQテーブルの保存先")
+    resume.set_defaults(func=cmd_resume)
+
+    compact = subparsers.add_parser("compact", help="チェックポイントのデルタを base にまとめる")
+    compact.add_argument("checkpoint_dir")
+    compact.set_defaults(func=cmd_compact)
+
+    evaluate = subparsers.add_parser("evaluate", help="Qテーブルの方策を評価する (勝率と信頼区間)")
+    evaluate.add_argument("q_table", help="評価するQテーブル")
+    evaluate.add_argument("--opponent", choices=app.EVALUATION_OPPONENTS, default="omega",
+                          help="対戦相手 (omega: OmegaAI, self: 同じ方策, q: --opponent-table の方策)")
+    evaluate.add_argument("--opponent-table", default="q_table.json", help="opponent=q で使うQテーブル")
+    evaluate.add_argument("--games", type=int, default=1000000, help="最大ゲーム数")
+    evaluate.add_argument("--precision", type=float, help="信頼区間の半幅がこれ以下になったら打ち切る (例 0.002)")
+    evaluate.add_argument("--confidence", type=float, default=0.95, help="信頼度 (既定 0.95)")
+    evaluate.add_argument("--workers", type=int, help="プロセス数 (省略時は CPU コア数)")
+    evaluate.add_argument("--seed", type=int, help="乱数シード (同じシード・プロセス数なら同じ結果)")
+    evaluate.add_argument("--alternate-seats", action=argparse.BooleanOptionalAction, default=None,
+                          help="先手・後手を1ゲームごとに入れ替える (省略時は opponent=q のときだけ)")
+    evaluate.add_argument("-v", "--verbose", action="store_true", help="ラウンドごとに途中経過を表示する")
+    evaluate.set_defaults(func=cmd_evaluate)
+
+    sweep = subparsers.add_parser("sweep", help="QLearningAgent のハイパーパラメータを並列に探索する")
+    sweep.add_argument("--search", choices=["grid", "random"], default="grid")
+    sweep.add_argument("--trials", type=int, help="試行数 (random の既定は 20、grid では先頭から)")
+    for name in app.SWEEP_PARAMETERS:
+        sweep.add_argument(f"--{name.replace('_', '-')}", dest=name,
+                           help="カンマ区切りの値 (random では 下限:上限 も可)。省略時は既定値")
+    sweep.add_argument("--kind", choices=["phase1", "phase2"], default="phase1")
+    sweep.add_argument("--episodes", type=int, default=100000, help="1試行の学習エピソード数")
+    sweep.add_argument("--mode", choices=["batch"], help="batch: NumPy のバッチ学習 (phase2)")
+    sweep.add_argument("--batch-size", type=int, default=4096)
+    sweep.add_argument("--q-table", help="各試行の学習を始めるQテーブル (省略時は空のテーブル)")
+    sweep.add_argument("--eval-games", type=int, default=100000, help="1試行の評価ゲーム数")
+    sweep.add_argument("--opponent", choices=app.EVALUATION_OPPONENTS, default="omega", help="評価の対戦相手")
+    sweep.add_argument("--opponent-table", default="q_table.json", help="opponent=q で使うQテーブル")
+    sweep.add_argument("--workers", type=int, help="プロセス数 (省略時は CPU コア数)")
+    sweep.add_argument("--seed", type=int, help="乱数シード (学習・評価・ランダム探索)")
+    sweep.add_argument("--out-dir", default="sweep", help="結果 (results.json, best.qtb) の保存先")
+    sweep.add_argument("--out", help="最良の試行のQテーブルのコピー先 (拡張子 .qtb 以外なら JSON)")
+    sweep.set_defaults(func=cmd_sweep)
+
+    publish = subparsers.add_parser("publish-policy", help="配信方策を共有メモリに公開する")
+    publish.add_argument("--dir", help="公開先 (省略時は環境変数 SHARED_POLICY_DIR)")
+    publish.add_argument("--q-table", help="公開するQテーブル (省略時は q_table2 / q_table の新しい方)")
+    publish.set_defaults(func=cmd_publish_policy)
+
+    log_stats = subparsers.add_parser("log-stats", help="ゲームのイベントログを集計する")
+    log_stats.add_argument("paths", nargs="+", help="ログファイルかディレクトリ (EVENT_LOG_DIR)")
+    log_stats.add_argument("--confidence", type=float, default=0.95, help="勝率の信頼区間の信頼度")
+    log_stats.add_argument("--json", action="store_true", help="集計結果を JSON で出力する")
+    log_stats.set_defaults(func=cmd_log_stats)
+
+    offline = subparsers.add_parser("offline-train", help="イベントログの実際の対戦からQ学習する")
+    offline.add_argument("paths", nargs="+", help="ログファイルかディレクトリ (EVENT_LOG_DIR)")
+    offline.add_argument("--q-table", help="学習を始めるQテーブル (省略時は空のテーブル)")
+    offline.add_argument("--epochs", type=int, default=app.OFFLINE_TRAIN_EPOCHS, help="全遷移を何周するか")
+    offline.add_argument("--batch-size", type=int, default=4096, help="ミニバッチの遷移数")
+    offline.add_argument("--alpha", type=float, default=0.1, help="学習率")
+    offline.add_argument("--gamma", type=float, default=0.9, help="割引率")
+    offline.add_argument("--seed", type=int, help="シャッフルの乱数シード")
+    offline.add_argument("--out", default="q_table_offline.qtb", help="学習後のQテーブルの保存先")
+    offline.set_defaults(func=cmd_offline_train)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
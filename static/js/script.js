@@ -5,49 +5,13 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- 新しいトグルスイッチの制御 ---
     const themeToggleCheckbox = document.getElementById('theme-toggle-checkbox');
 
-    // 画像要素を取得
-    const playImage = document.getElementById('play-image');           
-    const resetImage = document.getElementById('reset-image');
-    const hitImage = document.getElementById('hit-image');
-    const standImage = document.getElementById('stand-image');
-    const nextGameImage = document.getElementById('next-game-image');
-
-    // パスを直接文字列で指定する
-    const imagePaths = {
-        light: {
-            play:  '/static/images/play_button.png',                   // (ライトモード用画像)
-            reset: '/static/images/end_button.png',
-            hit:   '/static/images/hit_button.png',
-            stand: '/static/images/stand_button.png',
-            next:  '/static/images/next_game_button.png'
-        },
-        dark: {
-            play:  '/static/images/play_button_dark.png',              // (ダークモード用画像)
-            reset: '/static/images/end_button_dark.png',
-            hit:   '/static/images/hit_button_dark.png',
-            stand: '/static/images/stand_button_dark.png',
-            next:  '/static/images/next_game_button_dark.png'
-        }
-    };
-
     // テーマを適用する関数
+    // (ボタン画像は images.css の body.dark-mode .sprite-* でダークモード用に切り替わる)
     function applyTheme(theme) {
         if (theme === 'dark') {
             body.classList.add('dark-mode');
-            // 画像をダークモード用に変更
-            if (playImage) playImage.src = imagePaths.dark.play;
-            if (resetImage) resetImage.src = imagePaths.dark.reset;
-            if (hitImage) hitImage.src = imagePaths.dark.hit;
-            if (standImage) standImage.src = imagePaths.dark.stand;
-            if (nextGameImage) nextGameImage.src = imagePaths.dark.next;
         } else {
             body.classList.remove('dark-mode');
-            // 画像をライトモード用に変更
-            if (playImage) playImage.src = imagePaths.light.play;
-            if (resetImage) resetImage.src = imagePaths.light.reset;
-            if (hitImage) hitImage.src = imagePaths.light.hit;
-            if (standImage) standImage.src = imagePaths.light.stand;
-            if (nextGameImage) nextGameImage.src = imagePaths.light.next;
         }
     }
 
@@ -109,23 +73,15 @@ function updateCards(playerHand, aiHand) {
     aiHandDiv.innerHTML = "";
     playerHand.forEach(card => {
         const cardDiv = document.createElement("div");
-        cardDiv.classList.add("card");
-        cardDiv.style.backgroundImage = `url('/static/images/card_${card}.png')`;
+        // 画像は images.css の .card-N (ビルド後はスプライトシートの位置)
+        cardDiv.classList.add("card", `card-${card}`);
         playerHandDiv.appendChild(cardDiv);
     });
     // AIの手札表示
     aiHand.forEach(card => {
         const cardDiv = document.createElement("div");
-        cardDiv.classList.add("card");
-        let imageUrl;
-        // カード番号に応じて画像URLを切り替え
-        if (card === 0) { // Pythonから送られてきた特別な値 0 の場合
-            imageUrl = `url('/static/images/card_unknown.png')`; // 「？」画像
-        } else {
-            imageUrl = `url('/static/images/card_${card}.png')`; // 通常のカード画像
-        }
-        // ここまで
-        cardDiv.style.backgroundImage = imageUrl;
+        // Pythonから送られてきた特別な値 0 は .card-0 (「？」画像)
+        cardDiv.classList.add("card", `card-${card}`);
         aiHandDiv.appendChild(cardDiv);
     });
 }
@@ -393,15 +349,16 @@ async function handleUseSpCard(event) {
     try {
         const response = await fetch('/use_sp_card', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json', },
+            headers: stateHeaders({ 'Content-Type': 'application/json', }),
             body: JSON.stringify({ card_id: cardId }),
         });
 
-        const data = await response.json();
+        let data = await response.json();
 
         if (!response.ok) {
             throw new Error(data.error || `サーバーエラー: ${response.status}`);
         }
+        data = mergeState(data);
 
         // エラー復帰処理のために、成功した時点のSPカード状態を保存する
         sessionStorage.setItem('last_player_sp_cards', JSON.stringify(data.player_sp_cards));
@@ -480,64 +437,212 @@ async function handleUseSpCard(event) {
 }
 
 
-// AIターン呼び出し
-async function aiTurn() {
-    try {
-        const response = await fetch("/ai_turn", { method: "POST" });
-        if (!response.ok) throw new Error("Network response was not ok");
-        const data = await response.json(); // レスポンスを受け取る
+// --- 状態の版と差分 ---
+// サーバーは state_version を返し、X-State-Version で送った版が最新なら変わった項目だけを返す ("delta": true)。
+// 手元の gameState に差分を当てて、いつも全項目そろったデータとして表示処理に渡す。
+const STATE_FIELDS = ["player_hand", "ai_hand", "player_points", "ai_points", "player_sp_cards", "ai_sp_cards",
+                      "declared_sp_card", "ai_declared_sp_card", "game_over"];
+let gameState = null;
+let stateVersion = null;
 
-        // --- ↓↓↓ 修正箇所: ボタン状態の更新を先に行う ↓↓↓ ---
-        let isGameOver = data.game_over || false; // game_over フラグを取得
+// ゲームのルートに送るヘッダー (手元の状態の版を付ける)
+function stateHeaders(headers = {}) {
+    if (stateVersion !== null) headers["X-State-Version"] = String(stateVersion);
+    return headers;
+}
 
-        if (!isGameOver) {
-             // ゲームが続くならプレイヤーのターンなのでボタンを有効化
-             hitButton.disabled = false;
-             standButton.disabled = false;
+// レスポンスを手元の状態に当てて、全項目そろったデータを返す
+function mergeState(data) {
+    if (!data || data.state_version === undefined) return data;
+    if (!data.delta || gameState === null) gameState = {};
+    for (const key of STATE_FIELDS) {
+        if (key in data) gameState[key] = data[key];
+    }
+    stateVersion = data.state_version;
+    return Object.assign({}, data, gameState);
+}
+
+// --- AIのターンのイベントストリーム (/events) ---
+// サーバーで有効 (GAME_EVENTS=1、body の data-game-events="1") なときだけ使う。
+// ストリームがつながっていれば /turn に "push": true を付け、AIの行動はサーバーが間を空けて送ってくる。
+// /turn の応答を処理し終わるまで届いたイベントは待たせて、プレイヤー → AI の順に表示する。
+// 切れたときはブラウザが Last-Event-ID を付けて自動で再接続し、続きから受け取る。
+let eventSource = null;
+let turnInFlight = false;
+let pendingEvents = [];
+
+function openEventStream() {
+    if (eventSource || typeof EventSource === "undefined" || document.body.dataset.gameEvents !== "1") return;
+    eventSource = new EventSource("/events");
+    const handle = (event) => {
+        if (turnInFlight) {
+            pendingEvents.push(event);
         } else {
-             // ゲームオーバーならボタンを無効化
-             hitButton.disabled = true;
-             standButton.disabled = true;
-             endGameDiv.style.display = "block"; // ゲーム終了表示 (「次のゲームへ」ボタン表示)
+            handleGameEvent(event);
         }
-        // --- ↑↑↑ 修正箇所: ボタン状態の更新を先に行う ↑↑↑ ---
+    };
+    ["ai_sp_declared", "ai_action", "round_end", "resync"].forEach(name => eventSource.addEventListener(name, handle));
+}
 
-        // --- 表示更新関数呼び出し (ボタン状態が確定した後) ---
-        updatePointsDisplay(data.player_points, data.ai_points);
-        // プレイヤーのSPカード表示更新 (宣言中カードIDも渡す)
-        updateSpCardsDisplay(data.player_sp_cards, data.declared_sp_card || null);
-        // AIのSPカード表示更新
-        updateAISpCardsDisplay(data.ai_sp_cards);
-        // AIの宣言中カード表示更新
-        updateAIDeclaredCardDisplay(data.ai_declared_sp_card || null);
-        // 手札表示更新
-        updateCards(data.player_hand, data.ai_hand);
+function canPushAiTurn() {
+    return eventSource !== null && eventSource.readyState === EventSource.OPEN;
+}
+
+function handleGameEvent(event) {
+    const data = JSON.parse(event.data);
+    if (event.type === "ai_sp_declared") {
+        updateAIDeclaredCardDisplay(data.ai_declared_sp_card);
+    } else if (event.type === "ai_action" || event.type === "round_end") {
+        applyAiTurnResult(mergeState(data));
+    } else if (event.type === "resync") {
+        resyncGameState();
+    }
+}
+
+function flushPendingEvents() {
+    turnInFlight = false;
+    const events = pendingEvents;
+    pendingEvents = [];
+    events.forEach(handleGameEvent);
+}
+
+// イベントを取りこぼしたときは /state から全項目を取り直す
+async function resyncGameState() {
+    try {
+        const response = await fetch("/state");
+        if (!response.ok) return;
+        const data = mergeState(await response.json());
+        renderGameState(Object.assign({}, data, { message: "" }));
+        hitButton.disabled = data.game_over;
+        standButton.disabled = data.game_over;
+        endGameDiv.style.display = data.game_over ? "block" : "none";
+    } catch (error) {
+        console.error("Error resyncing game state:", error);
+    }
+}
 
-        appendMessage(data.message || ""); // メッセージ追加
+// 手札・ポイント・SPカードの表示を更新してメッセージを追加する
+function renderGameState(data) {
+    updatePointsDisplay(data.player_points, data.ai_points);
+    // プレイヤーのSPカード表示更新 (宣言中カードIDも渡す)
+    updateSpCardsDisplay(data.player_sp_cards, data.declared_sp_card || null);
+    // AIのSPカード表示更新
+    updateAISpCardsDisplay(data.ai_sp_cards);
+    // AIの宣言中カード表示更新
+    updateAIDeclaredCardDisplay(data.ai_declared_sp_card || null);
+    // 手札表示更新
+    updateCards(data.player_hand, data.ai_hand);
+    appendMessage(data.message || ""); // メッセージ追加
+}
 
+// /hit・/stand (または /turn の player) の結果を反映する。ゲームオーバーなら true を返す
+function applyPlayerActionResult(data) {
+    let isGameOver = data.game_over || false;
+    // ヒット/スタンド後はAIターンなので、ヒット/スタンドボタンは無効のまま
+    // (SPカードボタンの状態は updateSpCardsDisplay で決定される)
+    hitButton.disabled = true;
+    standButton.disabled = true;
+    if (isGameOver) {
+        endGameDiv.style.display = "block"; // ゲーム終了表示
+    }
+
+    renderGameState(data);
+
+    if (isGameOver) {
         // ゲームオーバー時の追加処理 (ポイント0チェックと「次のゲームへ」ボタンの状態更新)
-        if (isGameOver) {
-             // updatePointsDisplay を再度呼び出して「次のゲームへ」ボタンの状態を再評価
-             updatePointsDisplay(data.player_points, data.ai_points);
-        }
+        updatePointsDisplay(data.player_points, data.ai_points);
+    }
+    return isGameOver;
+}
+
+// /ai_turn (または /turn の ai) の結果を反映する
+function applyAiTurnResult(data) {
+    // --- ボタン状態の更新を先に行う ---
+    let isGameOver = data.game_over || false; // game_over フラグを取得
+
+    if (!isGameOver) {
+         // ゲームが続くならプレイヤーのターンなのでボタンを有効化
+         hitButton.disabled = false;
+         standButton.disabled = false;
+    } else {
+         // ゲームオーバーならボタンを無効化
+         hitButton.disabled = true;
+         standButton.disabled = true;
+         endGameDiv.style.display = "block"; // ゲーム終了表示 (「次のゲームへ」ボタン表示)
+    }
+
+    // --- 表示更新 (ボタン状態が確定した後) ---
+    renderGameState(data);
 
+    // ゲームオーバー時の追加処理 (ポイント0チェックと「次のゲームへ」ボタンの状態更新)
+    if (isGameOver) {
+         // updatePointsDisplay を再度呼び出して「次のゲームへ」ボタンの状態を再評価
+         updatePointsDisplay(data.player_points, data.ai_points);
+    }
+}
+
+// AIターン呼び出し (/turn を使わない場合用に残している)
+async function aiTurn() {
+    try {
+        const response = await fetch("/ai_turn", { method: "POST", headers: stateHeaders() });
+        if (!response.ok) throw new Error("Network response was not ok");
+        applyAiTurnResult(mergeState(await response.json()));
     } catch (error) {
         console.error("Error in AI turn:", error);
         appendMessage("AIの動作中にエラーが発生しました。");
         // エラー時も操作可能に戻す
         hitButton.disabled = false;
         standButton.disabled = false;
-        // エラー時に他の表示も更新すべきか検討 (例: SPカードボタンの状態など)
-        // updateSpCardsDisplay(...) など
+    }
+}
+
+// プレイヤーの行動 (hit / stand) とAIのターンを /turn の1リクエストで処理する
+async function playTurn(action, errorMessage) {
+    // --- ボタン無効化 (API呼び出し前) ---
+    hitButton.disabled = true;
+    standButton.disabled = true;
+    // SPカードボタンも一時的に無効化する方が安全
+    document.querySelectorAll('.use-sp-button').forEach(btn => btn.disabled = true);
+
+    const push = canPushAiTurn();
+    turnInFlight = true;
+    try {
+        const response = await fetch("/turn", {
+            method: "POST",
+            headers: stateHeaders({ "Content-Type": "application/json" }),
+            body: JSON.stringify({ action: action, push: push }),
+        });
+        if (!response.ok) throw new Error("Network response was not ok");
+        const data = await response.json();
+
+        // player → ai の順に差分を当てる
+        const isGameOver = applyPlayerActionResult(mergeState(data.player));
+        if (data.ai) {
+            applyAiTurnResult(mergeState(data.ai));
+        } else if (data.ai_event_id) {
+            // AIのターンは /events から届く (それまでボタンは無効のまま)
+        } else if (!isGameOver) {
+            // AIのターンに進まなかった (自分のターンではなかった等) ので操作可能に戻す
+            hitButton.disabled = false;
+            standButton.disabled = false;
+        }
+    } catch (error) {
+        console.error(`Error in ${action}:`, error);
+        appendMessage(errorMessage);
+        // エラー時は操作可能に戻す
+        hitButton.disabled = false;
+        standButton.disabled = false;
+    } finally {
+        flushPendingEvents();
     }
 }
 
 // ゲーム開始
 async function startGame() {
     try {
-        const response = await fetch("/start_game", { method: "POST" });
+        const response = await fetch("/start_game", { method: "POST", headers: stateHeaders() });
         if (!response.ok) throw new Error("Network response was not ok");
-        const data = await response.json();
+        const data = mergeState(await response.json());
 
         // --- ↓↓↓ ★★★ ボタン状態の初期化を先に実行 ★★★ ↓↓↓ ---
         // ゲーム開始時はヒット/スタンド有効
@@ -566,6 +671,7 @@ async function startGame() {
         messageLogDiv.innerHTML = "";
         appendMessage(data.load_status || "");
         appendMessage(data.message || "ゲーム開始！");
+        openEventStream();
 
     } catch (error) {
         console.error("Error starting game:", error);
@@ -579,122 +685,10 @@ async function startGame() {
 }
 
 // ヒットボタン
-hitButton.addEventListener("click", async () => {
-    // --- ボタン無効化 (API呼び出し前) ---
-    hitButton.disabled = true;
-    standButton.disabled = true;
-    // SPカードボタンも一時的に無効化する方が安全
-    document.querySelectorAll('.use-sp-button').forEach(btn => btn.disabled = true);
-
-    try {
-        const response = await fetch("/hit", { method: "POST" });
-        if (!response.ok) throw new Error("Network response was not ok");
-        const data = await response.json();
-
-        // --- ↓↓↓ 修正箇所: ボタン状態の更新を先に行う ↓↓↓ ---
-        let isGameOver = data.game_over || false;
-        if (isGameOver) {
-             // ゲームオーバーならボタンは無効のまま
-             endGameDiv.style.display = "block"; // ゲーム終了表示
-        } else {
-             // ヒット後はAIターンなので、ヒット/スタンドボタンは無効のまま
-             // (SPカードボタンの状態は updateSpCardsDisplay で決定される)
-             hitButton.disabled = true; // 念のため再設定
-             standButton.disabled = true; // 念のため再設定
-        }
-        // --- ↑↑↑ 修正箇所: ボタン状態の更新を先に行う ↑↑↑ ---
-
-        // --- 表示更新 (ボタン状態が確定した後) ---
-        updatePointsDisplay(data.player_points, data.ai_points);
-        // プレイヤーのSPカード表示更新 (宣言中カードIDも渡す)
-        updateSpCardsDisplay(data.player_sp_cards, data.declared_sp_card || null);
-        // AIのSPカード表示更新
-        updateAISpCardsDisplay(data.ai_sp_cards);
-        // AIの宣言中カード表示更新
-        updateAIDeclaredCardDisplay(data.ai_declared_sp_card || null);
-        // 手札表示更新
-        updateCards(data.player_hand, data.ai_hand);
-        appendMessage(data.message || ""); // メッセージ追加
-
-        // --- 次のアクション ---
-        if (isGameOver) {
-            // ゲームオーバー時の追加処理 (ポイント0チェックと「次のゲームへ」ボタンの状態更新)
-            updatePointsDisplay(data.player_points, data.ai_points);
-        } else {
-            // AIターンを呼ぶ前に少し待つ場合 (任意)
-            // await new Promise(resolve => setTimeout(resolve, 500));
-            await aiTurn(); // AIターンへ
-        }
-    } catch (error) {
-        console.error("Error in hit:", error);
-        appendMessage("山札にもうカードがありません。もしくはエラー？");
-        // エラー時は操作可能に戻す
-        hitButton.disabled = false;
-        standButton.disabled = false;
-        // エラー時にSPカードボタンも有効に戻す (updateSpCardsDisplay を呼ぶなどして再評価)
-        // サーバーから最新状態を取得して再表示するのが理想
-        // updateSpCardsDisplay(...)
-    }
-});
+hitButton.addEventListener("click", () => playTurn("hit", "山札にもうカードがありません。もしくはエラー？"));
 
 // スタンドボタン
-standButton.addEventListener("click", async () => {
-    // --- ボタン無効化 (API呼び出し前) ---
-    hitButton.disabled = true;
-    standButton.disabled = true;
-    // SPカードボタンも一時的に無効化する方が安全
-    document.querySelectorAll('.use-sp-button').forEach(btn => btn.disabled = true);
-
-    try {
-        const response = await fetch("/stand", { method: "POST" });
-        if (!response.ok) throw new Error("Network response was not ok");
-        const data = await response.json();
-
-        // --- ↓↓↓ 修正箇所: ボタン状態の更新を先に行う ↓↓↓ ---
-        // スタンド直後は通常 isGameOver = false のはずだが、念のためチェック
-        let isGameOver = data.game_over || false;
-         if (isGameOver) {
-              hitButton.disabled = true;
-              standButton.disabled = true;
-              endGameDiv.style.display = "block"; // ゲーム終了表示
-         } else {
-              // スタンド後はAIターンなので、ヒット/スタンドボタンは無効のまま
-              hitButton.disabled = true; // 念のため再設定
-              standButton.disabled = true; // 念のため再設定
-         }
-        // --- ↑↑↑ 修正箇所: ボタン状態の更新を先に行う ↑↑↑ ---
-
-        // --- 表示更新 (ボタン状態が確定した後) ---
-        updatePointsDisplay(data.player_points, data.ai_points);
-        // プレイヤーのSPカード表示更新 (宣言中カードIDも渡す)
-        updateSpCardsDisplay(data.player_sp_cards, data.declared_sp_card || null);
-        // AIのSPカード表示更新
-        updateAISpCardsDisplay(data.ai_sp_cards);
-        // AIの宣言中カード表示更新
-        updateAIDeclaredCardDisplay(data.ai_declared_sp_card || null);
-        // 手札表示更新 (スタンド時は変わらないが表示してもOK)
-        updateCards(data.player_hand, data.ai_hand);
-        appendMessage(data.message || ""); // メッセージ追加
-
-        // --- 次のアクション ---
-        if (isGameOver) {
-            // ゲームオーバー時の追加処理 (ポイント0チェックと「次のゲームへ」ボタンの状態更新)
-            updatePointsDisplay(data.player_points, data.ai_points);
-        } else {
-            // AIターンを呼ぶ前に少し待つ場合 (任意)
-            // await new Promise(resolve => setTimeout(resolve, 500));
-            await aiTurn(); // AIターンへ
-        }
-    } catch (error) {
-        console.error("Error in stand:", error);
-        appendMessage("スタンド処理中にエラーが発生しました。");
-        // エラー時は操作可能に戻す
-        hitButton.disabled = false;
-        standButton.disabled = false;
-        // エラー時にSPカードボタンも有効に戻す (updateSpCardsDisplay を呼ぶなどして再評価)
-        // updateSpCardsDisplay(...)
-    }
-});
+standButton.addEventListener("click", () => playTurn("stand", "スタンド処理中にエラーが発生しました。"));
 
 // --- イベントリスナーの設定 ---
 // ここはメンテナンス実行時以外はコメントアウト
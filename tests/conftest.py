@@ -0,0 +1,29 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+# 共有メモリの方策やイベントログは使わず、プロセス内のゲーム状態ストアで動かす
+for name in ("SHARED_POLICY_DIR", "EVENT_LOG_DIR"):
+    os.environ.pop(name, None)
+os.environ["GAME_STATE_BACKEND"] = "memory"
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app as app_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    return app_module
+
+
+@pytest.fixture
+def client(app):
+    """ゲームの乱数を固定したテストクライアント (ルートのデバッグ出力は捨てる)"""
+    app.game_rng.seed(12345)
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield app.app.test_client()
@@ -0,0 +1,51 @@
+"""NumPy のバッチ版 Phase2"""
+import contextlib
+import io
+
+import pytest
+
+
+@pytest.fixture
+def np(app):
+    if app.np is None:
+        pytest.skip("numpy がありません")
+    return app.np
+
+
+def test_np_learn_matches_sequential_learn(app, np):
+    """同じ (状態, 行動) が1件ずつなら、バッチの更新は更新前の値を使った learn と一致する"""
+    batch = app.QLearningAgent()
+    sequential = app.QLearningAgent()
+    rng = np.random.default_rng(1)
+    states = rng.choice(app.Q_NUM_STATES, 500, replace=False).astype(np.int64)
+    actions = rng.integers(0, 2, 500)
+    rewards = rng.choice([-10.0, -1.0, 0.0, 0.1, 1.0], 500)
+    next_states = np.where(rng.random(500) < 0.5, -1, rng.choice(app.Q_NUM_STATES, 500)).astype(np.int64)
+    # 次の状態の値は更新前のものを使うので、先に値を入れておく
+    for agent in (batch, sequential):
+        values = np.frombuffer(agent.q_table.values, dtype=np.float64)
+        values[:] = np.random.default_rng(2).normal(size=values.size)
+    before = np.frombuffer(sequential.q_table.values, dtype=np.float64).copy()
+    expected = before.copy()
+    values = np.frombuffer(batch.q_table.values, dtype=np.float64)
+    seen = np.frombuffer(batch.q_table.seen, dtype=np.uint8)
+    app._np_learn(batch, values, seen, states, actions, rewards, next_states, np.ones(500, dtype=bool))
+    for s, a, r, n in zip(states, actions, rewards, next_states):
+        i = (int(s) << 1) + int(a)
+        next_max = 0.0 if n < 0 else max(before[int(n) << 1], before[(int(n) << 1) + 1])
+        target = r * sequential.reward_scale + sequential.gamma * next_max
+        expected[i] += sequential.alpha * (target - expected[i])
+    assert np.allclose(values, expected)
+    assert seen[states].all()
+
+
+def test_batch_training_is_reproducible(app, np):
+    tables = []
+    for _ in range(2):
+        agent = app.QLearningAgent()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = app.simulate_q_vs_q_batch(agent, episodes=4000, batch_size=1000, seed=9)
+        assert sum(results.values()) <= 4000
+        tables.append(bytes(agent.q_table.values))
+    assert tables[0] == tables[1]
+    assert len(agent.q_table) > 0
@@ -0,0 +1,37 @@
+"""学習のチェックポイントと再開"""
+import contextlib
+import io
+
+import pytest
+
+
+def _interrupt_at(app, episodes):
+    def progress(done, epsilon, results):
+        if done >= episodes:
+            raise app.TrainingCancelled()
+    return progress
+
+
+@pytest.mark.parametrize("kind, params", [
+    ("phase1", {"episodes": 3000}),
+    ("phase2", {"episodes": 3000}),
+    ("phase2", {"episodes": 20000, "mode": "batch", "batch_size": 1000}),
+])
+def test_resume_gives_identical_table(app, tmp_path, kind, params):
+    if params.get("mode") == "batch" and app.np is None:
+        pytest.skip("numpy がありません")
+    params = dict(params, seed=7)
+    every = params["episodes"] // 3
+    with contextlib.redirect_stdout(io.StringIO()):
+        straight, straight_results = app.run_checkpointed_training(
+            app.QLearningAgent(), kind, params, str(tmp_path / "straight"), every=every, log_every=0)
+        with pytest.raises(app.TrainingCancelled):
+            app.run_checkpointed_training(app.QLearningAgent(), kind, params, str(tmp_path / "resumed"),
+                                          every=every, progress=_interrupt_at(app, params["episodes"] // 2),
+                                          log_every=0)
+        resumed, resumed_results = app.run_checkpointed_training(None, None, None, str(tmp_path / "resumed"),
+                                                                 resume=True, every=every, log_every=0)
+    assert bytes(resumed.q_table.values) == bytes(straight.q_table.values)
+    assert bytes(resumed.q_table.seen) == bytes(straight.q_table.seen)
+    assert resumed.epsilon == straight.epsilon
+    assert resumed_results == straight_results
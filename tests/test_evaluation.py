@@ -0,0 +1,24 @@
+"""方策の評価"""
+
+
+def test_same_seed_gives_same_result(app):
+    policy = app.FrozenPolicy.compile(app.CompactQTable())
+    first = app.evaluate_policy(policy, "omega", max_games=20000, workers=1, seed=3)
+    second = app.evaluate_policy(policy, "omega", max_games=20000, workers=1, seed=3)
+    assert first["games"] == 20000
+    assert (first["win"], first["draw"], first["loss"]) == (second["win"], second["draw"], second["loss"])
+
+
+def test_interval_contains_exact_value(app):
+    """最適方策を対戦させた得点の信頼区間に、厳密解の期待値が入る"""
+    _, table, expected = app.solve_exact_policy("omega")
+    summary = app.evaluate_policy(app.FrozenPolicy.compile(table), "omega", max_games=40000, workers=1, seed=3)
+    assert summary["score"]["low"] <= expected <= summary["score"]["high"]
+
+
+def test_precision_stops_early(app):
+    policy = app.FrozenPolicy.compile(app.CompactQTable())
+    summary = app.evaluate_policy(policy, "omega", max_games=1000000, precision=0.01, workers=1, seed=5,
+                                  round_games=5000)
+    assert summary["stopped_early"] and summary["games"] < 1000000
+    assert summary["half_width"] <= 0.01
@@ -0,0 +1,55 @@
+"""ゲームのイベントログと集計"""
+import json
+import os
+
+
+def test_records_rotate_and_read_back_in_order(app, tmp_path):
+    log = app.GameEventLog(str(tmp_path), max_bytes=200)
+    for i in range(3):
+        for n in range(5):
+            log.record({"e": "player", "g": f"game{i}", "n": n, "t": 1000.0 + n * 3 + i, "a": "stand"})
+        log.flush()
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) >= 2
+    lines = [json.loads(line) for name in files for line in open(tmp_path / name, encoding="utf-8")]
+    assert len(lines) == 15 and log.written == 15 and log.dropped == 0
+    times = [event["t"] for event in app.read_game_event_log([str(tmp_path)])]
+    assert times == sorted(times) and len(times) == 15
+
+
+def test_queue_limit_drops_events(app, tmp_path):
+    log = app.GameEventLog(str(tmp_path), queue_limit=2)
+    for n in range(5):
+        log.record({"e": "player", "n": n, "t": 0.0})
+    log.flush()
+    assert (log.written, log.dropped) == (2, 3)
+
+
+def test_summary_of_played_games(app, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "game_event_log", app.GameEventLog(str(tmp_path)))
+    games = 20
+    for _ in range(games):
+        client.post("/start_game")
+        client.post("/use_sp_card", json={"card_id": "sp_minus_3"})
+        for _ in range(40):
+            body = client.post("/turn", json={"action": "stand"}).get_json()
+            if body["ai"] and body["ai"].get("game_over"):
+                break
+        client.post("/reset_all")
+    client.post("/start_game")  # 決着していないゲーム
+    app.game_event_log.flush()
+    summary = app.summarize_game_events(app.read_game_event_log([str(tmp_path)]))
+    player = summary["player"]
+    assert summary["games"] == games and summary["abandoned"] == 1
+    assert player["wins"] + player["draws"] + player["losses"] == games
+    assert player["low"] <= player["win_rate"] <= player["high"]
+    assert summary["sp_cards"]["player:sp_minus_3"]["used"] == games
+    assert summary["average_turns"] >= 6  # 3回ずつスタンドするまで終わらない
+
+
+def test_disabled_log_records_nothing(app, client, monkeypatch):
+    monkeypatch.setattr(app, "game_event_log", None)
+    client.post("/start_game")
+    client.post("/turn", json={"action": "hit"})
+    with client.session_transaction() as session:
+        assert session["game_log_seq"] == 0
@@ -0,0 +1,20 @@
+"""厳密解ソルバー"""
+import pytest
+
+
+@pytest.fixture(scope="module")
+def solved(app):
+    return app.solve_exact_policy("omega")
+
+
+def test_saved_table_is_optimal(solved):
+    solver, table, expected = solved
+    assert -1.0 <= expected <= 1.0
+    # 保存したテーブルの greedy 方策 (固定ルール込み) は最適値にほぼ一致し、それを超えない
+    assert solver.policy_value(table) == pytest.approx(expected, abs=1e-3)
+    assert solver.policy_value(table) <= expected + 1e-9
+
+
+def test_untrained_table_is_worse(app, solved):
+    solver, _, expected = solved
+    assert solver.policy_value(app.CompactQTable()) < expected - 0.05
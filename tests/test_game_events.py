@@ -0,0 +1,76 @@
+"""AIのターンのイベントストリーム (/events)"""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def events_enabled(app, monkeypatch):
+    monkeypatch.setattr(app, "GAME_EVENTS_ENABLED", True)
+    monkeypatch.setattr(app, "GAME_EVENT_DELAY", 0.0)
+    monkeypatch.setattr(app, "GAME_EVENTS_STREAM_SECONDS", 0.5)
+
+
+def read_events(client, last_event_id):
+    """ストリームが閉じるまで読み、(id, event, data) のリストを返す"""
+    response = client.get("/events", headers={"Last-Event-ID": str(last_event_id)}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    text = b"".join(response.iter_encoded()).decode()
+    events = []
+    for block in text.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            events.append((int(fields["id"]) if "id" in fields else None, fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def play_pushed_turns(client, turns):
+    """push 付きの /turn を turns 回 (決着したらそこまで) 進め、最後のイベントIDを返す"""
+    client.post("/start_game")
+    event_id = 0
+    for _ in range(turns):
+        body = client.post("/turn", json={"action": "stand", "push": True}).get_json()
+        assert body["ai"] is None
+        event_id = body["ai_event_id"]
+        if client.get("/state").get_json()["game_over"]:
+            break
+    return event_id
+
+
+def test_resume_from_last_event_id(client, events_enabled):
+    last = play_pushed_turns(client, 3)
+    assert last >= 2
+    events = read_events(client, 1)
+    assert [event_id for event_id, _, _ in events] == list(range(2, last + 1))
+    assert {name for _, name, _ in events} <= {"ai_sp_declared", "ai_action", "round_end"}
+    # 最後のイベントは全項目の状態を持ち、GET /state と一致する
+    state = client.get("/state").get_json()
+    assert events[-1][2]["player_hand"] == state["player_hand"]
+    assert events[-1][2]["state_version"] == state["state_version"]
+
+
+def test_resync_when_backlog_is_gone(app, client, events_enabled):
+    """セッションに残っているより古い ID から再接続すると resync が届く"""
+    client.post("/start_game")
+    for _ in range(app.GAME_EVENTS_BACKLOG + 2):
+        client.post("/turn", json={"action": "stand", "push": True})
+        client.post("/start_game")
+    events = read_events(client, 0)
+    assert events[0][1] == "resync"
+
+
+def test_resync_is_sent_once_before_the_first_event_is_due(app, client, events_enabled, monkeypatch):
+    monkeypatch.setattr(app, "GAME_EVENT_DELAY", 60.0)
+    client.post("/start_game")
+    for _ in range(app.GAME_EVENTS_BACKLOG + 2):
+        client.post("/turn", json={"action": "stand", "push": True})
+        client.post("/start_game")
+    assert [name for _, name, _ in read_events(client, 0)] == ["resync"]
+
+
+def test_disabled_by_default(app, client):
+    assert app.GAME_EVENTS_ENABLED is False
+    client.post("/start_game")
+    assert client.get("/events").status_code == 404
+    body = client.post("/turn", json={"action": "stand", "push": True}).get_json()
+    assert body["ai"] is not None and "ai_event_id" not in body
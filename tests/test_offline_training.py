@@ -0,0 +1,68 @@
+"""イベントログからのオフライン学習"""
+import pytest
+
+FULL = (1 << 11) - 1
+
+
+def ai(game, t, total, opponent, mask, action):
+    return {"e": "ai", "g": game, "t": t, "s": [total, opponent, mask], "a": action}
+
+
+def end(game, t, result):
+    return {"e": "end", "g": game, "t": t, "r": result}
+
+
+def test_transitions_and_rewards(app):
+    index = app.CompactQTable.index
+    events = [
+        {"e": "start", "g": "a", "t": 0.0},
+        {"e": "start", "g": "b", "t": 0.0},
+        ai("a", 1.0, 12, 5, FULL, "hit"),
+        ai("b", 1.5, 20, 9, FULL, "hit"),
+        ai("a", 2.0, 18, 5, FULL & ~(1 << 5), "stand"),   # 6 を引いた
+        ai("b", 2.5, 25, 9, FULL & ~(1 << 4), "stand"),   # バースト
+        ai("a", 3.0, 18, 5, FULL & ~(1 << 5), "stand"),
+        end("a", 3.0, 1),                                  # プレイヤーの勝ち = AI は -1
+        end("b", 3.5, 1),
+        {"e": "start", "g": "c", "t": 4.0},
+        ai("c", 5.0, 15, 3, FULL, "stand"),               # 決着しないまま終わったゲーム
+    ]
+    transitions = list(app.iter_logged_transitions(events))
+    assert transitions == [
+        (index(12, 5, FULL), 0, 0.1, index(18, 5, FULL & ~(1 << 5))),
+        (index(20, 9, FULL), 0, -10.0, -1),
+        (index(18, 5, FULL & ~(1 << 5)), 1, 0.0, index(18, 5, FULL & ~(1 << 5))),
+        (index(18, 5, FULL & ~(1 << 5)), 1, -1.0, -1),
+    ]
+
+
+def test_draw_and_ai_win_rewards(app):
+    events = [ai("a", 1.0, 19, 4, FULL, "stand"), end("a", 2.0, 0),
+              ai("b", 1.0, 20, 4, FULL, "stand"), end("b", 2.0, -1)]
+    assert [reward for _, _, reward, _ in app.iter_logged_transitions(events)] == [0.0, 1.0]
+
+
+def test_train_offline_learns_logged_rewards(app, tmp_path, monkeypatch):
+    if app.np is None:
+        pytest.skip("numpy がありません")
+    log = app.GameEventLog(str(tmp_path))
+    for i in range(200):
+        game = f"g{i}"
+        for event in (ai(game, i, 20, 9, FULL, "hit"), ai(game, i + 0.1, 25, 9, FULL & ~(1 << 4), "stand"),
+                      ai(game, i + 0.2, 19, 9, FULL, "stand"), end(game, i + 0.3, -1)):
+            log.record(event)
+    log.flush()
+    transitions = app.load_logged_transitions([str(tmp_path)])
+    assert len(transitions[0]) == 400
+    agent = app.QLearningAgent()
+    summary = app.train_offline(agent, transitions, epochs=3, batch_size=64, seed=1, log_every=0)
+    assert summary["td_error"][-1] < summary["td_error"][0]
+    values = agent.q_table.values
+    hit = app.CompactQTable.index(20, 9, FULL) << 1
+    stand = app.CompactQTable.index(19, 9, FULL) << 1 | 1
+    assert values[hit] == pytest.approx(-10.0, abs=0.5)
+    assert values[stand] == pytest.approx(1.0, abs=0.05)
+    path = str(tmp_path / "offline.qtb")
+    agent.save(path)
+    loaded = app.QLearningAgent()
+    assert loaded.load(path) and loaded.choose_action(hit >> 1, 20, is_training=False) == "stand"
@@ -0,0 +1,53 @@
+"""並列学習の同期 (訪問回数で重み付けした Q値の平均)"""
+from array import array
+
+import pytest
+
+
+def _updates():
+    return [
+        (array('q', [2, 5]), array('d', [1.0, 4.0]), array('I', [1, 2])),
+        (array('q', [5, 9]), array('d', [1.0, -2.0]), array('I', [2, 3])),
+    ]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_merge_is_visit_weighted_average(app, monkeypatch, use_numpy):
+    if use_numpy and app.np is None:
+        pytest.skip("numpy がありません")
+    if not use_numpy:
+        monkeypatch.setattr(app, "np", None)
+    indices, values = app._merge_sparse(_updates())
+    assert list(indices) == [2, 5, 9]
+    assert list(values) == pytest.approx([1.0, (4.0 * 2 + 1.0 * 2) / 4, -2.0])
+
+
+def test_sparse_visits_resets_counts(app):
+    table = app.CompactQTable()
+    table.visits = array('I', bytes(4 * 2 * app.Q_NUM_STATES))
+    table.values[7] = 0.5
+    table.visits[7] = 3
+    indices, values, counts = app._sparse_visits(table)
+    assert list(indices) == [7] and list(values) == [0.5] and list(counts) == [3]
+    assert table.visits[7] == 0
+
+
+def test_merge_seen_is_union(app):
+    first = bytearray(app.Q_NUM_STATES)
+    second = bytearray(app.Q_NUM_STATES)
+    first[3] = 1
+    second[10] = 1
+    merged = app._merge_seen([bytes(first), bytes(second)])
+    assert merged[3] == merged[10] == 1 and sum(merged) == 2
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/train", {"workers": "x"}),
+    ("/train", {"workers": 0}),
+    ("/train2", {"workers": -1}),
+    ("/train2", {"mode": "batch", "batch_size": 2.5}),
+])
+def test_invalid_params_are_rejected(app, path, params):
+    response = app.app.test_client().post(path, json=params)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -0,0 +1,73 @@
+"""Qテーブルの保存形式 (CompactQTable と従来の dict)"""
+import random
+
+
+def _train_both(app, steps=3000, seed=3):
+    """同じ状態・行動・報酬の列で compact と dict の2つのエージェントを更新し、選んだ行動も比べる"""
+    compact = app.QLearningAgent(storage="compact")
+    legacy = app.QLearningAgent(storage="dict")
+    rng = random.Random(seed)
+    for _ in range(steps):
+        deck = rng.sample(app.DECK, rng.randint(0, len(app.DECK)))
+        # 学習で使う状態の合計は21以下 (compact は22以上をバースト枠にまとめるので dict と同じキーにならない)
+        total, opponent = rng.randint(2, 21), rng.randint(1, 11)
+        next_deck = deck[1:]
+        next_total = total + (deck[0] if deck else 0)
+        terminal = next_total > app.BURST_LIMIT or rng.random() < 0.3
+        states = []
+        for agent in (compact, legacy):
+            state = agent.get_state(total, opponent, deck)
+            next_state = None if terminal else agent.get_state(next_total, opponent, next_deck)
+            states.append((state, next_state))
+        action_rng_seed = rng.random()
+        actions = [agent.choose_action(state, total, rng=random.Random(action_rng_seed))
+                   for agent, (state, _) in zip((compact, legacy), states)]
+        assert actions[0] == actions[1]
+        reward = rng.choice([-10, -1, 0, 0.1, 1])
+        for agent, (state, next_state) in zip((compact, legacy), states):
+            agent.learn(state, actions[0], reward, next_state)
+    return compact, legacy
+
+
+def test_compact_matches_dict_table(app):
+    compact, legacy = _train_both(app)
+    assert compact.q_table.to_dict() == legacy.q_table
+    assert len(compact.q_table) == len(legacy.q_table)
+    assert app.CompactQTable.from_dict(legacy.q_table).to_dict() == legacy.q_table
+
+
+def test_json_round_trip(app, tmp_path):
+    compact, legacy = _train_both(app, steps=500)
+    path = str(tmp_path / "q_table.json")
+    compact.save(path)
+    loaded_dict = app.QLearningAgent(storage="dict")
+    loaded_dict.load(path)
+    assert loaded_dict.q_table == legacy.q_table
+
+
+def test_binary_round_trip(app, tmp_path):
+    compact, legacy = _train_both(app, steps=500)
+    path = str(tmp_path / "q_table.qtb")
+    compact.save(path)
+    assert app.CompactQTable.is_binary_file(path)
+    for read_only in (True, False):
+        loaded = app.QLearningAgent()
+        assert loaded.load(path, read_only=read_only)
+        assert bytes(loaded.q_table.values) == bytes(compact.q_table.values)
+        assert bytes(loaded.q_table.seen) == bytes(compact.q_table.seen)
+        assert len(loaded.q_table) == len(compact.q_table)
+    # dict のエージェントで読んでも同じテーブル、JSON に変換しても同じ
+    loaded_dict = app.QLearningAgent(storage="dict")
+    assert loaded_dict.load(path)
+    assert loaded_dict.q_table == legacy.q_table
+    json_path = str(tmp_path / "converted.json")
+    assert app.convert_q_table(path, json_path) == len(legacy.q_table)
+    assert app.QLearningAgent(storage="dict").load(json_path)
+
+
+def test_broken_binary_file_is_rejected(app, tmp_path):
+    path = tmp_path / "broken.qtb"
+    compact, _ = _train_both(app, steps=100)
+    compact.save(str(path))
+    path.write_bytes(path.read_bytes()[:100])
+    assert not app.QLearningAgent().load(str(path))
@@ -0,0 +1,18 @@
+"""共有メモリの配信方策"""
+
+
+def test_publish_and_attach(app, tmp_path):
+    agent = app.QLearningAgent()
+    state = agent.get_state(15, 5, [1, 2, 3])
+    agent.learn(state, "stand", 1.0, None)
+    policy = app.FrozenPolicy.compile(agent.q_table)
+    version = app.publish_shared_policy(policy, str(tmp_path))
+    attached, attached_version = app.attach_shared_policy(str(tmp_path))
+    assert attached_version == version
+    assert bytes(attached.codes) == bytes(policy.codes)
+
+
+def test_broken_policy_file_is_ignored(app, tmp_path):
+    (tmp_path / "policy-1.bin").write_bytes(b"short")
+    (tmp_path / "current").write_text("policy-1.bin")
+    assert app.attach_shared_policy(str(tmp_path)) is None
@@ -0,0 +1,86 @@
+"""状態の版 (X-State-Version) と差分レスポンス"""
+import pytest
+
+
+def merge(app, state, body):
+    """script.js の mergeState と同じく、レスポンスの状態の項目を手元の状態に当てる"""
+    state.update({key: body[key] for key in app.STATE_FIELDS if key in body})
+    return body["state_version"]
+
+
+def full_state(app, client):
+    body = client.get("/state").get_json()
+    return {key: body[key] for key in app.STATE_FIELDS}
+
+
+def start(app, client):
+    body = client.post("/start_game").get_json()
+    state = {}
+    return state, merge(app, state, body)
+
+
+def test_hit_delta_contains_drawn_card(app, client):
+    for _ in range(30):
+        state, version = start(app, client)
+        hand = list(state["player_hand"])
+        body = client.post("/hit", headers={"X-State-Version": str(version)}).get_json()
+        assert body["delta"] is True
+        assert body["state_version"] == version + 1
+        assert body["player_hand"][:2] == hand and len(body["player_hand"]) == 3
+        client.post("/reset_all")
+
+
+def test_sp_card_delta_contains_new_counts(app, client):
+    state, version = start(app, client)
+    count = state["player_sp_cards"]["sp_minus_3"]
+    body = client.post("/use_sp_card", json={"card_id": "sp_minus_3"},
+                       headers={"X-State-Version": str(version)}).get_json()
+    assert body["delta"] is True
+    assert body["player_sp_cards"]["sp_minus_3"] == count - 1
+    assert body["declared_sp_card"] == "sp_minus_3"
+
+
+def test_stale_version_gets_full_state(app, client):
+    state, version = start(app, client)
+    body = client.post("/stand", headers={"X-State-Version": str(version - 1)}).get_json()
+    assert body["delta"] is False
+    assert set(app.STATE_FIELDS) <= set(body)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_turn_deltas_merge_to_full_state(app, client, seed):
+    """/turn と /use_sp_card の差分を当て続けた状態が、常に GET /state の全項目と一致する"""
+    app.game_rng.seed(seed)
+    state, version = start(app, client)
+    body = client.post("/use_sp_card", json={"card_id": "sp_minus_3"},
+                       headers={"X-State-Version": str(version)}).get_json()
+    version = merge(app, state, body)
+    assert state == full_state(app, client)
+    for _ in range(40):
+        action = "hit" if sum(state["player_hand"]) < 17 else "stand"
+        body = client.post("/turn", json={"action": action}, headers={"X-State-Version": str(version)}).get_json()
+        version = merge(app, state, body["player"])
+        if body["ai"] is not None:
+            version = merge(app, state, body["ai"])
+        assert state == full_state(app, client)
+        if state["game_over"]:
+            break
+    else:
+        pytest.fail("ゲームが終わりませんでした")
+
+
+def test_turn_without_header_returns_full_states(app, client):
+    """X-State-Version なしの /turn は "player" も "ai" も全項目 (/ai_turn と同じ形) で返す"""
+    client.post("/start_game")
+    body = client.post("/turn", json={"action": "hit"}).get_json()
+    assert body["ai"] is not None
+    for part in (body["player"], body["ai"]):
+        assert part["delta"] is False
+        assert set(app.STATE_FIELDS) <= set(part)
+    assert {key: body["ai"][key] for key in app.STATE_FIELDS} == full_state(app, client)
+
+
+def test_state_etag(client):
+    client.post("/start_game")
+    response = client.get("/state")
+    assert client.get("/state", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
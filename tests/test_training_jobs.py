@@ -0,0 +1,92 @@
+"""バックグラウンド学習ジョブの起動"""
+import random
+import threading
+import time
+
+import pytest
+
+
+class _FakeProcess:
+    def __init__(self, target=None, args=()):
+        self.pid = None
+
+    def start(self):
+        pass
+
+
+class _FakeContext:
+    Process = _FakeProcess
+
+
+@pytest.fixture
+def jobs_dir(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "TRAINING_JOBS_DIR", str(tmp_path))
+    monkeypatch.setattr(app.multiprocessing, "get_context", lambda method: _FakeContext())
+    monkeypatch.setattr(app, "_watch_training_job", lambda job_id, process: None)
+    monkeypatch.setattr(app, "_pid_alive", lambda pid: True)
+    return tmp_path
+
+
+def test_concurrent_starts_launch_one_job(app, jobs_dir, monkeypatch):
+    list_training_jobs = app.list_training_jobs
+
+    def slow_list():  # 確認とジョブファイルの書き込みの間を広げて、排他がなければ競合するようにする
+        jobs = list_training_jobs()
+        time.sleep(0.01)
+        return jobs
+
+    monkeypatch.setattr(app, "list_training_jobs", slow_list)
+    threads = 16
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def start():
+        barrier.wait()
+        results.append(app.start_training_job("phase1", {"episodes": 100}))
+
+    workers = [threading.Thread(target=start) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    started = [job for job, was_started in results if was_started]
+    assert len(started) == 1
+    assert {job["id"] for job, _ in results} == {started[0]["id"]}
+    assert len(app.list_training_jobs()) == 1
+
+
+def test_resume_of_unknown_job_is_rejected(app, jobs_dir):
+    with pytest.raises(ValueError):
+        app.start_training_job("phase1", {"episodes": 100, "resume": "missing"})
+    assert app.list_training_jobs() == []
+
+
+def test_phase1_progress_reports_win_counts(app):
+    reports = []
+    results = app.train_phase1(app.QLearningAgent(), episodes=1000, save_path=None, log_every=0,
+                               progress=lambda done, epsilon, counts: reports.append((done, dict(counts))),
+                               rng=random.Random(1))
+    assert [done for done, _ in reports] == [500, 1000]
+    assert all(sum(counts.values()) == done for done, counts in reports)
+    assert reports[-1][1] == results and results["agent1_win"] > 0 and results["agent2_win"] > 0
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/train", {"episodes": -5}),
+    ("/train2", {"episodes": "1e6"}),
+    ("/train", {"checkpoint_every": 0}),
+    ("/train2", {"seed": "abc"}),
+    ("/train2", {"seed": -1}),
+])
+def test_invalid_params_are_rejected(app, client, jobs_dir, path, params):
+    response = client.post(path, json=params)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+    assert app.list_training_jobs() == []
+
+
+def test_valid_params_start_a_job(app, client, jobs_dir):
+    response = client.post("/train2", json={"workers": "2", "seed": 0, "checkpoint_every": 1000})
+    assert response.status_code == 202
+    assert response.get_json()["job"]["params"] == {"episodes": 2000000, "workers": 2, "seed": 0,
+                                                    "checkpoint_every": 1000}
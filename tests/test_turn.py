@@ -0,0 +1,46 @@
+"""/turn (プレイヤーの行動とAIのターンを1回のリクエストで)"""
+import contextlib
+import io
+
+
+def _play(app, seed, use_turn):
+    """同じ乱数で1ゲーム遊び、各ターンのプレイヤーとAIのレスポンスを返す"""
+    app.game_rng.seed(seed)
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = app.app.test_client()
+        state = client.post("/start_game").get_json()
+        for _ in range(40):
+            action = "hit" if sum(state["player_hand"]) < 16 else "stand"
+            if use_turn:
+                body = client.post("/turn", json={"action": action}).get_json()
+                player, ai = body["player"], body["ai"]
+            else:
+                player = client.post(f"/{action}").get_json()
+                ai = client.post("/ai_turn").get_json()
+            results.append((player, ai))
+            state = ai
+            if state["game_over"]:
+                return results
+    raise AssertionError("ゲームが終わりませんでした")
+
+
+def test_turn_matches_separate_requests(app):
+    for seed in range(10):
+        assert _play(app, seed, use_turn=True) == _play(app, seed, use_turn=False)
+
+
+def test_turn_rejects_unknown_action(client):
+    client.post("/start_game")
+    response = client.post("/turn", json={"action": "double"})
+    assert response.status_code == 400
+
+
+def test_turn_without_ai_reply(app, client):
+    """プレイヤーのターンでなければ AI には進まず "ai" は null"""
+    client.post("/start_game")
+    with client.session_transaction() as session:
+        session["turn"] = "ai"
+    body = client.post("/turn", json={"action": "stand"}).get_json()
+    assert body["player"]["message"] == "Not your turn"
+    assert body["ai"] is None